@@ -0,0 +1,107 @@
+'''
+Copyright Nate Carson 2013
+
+Finds the draws that could have been claimed in the games of a corpus, by
+threefold repetition or the fifty move rule, and the ply each could first
+be claimed at. Every game is replayed once with a RepetitionTracker (see
+game_engine) so a game takes time in proportion to its length.
+
+    for game, (ply, reason) in enumerate(drawClaims('corpus.cja', processes=8)):
+        if reason:
+            print game, ply, reason
+
+Pgn files are read through pgn.PgnImport and archives are split into game
+ranges, both across a process pool.
+'''
+
+import itertools
+from multiprocessing import Pool
+
+from game_engine import firstDrawClaim
+from archive import Archive
+from pgn import PgnImport
+
+
+def _claimRange(args):
+
+    archive_name, start, end = args
+    archive = Archive(archive_name)
+    try:
+        claims = []
+        for n in xrange(start, end):
+            line = archive.gameLine(n)
+            claims.append(firstDrawClaim(line.moves, line.start_fen))
+        return claims
+    finally:
+        archive.close()
+
+
+def _archiveClaims(archive_name, processes, size):
+
+    archive = Archive(archive_name)
+    count = len(archive)
+    archive.close()
+    ranges = [(archive_name, start, min(count, start + size)) for start in xrange(0, count, size)]
+
+    if processes > 1 and len(ranges) > 1:
+        pool = Pool(min(processes, len(ranges)))
+        results = pool.imap(_claimRange, ranges)
+    else:
+        pool = None
+        results = itertools.imap(_claimRange, ranges)
+
+    try:
+        for claims in results:
+            for claim in claims:
+                yield claim
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def _pgnClaims(filename, processes):
+
+    # games with an illegal move keep their place so games are numbered as in the file
+    for game in PgnImport(filename, processes, skip_illegal=False):
+        if game.packed is None:
+            yield None, None
+        else:
+            yield firstDrawClaim(game.packed, game.fen)
+
+
+def drawClaims(source, processes=1, size=4096):
+    '''
+        Yields (ply, reason) for every game of a pgn file or archive (.cja) in
+        order, (None, None) for a game where no draw could be claimed or that
+        has an illegal move.
+    '''
+
+    if source.endswith('.cja'):
+        return _archiveClaims(source, processes, size)
+    return _pgnClaims(source, processes)
+
+
+if __name__ == '__main__':
+
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='find the draws that could be claimed in games')
+    parser.add_argument('source', help='pgn file or archive (.cja)')
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('-q', '--quiet', action='store_true', help='only print the counts')
+    args = parser.parse_args()
+
+    begin = time.time()
+    counts = {}
+    games = 0
+    for game, (ply, reason) in enumerate(drawClaims(args.source, args.processes)):
+        games += 1
+        counts[reason] = counts.get(reason, 0) + 1
+        if reason and not args.quiet:
+            print 'game %d ply %d: %s' % (game, ply, reason)
+
+    print '%d games in %.2fs' % (games, time.time() - begin)
+    for reason in sorted(counts):
+        print '    %s %d' % (reason or 'no claim', counts[reason])
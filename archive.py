@@ -0,0 +1,303 @@
+'''
+Copyright Nate Carson 2013
+
+Compact binary archive of games. A game takes a small header block and two
+bytes a move, players and events are stored once in a string table and an
+offsets table finds any game directly. Archives are read through mmap so a
+game's moves are a slice of the file.
+
+    writer = ArchiveWriter('corpus.cja')
+    for game in readGames('games.pgn'):
+        writer.addGame(game)
+    writer.close()
+
+    archive = Archive('corpus.cja')
+    line = archive.gameLine(1250000)
+
+All numbers are little endian. The file is laid out as
+
+    file header     magic, version, game count, offsets table and string
+                    table positions, string count
+    games           per game a header block (string ids of the tags, result,
+                    ply count) followed by its packed 16 bit moves
+                    (target | source << 6 | promotion << 12)
+    offsets table   uint64 position of every game
+    string table    uint32 end of every string then the utf-8 strings
+'''
+
+import sys
+import mmap
+import struct
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import bitboard
+from game_engine import ChessLibGameEngine, GameLine
+
+
+class ArchiveError(Exception): pass
+
+
+# pgn tags kept for every game, in header block order
+TAGS = ('Event', 'Site', 'Date', 'Round', 'White', 'Black', 'ECO', 'WhiteElo', 'BlackElo', 'FEN')
+RESULTS = ('*', '1-0', '0-1', '1/2-1/2')
+NO_STRING = 0xffffffff
+
+MAGIC = 'CJGA'
+VERSION = 1
+# magic, version, games, offsets table, string table, strings
+HEADER = struct.Struct('<4sIIQQI')
+# a string id for every tag, result, plies
+GAME = struct.Struct('<%dIBxH' % len(TAGS))
+
+_swap = sys.byteorder != 'little'
+
+
+class ArchiveWriter(object):
+    '''
+        Writes games to an archive as they are added. The offsets and string
+        tables are written by close().
+    '''
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self._file = open(filename, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0, 0))
+        self._offsets = []
+        self._strings = {}
+        self._string_list = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _stringId(self, text):
+
+        if not text:
+            return NO_STRING
+        sid = self._strings.get(text)
+        if sid is None:
+            sid = self._strings[text] = len(self._string_list)
+            self._string_list.append(text)
+        return sid
+
+    def add(self, moves, headers=None, result='*'):
+        '''Adds a game from its packed moves and a dict of pgn tags, returns its number.'''
+
+        headers = headers or {}
+        result = headers.get('Result', result)
+        try:
+            result = RESULTS.index(result)
+        except ValueError:
+            result = 0
+
+        moves = array('H', moves)
+        if len(moves) > 0xffff:
+            raise ArchiveError('game of %d plies is too long' % len(moves))
+        if _swap:
+            moves.byteswap()
+
+        ids = [self._stringId(headers.get(tag)) for tag in TAGS]
+        self._offsets.append(self._file.tell())
+        self._file.write(GAME.pack(*(ids + [result, len(moves)])))
+        self._file.write(moves.tostring())
+        return len(self._offsets) - 1
+
+    def addGame(self, game):
+        '''Adds a pgn.PgnGame, replaying it unless an import already packed its moves.'''
+
+        moves = game.packed
+        if moves is None:
+            replay = ChessLibGameEngine('bitboard').replay(game.sans, game.fen)
+            if replay.illegal is not None:
+                raise ArchiveError('illegal move %s at ply %d of %s' % (
+                    game.sans[replay.illegal], replay.illegal, game))
+            moves = replay.packed
+        return self.add(moves, game.headers, game.result)
+
+    def addLine(self, line, headers=None, result='*'):
+        '''Adds a GameLine, for instance ChessLibGameEngine.gameLine().'''
+
+        headers = dict(headers or {})
+        if line.start_fen != bitboard.BitboardPosition.START_FEN:
+            headers['FEN'] = line.start_fen
+        return self.add(line.moves, headers, result)
+
+    def close(self):
+
+        if self._file is None:
+            return
+        f = self._file
+
+        offsets_pos = f.tell()
+        f.write(struct.pack('<%dQ' % len(self._offsets), *self._offsets))
+
+        strings_pos = f.tell()
+        encoded = [s if isinstance(s, str) else s.encode('utf-8') for s in self._string_list]
+        ends, end = [], 0
+        for s in encoded:
+            end += len(s)
+            ends.append(end)
+        f.write(struct.pack('<%dI' % len(ends), *ends))
+        f.write(''.join(encoded))
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(self._offsets), offsets_pos, strings_pos, len(encoded)))
+        f.close()
+        self._file = None
+
+
+class Archive(object):
+    '''Reads an archive through mmap.'''
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ArchiveError('empty archive %s' % filename)
+
+        if len(self._map) < HEADER.size:
+            raise ArchiveError('%s is not a game archive' % filename)
+        magic, version, count, offsets_pos, strings_pos, strings = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ArchiveError('%s is not a game archive' % filename)
+        if version != VERSION:
+            raise ArchiveError('%s is archive version %d' % (filename, version))
+
+        self._count = count
+        self._offsets_pos = offsets_pos
+        self._ends_pos = strings_pos
+        self._text_pos = strings_pos + 4 * strings
+        self._strings = strings
+        self._cache = {}
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self._count
+
+    def _offset(self, n):
+
+        if n < 0:
+            n += self._count
+        if not 0 <= n < self._count:
+            raise IndexError(n)
+        return struct.unpack_from('<Q', self._map, self._offsets_pos + 8 * n)[0]
+
+    def string(self, sid):
+        '''Returns the text of a string id.'''
+
+        if sid == NO_STRING:
+            return None
+        text = self._cache.get(sid)
+        if text is None:
+            end = struct.unpack_from('<I', self._map, self._ends_pos + 4 * sid)[0]
+            start = sid and struct.unpack_from('<I', self._map, self._ends_pos + 4 * sid - 4)[0]
+            text = self._cache[sid] = self._map[self._text_pos + start:self._text_pos + end]
+        return text
+
+    def _game(self, n):
+        offset = self._offset(n)
+        fields = GAME.unpack_from(self._map, offset)
+        return offset + GAME.size, fields
+
+    def headers(self, n):
+        '''Returns the pgn tags of game n as a dict.'''
+
+        start, fields = self._game(n)
+        headers = dict([(tag, self.string(sid)) for tag, sid in zip(TAGS, fields) if sid != NO_STRING])
+        headers['Result'] = RESULTS[fields[-2]]
+        return headers
+
+    def plies(self, n):
+        return self._game(n)[1][-1]
+
+    def moves(self, n):
+        '''
+            Returns the packed moves of game n. With numpy this is a read only
+            view of the mapped file, otherwise an array module copy.
+        '''
+
+        start, fields = self._game(n)
+        plies = fields[-1]
+        if numpy is not None:
+            return numpy.frombuffer(self._map, dtype='<u2', count=plies, offset=start)
+        moves = array('H')
+        moves.fromstring(self._map[start:start + 2 * plies])
+        if _swap:
+            moves.byteswap()
+        return moves
+
+    def gameLine(self, n):
+        '''Returns game n as a GameLine.'''
+
+        start, fields = self._game(n)
+        fen = self.string(fields[TAGS.index('FEN')])
+        moves = array('H')
+        moves.fromstring(self._map[start:start + 2 * fields[-1]])
+        if _swap:
+            moves.byteswap()
+        return GameLine(moves, fen)
+
+    def gameMoves(self, n, engine=None):
+        '''Plays game n through an engine and returns its GameMoves.'''
+
+        engine = engine or ChessLibGameEngine()
+        start, fields = self._game(n)
+        engine.newGame(self.string(fields[TAGS.index('FEN')]))
+        return [engine.makePackedMove(move) for move in self.gameLine(n).moves]
+
+    def __iter__(self):
+        for n in xrange(self._count):
+            yield self.gameLine(n)
+
+
+if __name__ == '__main__':
+
+    import time
+    import argparse
+
+    from pgn import readGames, PgnImport
+
+    parser = argparse.ArgumentParser(description='write or read a game archive')
+    parser.add_argument('archive')
+    parser.add_argument('pgn', nargs='?', help='pgn file to write into the archive')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='import the pgn across processes')
+    parser.add_argument('-g', '--game', type=int, help='game number to show')
+    args = parser.parse_args()
+
+    if args.pgn:
+        begin = time.time()
+        games = PgnImport(args.pgn, args.processes) if args.processes > 1 else readGames(args.pgn)
+        writer = ArchiveWriter(args.archive)
+        skipped = 0
+        for game in games:
+            try:
+                writer.addGame(game)
+            except ArchiveError, e:
+                skipped += 1
+        count = len(writer)
+        writer.close()
+        print '%d games archived in %.2fs, %d skipped' % (count, time.time() - begin, skipped)
+
+    archive = Archive(args.archive)
+    print '%d games' % len(archive)
+    if args.game is not None:
+        print archive.headers(args.game)
+        line = archive.gameLine(args.game)
+        print ' '.join([move.san for move in line])
@@ -0,0 +1,787 @@
+'''
+Copyright Nate Carson 2013
+
+Native bitboard position for the game engine.
+
+Squares are numbered 0 - 63 from a1 to h8 (a1 = 0, b1 = 1, ... h8 = 63).
+Moves are packed into 16 bits the same way polyglot packs them:
+target | source << 6 | promotion << 12, where promotion is the piece kind.
+'''
+
+from zobrist import PIECE_KEYS, CASTLING_KEYS, EP_KEYS, TURN_KEY
+
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+
+# a piece is color * 6 + kind
+EMPTY = -1
+SYMBOLS = 'PNBRQKpnbrqk'
+
+FULL = 0xFFFFFFFFFFFFFFFF
+
+FILES = 'abcdefgh'
+RANKS = '12345678'
+SQUARE_NAMES = [f + r for r in RANKS for f in FILES]
+SQUARE_INDEX = dict((name, idx) for idx, name in enumerate(SQUARE_NAMES))
+
+RANK_3 = 0xFF << 16
+RANK_6 = 0xFF << 40
+BACK_RANKS = 0xFF | 0xFF << 56
+
+CASTLE_WHITE_KING, CASTLE_WHITE_QUEEN, CASTLE_BLACK_KING, CASTLE_BLACK_QUEEN = 1, 2, 4, 8
+CASTLING_SYMBOLS = 'KQkq'
+
+# castling rights kept when a piece moves from or to a square
+CASTLING_MASK = [15] * 64
+CASTLING_MASK[0] = 15 ^ CASTLE_WHITE_QUEEN
+CASTLING_MASK[4] = 15 ^ (CASTLE_WHITE_KING | CASTLE_WHITE_QUEEN)
+CASTLING_MASK[7] = 15 ^ CASTLE_WHITE_KING
+CASTLING_MASK[56] = 15 ^ CASTLE_BLACK_QUEEN
+CASTLING_MASK[60] = 15 ^ (CASTLE_BLACK_KING | CASTLE_BLACK_QUEEN)
+CASTLING_MASK[63] = 15 ^ CASTLE_BLACK_KING
+
+
+class MoveError(Exception): pass
+
+
+def _steps(sq, deltas):
+    x, y = sq & 7, sq >> 3
+    bb = 0
+    for dx, dy in deltas:
+        if 0 <= x + dx < 8 and 0 <= y + dy < 8:
+            bb |= 1 << ((y + dy) * 8 + x + dx)
+    return bb
+
+def _ray(sq, dx, dy):
+    x, y = (sq & 7) + dx, (sq >> 3) + dy
+    bb = 0
+    while 0 <= x < 8 and 0 <= y < 8:
+        bb |= 1 << (y * 8 + x)
+        x, y = x + dx, y + dy
+    return bb
+
+KNIGHT_ATTACKS = [_steps(sq, [(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)])
+    for sq in range(64)]
+KING_ATTACKS = [_steps(sq, [(0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1)])
+    for sq in range(64)]
+# squares attacked by a pawn of the given color standing on a square
+PAWN_ATTACKS = [
+    [_steps(sq, [(-1, 1), (1, 1)]) for sq in range(64)],
+    [_steps(sq, [(-1, -1), (1, -1)]) for sq in range(64)],
+]
+
+# rays that run towards higher squares are cut at the lowest blocker,
+# rays that run towards lower squares at the highest one.
+_NORTH, _EAST, _NORTHEAST, _NORTHWEST = [[_ray(sq, dx, dy) for sq in range(64)]
+    for dx, dy in [(0, 1), (1, 0), (1, 1), (-1, 1)]]
+_SOUTH, _WEST, _SOUTHWEST, _SOUTHEAST = [[_ray(sq, dx, dy) for sq in range(64)]
+    for dx, dy in [(0, -1), (-1, 0), (-1, -1), (1, -1)]]
+
+
+def _slide(sq, occupied, positive, negative):
+
+    attacks = 0
+    for rays in positive:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[(blockers & -blockers).bit_length() - 1]
+        attacks |= ray
+    for rays in negative:
+        ray = rays[sq]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= rays[blockers.bit_length() - 1]
+        attacks |= ray
+    return attacks
+
+def rookAttacks(sq, occupied):
+    return _slide(sq, occupied, (_NORTH, _EAST), (_SOUTH, _WEST))
+
+def bishopAttacks(sq, occupied):
+    return _slide(sq, occupied, (_NORTHEAST, _NORTHWEST), (_SOUTHWEST, _SOUTHEAST))
+
+def scan(bb):
+    '''Yields the square of every bit set in the bitboard from low to high.'''
+
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+def packMove(source, target, promotion=0):
+    return target | source << 6 | promotion << 12
+
+def unpackMove(move):
+    '''Returns (source, target, promotion kind) for a packed move.'''
+    return move >> 6 & 63, move & 63, move >> 12 & 7
+
+def moveToUci(move):
+    source, target, promotion = unpackMove(move)
+    uci = SQUARE_NAMES[source] + SQUARE_NAMES[target]
+    if promotion:
+        uci += SYMBOLS[promotion + 6]
+    return uci
+
+def zobristKey(fen):
+    '''Returns the polyglot zobrist key for a fen.'''
+    return BitboardPosition(fen).key
+
+# material signatures count the pieces other than kings in 4 bits each,
+# white pawns in the lowest bits up to black queens
+MATERIAL_SHIFTS = [4 * (color * 5 + kind) if kind != KING else None
+    for color in (WHITE, BLACK) for kind in range(6)]
+MATERIAL_ORDER = 'QRBNP'
+
+def materialSignature(position):
+    '''Returns the material signature of a BitboardPosition.'''
+
+    signature = 0
+    for color in (WHITE, BLACK):
+        pieces = position.colors[color]
+        for kind in range(KING):
+            count = bin(position.kinds[kind] & pieces).count('1')
+            signature |= min(count, 15) << 4 * (color * 5 + kind)
+    return signature
+
+def parseMaterial(text):
+    '''Returns the material signature of text such as KRPvKR, white first.'''
+
+    sides = text.upper().replace('VS', 'V').replace(' ', '').split('V')
+    if len(sides) != 2:
+        raise ValueError(text)
+    signature = 0
+    for color, side in enumerate(sides):
+        for symbol in side:
+            if symbol == 'K':
+                continue
+            if symbol not in MATERIAL_ORDER:
+                raise ValueError(text)
+            signature += 1 << MATERIAL_SHIFTS[color * 6 + SYMBOLS.index(symbol)]
+    return signature
+
+def materialString(signature):
+    '''Returns the text of a material signature, such as KRPvKR.'''
+
+    sides = []
+    for color in (WHITE, BLACK):
+        side = 'K'
+        for symbol in MATERIAL_ORDER:
+            side += symbol * (signature >> MATERIAL_SHIFTS[color * 6 + SYMBOLS.index(symbol)] & 15)
+        sides.append(side)
+    return 'v'.join(sides)
+
+def uciToMove(uci):
+    if len(uci) not in (4, 5) or uci[0:2] not in SQUARE_INDEX or uci[2:4] not in SQUARE_INDEX:
+        raise MoveError(uci)
+    promotion = 0
+    if len(uci) == 5:
+        if uci[4].lower() not in 'nbrq':
+            raise MoveError(uci)
+        promotion = SYMBOLS.index(uci[4].upper())
+    return packMove(SQUARE_INDEX[uci[0:2]], SQUARE_INDEX[uci[2:4]], promotion)
+
+
+class Square(object):
+    '''Board square with the attributes the board widget expects from a move.'''
+
+    __slots__ = ('index', 'name')
+
+    def __init__(self, index):
+        self.index = index
+        self.name = SQUARE_NAMES[index]
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return 'Square(%s)' % self.name
+
+SQUARES = [Square(idx) for idx in range(64)]
+
+
+class Move(object):
+    '''
+        Thin wrapper around a packed move that looks like a python-chess move
+        so the widgets can use either.
+    '''
+
+    __slots__ = ('packed',)
+
+    def __init__(self, packed):
+        self.packed = packed
+
+    @classmethod
+    def from_uci(cls, uci):
+        return cls(uciToMove(str(uci)))
+
+    @property
+    def source(self):
+        return SQUARES[self.packed >> 6 & 63]
+
+    @property
+    def target(self):
+        return SQUARES[self.packed & 63]
+
+    @property
+    def promotion(self):
+        promotion = self.packed >> 12 & 7
+        return SYMBOLS[promotion + 6] if promotion else None
+
+    @property
+    def uci(self):
+        return moveToUci(self.packed)
+
+    def __str__(self):
+        return self.uci
+
+    def __repr__(self):
+        return 'Move.from_uci(%r)' % self.uci
+
+    def __eq__(self, other):
+        return isinstance(other, Move) and self.packed == other.packed
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self.packed
+
+
+class BitboardPosition(object):
+    '''
+        Position kept as one occupancy mask per piece kind and per color,
+        plus a 64 entry mailbox for looking up the piece on a square.
+
+        key is the polyglot compatible zobrist key of the position and is
+        updated incrementally as moves are made and taken back.
+    '''
+
+    START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+    def __init__(self, fen=None):
+        self.setFen(fen or self.START_FEN)
+
+    def __str__(self):
+        return self.toFen()
+
+    def __repr__(self):
+        return '<BitboardPosition %s>' % self.toFen()
+
+    def copy(self):
+        position = BitboardPosition.__new__(BitboardPosition)
+        position.__dict__.update(self.__dict__)
+        position.board = self.board[:]
+        position.kinds = self.kinds[:]
+        position.colors = self.colors[:]
+        return position
+
+    def setFen(self, fen):
+
+        parts = str(fen).split()
+        # allow epd style fens without the move counters
+        if len(parts) == 4:
+            parts += ['0', '1']
+        if len(parts) != 6:
+            raise ValueError(fen)
+        placement, turn, castling, ep_square, halfmove_clock, full_move = parts
+
+        self.board = [EMPTY] * 64
+        self.kinds = [0] * 6
+        self.colors = [0, 0]
+        self.key = 0
+
+        rows = placement.split('/')
+        if len(rows) != 8:
+            raise ValueError(fen)
+        for y, row in enumerate(rows):
+            x = 0
+            for char in row:
+                if char.isdigit():
+                    x += int(char)
+                    continue
+                if x > 7 or char not in SYMBOLS:
+                    raise ValueError(fen)
+                self._put(SYMBOLS.index(char), (7 - y) * 8 + x)
+                x += 1
+            if x != 8:
+                raise ValueError(fen)
+
+        if turn not in ('w', 'b'):
+            raise ValueError(fen)
+        self.turn = WHITE if turn == 'w' else BLACK
+
+        self.castling = 0
+        if castling != '-':
+            for char in castling:
+                if char not in CASTLING_SYMBOLS:
+                    raise ValueError(fen)
+                self.castling |= 1 << CASTLING_SYMBOLS.index(char)
+
+        if ep_square == '-':
+            self.ep_square = None
+        elif ep_square in SQUARE_INDEX:
+            self.ep_square = SQUARE_INDEX[ep_square]
+        else:
+            raise ValueError(fen)
+
+        self.halfmove_clock = int(halfmove_clock)
+        self.full_move = int(full_move)
+        self._fen = None
+        self._legal = self._legal_moves = self._legal_key = None
+
+        self.key ^= CASTLING_KEYS[self.castling] ^ self._epKey()
+        if self.turn == WHITE:
+            self.key ^= TURN_KEY
+
+    def toFen(self):
+
+        if self._fen is not None:
+            return self._fen
+
+        rows = []
+        for rank in range(7, -1, -1):
+            row, empties = '', 0
+            for sq in range(rank * 8, rank * 8 + 8):
+                piece = self.board[sq]
+                if piece == EMPTY:
+                    empties += 1
+                    continue
+                if empties:
+                    row += str(empties)
+                    empties = 0
+                row += SYMBOLS[piece]
+            if empties:
+                row += str(empties)
+            rows.append(row)
+
+        castling = ''.join([c for idx, c in enumerate(CASTLING_SYMBOLS) if self.castling & 1 << idx])
+        self._fen = ' '.join([
+            '/'.join(rows),
+            'wb'[self.turn],
+            castling or '-',
+            SQUARE_NAMES[self.ep_square] if self.ep_square is not None else '-',
+            str(self.halfmove_clock),
+            str(self.full_move),
+        ])
+        return self._fen
+
+    def _put(self, piece, sq):
+        bb = 1 << sq
+        self.board[sq] = piece
+        self.kinds[piece % 6] |= bb
+        self.colors[piece // 6] |= bb
+        self.key ^= PIECE_KEYS[piece][sq]
+
+    def _remove(self, sq):
+        bb = 1 << sq
+        piece = self.board[sq]
+        self.board[sq] = EMPTY
+        self.kinds[piece % 6] ^= bb
+        self.colors[piece // 6] ^= bb
+        self.key ^= PIECE_KEYS[piece][sq]
+        return piece
+
+    def _epKey(self):
+        '''Polyglot only hashes the en passant file if the side to move has a pawn to take with.'''
+
+        ep_square = self.ep_square
+        if ep_square is None:
+            return 0
+        us = self.turn
+        if PAWN_ATTACKS[us ^ 1][ep_square] & self.kinds[PAWN] & self.colors[us]:
+            return EP_KEYS[ep_square & 7]
+        return 0
+
+    def computeKey(self):
+        '''Returns the polyglot zobrist key built from scratch.'''
+
+        key = CASTLING_KEYS[self.castling] ^ self._epKey()
+        if self.turn == WHITE:
+            key ^= TURN_KEY
+        for sq, piece in enumerate(self.board):
+            if piece != EMPTY:
+                key ^= PIECE_KEYS[piece][sq]
+        return key
+
+    def pieceAt(self, sq):
+        '''Returns the piece symbol on a square or None.'''
+        piece = self.board[sq]
+        return SYMBOLS[piece] if piece != EMPTY else None
+
+    def kingSquare(self, color):
+        king = self.kinds[KING] & self.colors[color]
+        return (king & -king).bit_length() - 1 if king else None
+
+    def isAttacked(self, sq, by):
+        '''Returns True if any piece of color by attacks the square.'''
+
+        kinds, them = self.kinds, self.colors[by]
+        if PAWN_ATTACKS[by ^ 1][sq] & kinds[PAWN] & them:
+            return True
+        if KNIGHT_ATTACKS[sq] & kinds[KNIGHT] & them:
+            return True
+        if KING_ATTACKS[sq] & kinds[KING] & them:
+            return True
+        occupied = self.colors[WHITE] | self.colors[BLACK]
+        queens = kinds[QUEEN]
+        if rookAttacks(sq, occupied) & (kinds[ROOK] | queens) & them:
+            return True
+        if bishopAttacks(sq, occupied) & (kinds[BISHOP] | queens) & them:
+            return True
+        return False
+
+    def isCheck(self):
+        king = self.kingSquare(self.turn)
+        return king is not None and self.isAttacked(king, self.turn ^ 1)
+
+    def makeMove(self, move):
+        '''
+            Plays a packed move without checking it and returns the state
+            needed to take it back with unmakeMove.
+        '''
+
+        source, target, promotion = move >> 6 & 63, move & 63, move >> 12 & 7
+        us = self.turn
+        captured = self.board[target]
+        undo = (move, captured, self.castling, self.ep_square, self.halfmove_clock, self.key)
+        ep_square = self.ep_square
+        self.key ^= CASTLING_KEYS[self.castling] ^ self._epKey() ^ TURN_KEY
+
+        self.ep_square = None
+        self.halfmove_clock += 1
+        if captured != EMPTY:
+            self._remove(target)
+            self.halfmove_clock = 0
+
+        piece = self._remove(source)
+        kind = piece % 6
+        if kind == PAWN:
+            self.halfmove_clock = 0
+            if target == ep_square:
+                self._remove(target - 8 if us == WHITE else target + 8)
+            elif target - source in (16, -16):
+                self.ep_square = (source + target) // 2
+            if promotion:
+                piece = us * 6 + promotion
+        elif kind == KING and target - source in (2, -2):
+            if target > source:
+                self._put(self._remove(source + 3), source + 1)
+            else:
+                self._put(self._remove(source - 4), source - 1)
+        self._put(piece, target)
+
+        self.castling &= CASTLING_MASK[source] & CASTLING_MASK[target]
+        self.turn = us ^ 1
+        if us == BLACK:
+            self.full_move += 1
+        self.key ^= CASTLING_KEYS[self.castling] ^ self._epKey()
+        self._fen = None
+        return undo
+
+    def unmakeMove(self, undo):
+
+        move, captured, castling, ep_square, halfmove_clock, key = undo
+        source, target, promotion = move >> 6 & 63, move & 63, move >> 12 & 7
+        self.turn = us = self.turn ^ 1
+        if us == BLACK:
+            self.full_move -= 1
+
+        piece = self._remove(target)
+        if promotion:
+            piece = us * 6 + PAWN
+        self._put(piece, source)
+
+        kind = piece % 6
+        if captured != EMPTY:
+            self._put(captured, target)
+        elif kind == PAWN and target == ep_square:
+            self._put((us ^ 1) * 6 + PAWN, target - 8 if us == WHITE else target + 8)
+        elif kind == KING and target - source in (2, -2):
+            if target > source:
+                self._put(self._remove(source + 1), source + 3)
+            else:
+                self._put(self._remove(source - 1), source - 4)
+
+        self.castling = castling
+        self.ep_square = ep_square
+        self.halfmove_clock = halfmove_clock
+        self.key = key
+        self._fen = None
+
+    def pseudoLegalMoves(self):
+        '''Returns packed moves that may leave the king in check.'''
+
+        us = self.turn
+        board, kinds = self.board, self.kinds
+        own, enemy = self.colors[us], self.colors[us ^ 1]
+        occupied = own | enemy
+        moves = []
+        append = moves.append
+
+        # pawns
+        pawns = kinds[PAWN] & own
+        if us == WHITE:
+            forward = 8
+            single = (pawns << 8) & ~occupied & FULL
+            double = ((single & RANK_3) << 8) & ~occupied
+        else:
+            forward = -8
+            single = (pawns >> 8) & ~occupied
+            double = ((single & RANK_6) >> 8) & ~occupied
+
+        captures = enemy
+        if self.ep_square is not None:
+            captures |= 1 << self.ep_square
+        targets = [(target - forward, target) for target in scan(single)]
+        for source in scan(pawns):
+            for target in scan(PAWN_ATTACKS[us][source] & captures):
+                targets.append((source, target))
+        for source, target in targets:
+            if 1 << target & BACK_RANKS:
+                for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+                    append(target | source << 6 | promotion << 12)
+            else:
+                append(target | source << 6)
+        for target in scan(double):
+            append(target | (target - forward * 2) << 6)
+
+        # pieces
+        for source in scan(kinds[KNIGHT] & own):
+            for target in scan(KNIGHT_ATTACKS[source] & ~own):
+                append(target | source << 6)
+        for source in scan((kinds[BISHOP] | kinds[QUEEN]) & own):
+            for target in scan(bishopAttacks(source, occupied) & ~own):
+                append(target | source << 6)
+        for source in scan((kinds[ROOK] | kinds[QUEEN]) & own):
+            for target in scan(rookAttacks(source, occupied) & ~own):
+                append(target | source << 6)
+
+        # king
+        king = self.kingSquare(us)
+        if king is None:
+            return moves
+        for target in scan(KING_ATTACKS[king] & ~own):
+            append(target | king << 6)
+
+        # castling, the square the king lands on is checked by legalMoves
+        if us == WHITE:
+            rights, home, rook = self.castling & 3, 4, 3
+        else:
+            rights, home, rook = self.castling >> 2 & 3, 60, 9
+        if rights and king == home and not self.isAttacked(home, us ^ 1):
+            if (rights & 1 and board[home + 3] == rook and not occupied & (3 << home + 1)
+                    and not self.isAttacked(home + 1, us ^ 1)):
+                append(home + 2 | home << 6)
+            if (rights & 2 and board[home - 4] == rook and not occupied & (7 << home - 3)
+                    and not self.isAttacked(home - 1, us ^ 1)):
+                append(home - 2 | home << 6)
+
+        return moves
+
+    def legalTable(self):
+        '''
+            Returns a dict from every legal packed move (target | source << 6 | promotion << 12)
+            to its san, which is filled in when first asked for. The table is built once per
+            position and kept until the position key changes.
+        '''
+
+        if self._legal is None or self._legal_key != self.key:
+            moves = self._generateLegalMoves()
+            self._legal = dict.fromkeys(moves)
+            self._legal_moves = moves
+            self._legal_key = self.key
+        return self._legal
+
+    def legalMoves(self):
+        '''Returns every legal packed move. The list is shared so do not change it.'''
+
+        self.legalTable()
+        return self._legal_moves
+
+    def movesFrom(self, source):
+        '''Returns the legal packed moves of the piece on a square.'''
+        return [move for move in self.legalMoves() if move >> 6 & 63 == source]
+
+    def _generateLegalMoves(self):
+
+        if self.kingSquare(self.turn) is None:
+            return self.pseudoLegalMoves()
+        return [move for move in self.pseudoLegalMoves() if self._isSafe(move)]
+
+    def _isSafe(self, move):
+        '''Returns True if a pseudo legal move does not leave the king in check.'''
+
+        us = self.turn
+        undo = self.makeMove(move)
+        king = self.kingSquare(us)
+        safe = king is None or not self.isAttacked(king, us ^ 1)
+        self.unmakeMove(undo)
+        return safe
+
+    def hasLegalMove(self):
+
+        for move in self.pseudoLegalMoves():
+            if self._isSafe(move):
+                return True
+        return False
+
+    def isCheckmate(self):
+        return self.isCheck() and not self.hasLegalMove()
+
+    def isStalemate(self):
+        return not self.isCheck() and not self.hasLegalMove()
+
+    def isLegal(self, move):
+        return move in self.legalTable()
+
+    def san(self, move):
+        '''Returns the standard algebraic notation for a legal packed move.'''
+
+        table = self.legalTable()
+        san = table.get(move)
+        if san is not None:
+            return san
+        if move not in table:
+            raise MoveError(moveToUci(move))
+
+        source, target = move >> 6 & 63, move & 63
+        piece = self.board[source]
+        others = []
+        if piece % 6 not in (PAWN, KING):
+            others = [m >> 6 & 63 for m in self._legal_moves
+                if m & 63 == target and m >> 6 & 63 != source and self.board[m >> 6 & 63] == piece]
+        san = table[move] = self._san(move, others)
+        return san
+
+    def legalSan(self, move):
+        '''
+            Returns the san of a packed move already known to be legal, such as a
+            move of a game line, without building the legal table. Only the
+            pieces that could also reach the target square are tried.
+        '''
+
+        source, target = move >> 6 & 63, move & 63
+        piece = self.board[source]
+        kind = piece % 6
+        others = []
+        if kind not in (PAWN, KING):
+            occupied = self.colors[WHITE] | self.colors[BLACK]
+            if kind == KNIGHT:
+                reach = KNIGHT_ATTACKS[target]
+            elif kind == BISHOP:
+                reach = bishopAttacks(target, occupied)
+            elif kind == ROOK:
+                reach = rookAttacks(target, occupied)
+            else:
+                reach = bishopAttacks(target, occupied) | rookAttacks(target, occupied)
+            same = reach & self.kinds[kind] & self.colors[self.turn] & ~(1 << source)
+            # a pinned piece does not need telling apart
+            others = [other for other in scan(same) if self._isSafe(target | other << 6)]
+        return self._san(move, others)
+
+    def _san(self, move, others):
+        '''Returns the san of a legal move given the squares of the other pieces like it that reach its target.'''
+
+        source, target, promotion = move >> 6 & 63, move & 63, move >> 12 & 7
+        piece = self.board[source]
+        kind = piece % 6
+
+        if kind == KING and target - source in (2, -2):
+            san = 'O-O' if target > source else 'O-O-O'
+
+        elif kind == PAWN:
+            san = ''
+            if (source ^ target) & 7:
+                san = FILES[source & 7] + 'x'
+            san += SQUARE_NAMES[target]
+            if promotion:
+                san += '=' + SYMBOLS[promotion]
+
+        else:
+            san = SYMBOLS[kind]
+            if others:
+                if not [s for s in others if (s ^ source) & 7 == 0]:
+                    san += FILES[source & 7]
+                elif not [s for s in others if s >> 3 == source >> 3]:
+                    san += RANKS[source >> 3]
+                else:
+                    san += SQUARE_NAMES[source]
+            if self.board[target] != EMPTY:
+                san += 'x'
+            san += SQUARE_NAMES[target]
+
+        undo = self.makeMove(move)
+        if self.isCheck():
+            san += '+' if self.hasLegalMove() else '#'
+        self.unmakeMove(undo)
+        return san
+
+    def parseSan(self, san):
+        '''Returns the legal packed move for a san string or raises MoveError.'''
+
+        text = str(san).strip().rstrip('+#!?')
+        # a san picks out one or two moves, so only those are checked for
+        # legality unless the position's legal moves are already known
+        if self._legal is not None and self._legal_key == self.key:
+            moves, checked = self._legal_moves, True
+        else:
+            moves, checked = self.pseudoLegalMoves(), False
+
+        if text in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+            step = 2 if len(text) == 3 else -2
+            for move in moves:
+                source = move >> 6 & 63
+                if self.board[source] % 6 == KING and (move & 63) - source == step:
+                    if checked or self._isSafe(move):
+                        return move
+            raise MoveError(san)
+
+        promotion = 0
+        if '=' in text:
+            text, symbol = text.split('=', 1)
+            if symbol not in ('N', 'B', 'R', 'Q'):
+                raise MoveError(san)
+            promotion = SYMBOLS.index(symbol)
+        elif len(text) > 2 and text[-1] in 'NBRQ' and text[-2] in '18':
+            promotion = SYMBOLS.index(text[-1])
+            text = text[:-1]
+
+        target = SQUARE_INDEX.get(text[-2:])
+        if target is None:
+            raise MoveError(san)
+        text = text[:-2].replace('x', '').replace('-', '')
+
+        kind = PAWN
+        if text and text[0] in 'NBRQK':
+            kind = SYMBOLS.index(text[0])
+            text = text[1:]
+
+        candidates = []
+        for move in moves:
+            source = move >> 6 & 63
+            if move & 63 != target or move >> 12 & 7 != promotion:
+                continue
+            if self.board[source] % 6 != kind:
+                continue
+            name = SQUARE_NAMES[source]
+            if [c for c in text if c not in name]:
+                continue
+            candidates.append(move)
+
+        if not checked:
+            candidates = [move for move in candidates if self._isSafe(move)]
+        if len(candidates) != 1:
+            raise MoveError(san)
+        return candidates[0]
+
+
+if __name__ == '__main__':
+
+    position = BitboardPosition()
+    for san in 'e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7'.split():
+        move = position.parseSan(san)
+        print position.san(move), moveToUci(move)
+        position.makeMove(move)
+    print position.toFen()
@@ -17,6 +17,8 @@ class MoveError(Exception): pass
 
 class BoardItem(QtGui.QGraphicsRectItem):
 
+    square_class = AlgSquare
+
     def __init__(self):
         super(BoardItem, self).__init__()
 
@@ -40,10 +42,7 @@ class BoardItem(QtGui.QGraphicsRectItem):
         return QtCore.QSizeF(rect.width(), rect.height())
     
     def getSquare(self, x, y):  
-        for square in self:
-            if square.algsquare.x == x and square.algsquare.y == y:
-                return square
-        raise KeyError((x, y))
+        return self._squares[self.square_class.at(x, y).label]
     
     def setBoard(self, boardstring):
 
@@ -61,14 +60,12 @@ class BoardItem(QtGui.QGraphicsRectItem):
         self._createSquares(str(boardstring))
 
     def toString(self):
-        algsquares = list(AlgSquare.generate())
-        string = list(BoardString.EMPTY_SQUARE * len(algsquares))
-        for square in algsquares:
-            idx = self._toboardnum(square.x, square.y)
+        board = BoardString(BoardString.EMPTY_SQUARE * 64)
+        for square in AlgSquare.generate():
             piece = self._squares[square.label].getPiece()
             if piece:
-                string[idx] = piece.name
-        return BoardString(''.join(string))
+                board[square] = piece.name
+        return board
     
     def _createSquares(self, boardstring):
         # AlgSquares
@@ -116,6 +113,9 @@ class PaletteWidget(GraphicsWidget):
 
 
 class PaletteItem(BoardItem):
+
+    square_class = PaletteSquare
+
     def __init__(self):
         super(PaletteItem, self).__init__()
         side = settings.square_size
@@ -0,0 +1,207 @@
+'''
+Copyright Nate Carson 2013
+
+Polyglot opening books. A book is a sorted file of 16 byte big endian
+entries (key, move, weight, learn) where key is the polyglot zobrist key of
+a position. Books are read through mmap and searched in place, so several
+books, or several readers of one book, share the page cache and a lookup
+reads only the entries of its position.
+
+    book = openBook('performance.bin')
+    for move, weight in book.moves(engine):
+        print move, weight
+    move = book.choose(engine)
+
+Polyglot moves are packed like bitboard moves except that castling is the
+king taking its own rook (e1h1). Moves are given back as the king move
+(e1g1) that the engines play.
+'''
+
+import os
+import mmap
+import bisect
+import random
+import struct
+from collections import namedtuple
+
+from game_engine import AlgSquare
+
+
+class BookError(Exception): pass
+
+
+ENTRY = struct.Struct('>QHHI')
+KEY = struct.Struct('>Q')
+
+# polyglot king takes rook castling moves to king moves and back
+# (source, target) squares: e1h1, e1a1, e8h8, e8a8
+CASTLING_TO_KING = {(4, 7): 6, (4, 0): 2, (60, 63): 62, (60, 56): 58}
+CASTLING_TO_ROOK = dict([((source, king), rook) for (source, rook), king in CASTLING_TO_KING.items()])
+
+
+BookEntry = namedtuple('BookEntry', 'move weight learn')
+
+
+class _Keys(object):
+    '''Sequence over the keys of the mapped entries for bisect.'''
+
+    def __init__(self, data, count):
+        self._data, self._count = data, count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        return KEY.unpack_from(self._data, ENTRY.size * i)[0]
+
+
+class PolyglotBook(object):
+    '''Reads a polyglot book through mmap.'''
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size % ENTRY.size:
+            self._file.close()
+            raise BookError('%s is not a polyglot book' % filename)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else ''
+        self._count = size / ENTRY.size
+        self._keys = _Keys(self._map, self._count)
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key):
+        i = bisect.bisect_left(self._keys, key)
+        return i < self._count and self._keys[i] == key
+
+    def entries(self, key):
+        '''Returns the BookEntries of a position key as stored, castling included.'''
+
+        i = bisect.bisect_left(self._keys, key)
+        entries = []
+        unpack, data = ENTRY.unpack_from, self._map
+        while i < self._count:
+            k, move, weight, learn = unpack(data, ENTRY.size * i)
+            if k != key:
+                break
+            entries.append(BookEntry(move, weight, learn))
+            i += 1
+        return entries
+
+    def packedMoves(self, key, isKing):
+        '''
+            Returns (packed move, weight) for a position key with castling as king
+            moves. isKing(square) tells whether a king stands on a square.
+        '''
+
+        moves = []
+        for move, weight, learn in self.entries(key):
+            source, target = move >> 6 & 63, move & 63
+            king = CASTLING_TO_KING.get((source, target))
+            if king is not None and isKing(source):
+                move = move & ~63 | king
+            moves.append((move, weight))
+        return moves
+
+    def moves(self, engine):
+        '''Returns (move, weight) for the engine's position, heaviest first, as the engine's moves.'''
+
+        moves = self.packedMoves(engine.key, _kingTest(engine))
+        moves.sort(key=lambda (move, weight): -weight)
+        return [(engine.toMove(move), weight) for move, weight in moves]
+
+    def choose(self, engine, rand=random):
+        '''Picks one of the book moves of the engine's position by weight or returns None.'''
+        return weightedChoice(self.moves(engine), rand)
+
+
+def _kingTest(engine):
+    '''Returns a function telling whether a king stands on a square of the engine's position.'''
+
+    if engine.isbitboard:
+        position = engine.position
+        return lambda square: position.pieceAt(square) in ('K', 'k')
+    board = engine.toBoardstring()
+    return lambda square: board[AlgSquare.fromIndex(square)] in ('K', 'k')
+
+
+def weightedChoice(moves, rand=random):
+    '''Picks from (move, weight) pairs with chances by weight or returns None.'''
+
+    total = sum([weight for move, weight in moves])
+    if not total:
+        return moves[0][0] if moves else None
+    pick = rand.randint(0, total - 1)
+    for move, weight in moves:
+        if pick < weight:
+            return move
+        pick -= weight
+
+
+# books open in this process, shared by every reader
+_books = {}
+
+def openBook(filename):
+    '''Returns the PolyglotBook for a file, opening it the first time only.'''
+
+    path = os.path.realpath(filename)
+    book = _books.get(path)
+    if book is None:
+        book = _books[path] = PolyglotBook(path)
+    return book
+
+
+class BookSet(object):
+    '''
+        Several books looked up as one. The weights of a move found in more than
+        one book are added together.
+    '''
+
+    def __init__(self, filenames):
+        self.books = [openBook(name) for name in filenames]
+
+    def moves(self, engine):
+
+        key, isKing = engine.key, _kingTest(engine)
+        weights, order = {}, []
+        for book in self.books:
+            for move, weight in book.packedMoves(key, isKing):
+                if move not in weights:
+                    order.append(move)
+                    weights[move] = 0
+                weights[move] += weight
+        order.sort(key=lambda move: -weights[move])
+        return [(engine.toMove(move), weights[move]) for move in order]
+
+    def choose(self, engine, rand=random):
+        return weightedChoice(self.moves(engine), rand)
+
+
+if __name__ == '__main__':
+
+    import time
+    import argparse
+
+    from game_engine import ChessLibGameEngine
+
+    parser = argparse.ArgumentParser(description='show the book moves of a position')
+    parser.add_argument('books', nargs='+', help='polyglot .bin books')
+    parser.add_argument('-f', '--fen', help='position, the start position by default')
+    args = parser.parse_args()
+
+    engine = ChessLibGameEngine('bitboard')
+    engine.newGame(args.fen)
+    books = BookSet(args.books)
+    begin = time.time()
+    moves = books.moves(engine)
+    print '%d moves in %.3fms' % (len(moves), (time.time() - begin) * 1000)
+    for move, weight in moves:
+        print '    %s %d' % (engine.position.san(move.packed), weight)
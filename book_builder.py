@@ -0,0 +1,304 @@
+'''
+Copyright Nate Carson 2013
+
+Builds polyglot opening books (see book) from pgn files, archives or any
+stream of games such as a database query. Games are replayed up to a ply
+limit and the results of every (position key, move) are counted from the
+side to move. The counts are kept in memory up to a batch size and then
+spilled to sorted run files, which are merged into the book at the end, so
+corpora larger than memory can be used. Pgn files and archives are split
+across a process pool.
+
+    buildBook('corpus.cja', 'corpus.bin', processes=8, max_ply=30,
+        weighting=Weighting(min_games=5))
+
+    builder = BookBuilder('db.bin')
+    for game in db.Games.stream():
+        builder.addGame([move.san for move in game.moves()], '*')
+    builder.close()
+'''
+
+import os
+import heapq
+import shutil
+import struct
+import tempfile
+import itertools
+from multiprocessing import Pool
+
+import bitboard
+from bitboard import BitboardPosition
+from game_engine import ChessLibGameEngine
+from archive import Archive
+from pgn import readGames, splitGames
+from book import ENTRY, CASTLING_TO_ROOK
+
+
+class BookBuilderError(Exception): pass
+
+
+# key, move, wins, draws, losses, games
+RUN = struct.Struct('<QH2xIIII')
+
+# points of a result for white, black
+RESULTS = {'1-0': (2, 0), '0-1': (0, 2), '1/2-1/2': (1, 1)}
+
+
+class Weighting(object):
+    '''
+        How the counts of a move become its book weight. By default a win is
+        worth two, a draw one and a loss nothing, as polyglot weights them.
+        With frequency the weight is the number of games. Moves played in
+        fewer than min_games games are left out.
+    '''
+
+    def __init__(self, win=2, draw=1, loss=0, frequency=False, min_games=1):
+        self.win = win
+        self.draw = draw
+        self.loss = loss
+        self.frequency = frequency
+        self.min_games = min_games
+
+    def weight(self, wins, draws, losses, games):
+        if games < self.min_games:
+            return 0
+        if self.frequency:
+            return games
+        return self.win * wins + self.draw * draws + self.loss * losses
+
+
+def _polyglotMove(move, piece):
+    '''Returns a packed move in polyglot form, castling as the king taking its rook.'''
+
+    if piece is not None and piece % 6 == bitboard.KING:
+        rook = CASTLING_TO_ROOK.get((move >> 6 & 63, move & 63))
+        if rook is not None:
+            return move & ~63 | rook
+    return move
+
+
+class _Counts(object):
+    '''Counts of (key, move), spilled to sorted run files of at most batch moves.'''
+
+    def __init__(self, max_ply, batch, directory):
+        self.max_ply = max_ply
+        self.batch = batch
+        self.directory = directory
+        self.runs = []
+        self._counts = {}
+
+    def add(self, key, move, result, white):
+        '''Counts one move made from a position in a game with a result (see RESULTS).'''
+
+        counts = self._counts.get((key, move))
+        if counts is None:
+            counts = self._counts[(key, move)] = [0, 0, 0, 0]
+        points = RESULTS.get(result)
+        if points is not None:
+            # points from the side to move, 2 for a win
+            counts[2 - points[0 if white else 1]] += 1
+        counts[3] += 1
+        if len(self._counts) >= self.batch:
+            self.spill()
+
+    def addLine(self, moves, result, fen=None):
+        '''Counts the packed moves of a game up to the ply limit.'''
+
+        position = BitboardPosition(fen)
+        for move in moves[:self.max_ply]:
+            piece = position.board[move >> 6 & 63]
+            self.add(position.key, _polyglotMove(move, piece), result, position.turn == bitboard.WHITE)
+            position.makeMove(move)
+
+    def addReplay(self, replay, result):
+        '''Counts the moves of a game_engine.Replay.'''
+
+        position = BitboardPosition(replay.start_fen)
+        key, white = position.key, position.turn == bitboard.WHITE
+        for move, piece, after in itertools.izip(replay.packed, replay.piece, replay.keys):
+            self.add(key, _polyglotMove(int(move), int(piece)), result, white)
+            key, white = int(after), not white
+
+    def spill(self):
+
+        if not self._counts:
+            return
+        fd, name = tempfile.mkstemp('.run', 'book', self.directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            pack = RUN.pack
+            f.write(''.join([pack(key, move, *counts) for (key, move), counts in sorted(self._counts.iteritems())]))
+        finally:
+            f.close()
+        self.runs.append(name)
+        self._counts = {}
+
+
+def _readRun(name, block=4096):
+    '''Yields the records of a run file.'''
+
+    f = open(name, 'rb')
+    try:
+        size = RUN.size
+        while True:
+            data = f.read(size * block)
+            if not data:
+                break
+            for offset in xrange(0, len(data), size):
+                yield RUN.unpack_from(data, offset)
+    finally:
+        f.close()
+
+
+def mergeRuns(runs, out, weighting=None):
+    '''Merges sorted run files into a book, returns the number of entries written.'''
+
+    weighting = weighting or Weighting()
+    f = open(out, 'wb')
+    written = 0
+
+    def flush(key, moves):
+        # polyglot gives no more than 16 bits of weight so heavy positions are scaled down
+        moves = [(weighting.weight(*counts), move) for move, counts in moves]
+        moves = [(weight, move) for weight, move in moves if weight > 0]
+        if not moves:
+            return 0
+        top = max([weight for weight, move in moves])
+        scale = 0xffff / float(top) if top > 0xffff else 1
+        moves.sort(reverse=True)
+        f.write(''.join([ENTRY.pack(key, move, max(1, int(weight * scale)), 0) for weight, move in moves]))
+        return len(moves)
+
+    try:
+        key, move, moves, counts = None, None, [], None
+        for k, m, wins, draws, losses, games in heapq.merge(*[_readRun(name) for name in runs]):
+            if k == key and m == move:
+                counts[0] += wins
+                counts[1] += draws
+                counts[2] += losses
+                counts[3] += games
+                continue
+            if k != key:
+                if key is not None:
+                    written += flush(key, moves)
+                key, moves = k, []
+            move, counts = m, [wins, draws, losses, games]
+            moves.append((move, counts))
+        if key is not None:
+            written += flush(key, moves)
+    finally:
+        f.close()
+    return written
+
+
+class BookBuilder(object):
+    '''Builds a book from games given one at a time in this process.'''
+
+    def __init__(self, out, max_ply=40, weighting=None, batch=1 << 20):
+        self.out = out
+        self.weighting = weighting
+        self.directory = tempfile.mkdtemp('', 'book', os.path.dirname(os.path.abspath(out)))
+        self._counts = _Counts(max_ply, batch, self.directory)
+        self.engine = ChessLibGameEngine('bitboard')
+
+    def addLine(self, moves, result='*', fen=None):
+        '''Adds a game from its packed moves.'''
+        self._counts.addLine(moves, result, fen)
+
+    def addGame(self, sans, result='*', fen=None):
+        '''Adds a game from its san, up to its first illegal move.'''
+
+        counts = self._counts
+        replay = self.engine.replay(sans[:counts.max_ply], fen)
+        counts.addReplay(replay, result)
+
+    def close(self):
+        '''Writes the book, returns its number of entries.'''
+
+        try:
+            self._counts.spill()
+            return mergeRuns(self._counts.runs, self.out, self.weighting)
+        finally:
+            shutil.rmtree(self.directory)
+
+
+def _buildPart(args):
+    '''Counts the games of an archive range or a pgn shard into run files.'''
+
+    source, start, end, max_ply, batch, directory = args
+    counts = _Counts(max_ply, batch, directory)
+    if source.endswith('.cja'):
+        archive = Archive(source)
+        try:
+            for n in xrange(start, end):
+                headers = archive.headers(n)
+                counts.addLine(archive.gameLine(n).moves, headers['Result'], headers.get('FEN'))
+        finally:
+            archive.close()
+    else:
+        engine = ChessLibGameEngine('bitboard')
+        for game in readGames(source, start, end):
+            counts.addReplay(engine.replay(game.sans[:max_ply], game.fen), game.result)
+    counts.spill()
+    return counts.runs
+
+
+def buildBook(source, out, processes=1, max_ply=40, weighting=None, batch=1 << 20):
+    '''
+        Builds a book from a pgn file (gzipped when it ends in .gz) or an
+        archive (.cja). Archives are split into game ranges and plain pgn files
+        into shards, counted by a process pool into run files of at most batch
+        moves each. Returns the number of entries written.
+    '''
+
+    jobs = max(1, processes) * 4
+    if source.endswith('.cja'):
+        archive = Archive(source)
+        count = len(archive)
+        archive.close()
+        size = max(1, (count + jobs - 1) / jobs)
+        parts = [(start, min(count, start + size)) for start in xrange(0, count, size)]
+    elif source.endswith('.gz'):
+        parts = [(0, None)]
+    else:
+        size = max(1 << 20, os.path.getsize(source) / jobs)
+        parts = splitGames(source, size)
+
+    directory = tempfile.mkdtemp('', 'book', os.path.dirname(os.path.abspath(out)))
+    try:
+        args = [(source, start, end, max_ply, batch, directory) for start, end in parts]
+        if processes > 1 and len(args) > 1:
+            pool = Pool(min(processes, len(args)))
+            try:
+                results = pool.map(_buildPart, args, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_buildPart, args)
+        return mergeRuns([name for names in results for name in names], out, weighting)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='build a polyglot book from a pgn file or archive')
+    parser.add_argument('source', help='pgn file or archive (.cja)')
+    parser.add_argument('book', help='polyglot .bin book to write')
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('-m', '--max-ply', type=int, default=40)
+    parser.add_argument('--min-games', type=int, default=1, help='leave out moves played in fewer games')
+    parser.add_argument('--frequency', action='store_true', help='weigh moves by games played instead of results')
+    parser.add_argument('--win', type=int, default=2)
+    parser.add_argument('--draw', type=int, default=1)
+    parser.add_argument('--loss', type=int, default=0)
+    args = parser.parse_args()
+
+    begin = time.time()
+    weighting = Weighting(args.win, args.draw, args.loss, args.frequency, args.min_games)
+    count = buildBook(args.source, args.book, args.processes, args.max_ply, weighting)
+    print '%d entries in %.2fs' % (count, time.time() - begin)
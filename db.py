@@ -11,6 +11,9 @@ from game_engine import GameMove, BoardString
 
 class Conn(object):
 
+	# number of server side cursors opened, for their names
+	_cursors = 0
+
 	def __init__(self):
 		self.conn = psycopg2.connect('dbname=' + settings.dbname)
 
@@ -31,6 +34,21 @@ class Conn(object):
 		for row in cursor.fetchall():
 			yield row
 
+	def stream(self, sql, args=None, itersize=2000):
+		'''
+			Yields rows from a server side (named) cursor, fetching itersize rows
+			at a time instead of the whole result.
+		'''
+
+		Conn._cursors += 1
+		cursor = self.conn.cursor('stream%d' % Conn._cursors)
+		cursor.itersize = itersize
+		try:
+			cursor.execute(sql, args)
+			for row in cursor:
+				yield row
+		finally:
+			cursor.close()
 
 
 class Table(object):
@@ -50,6 +68,17 @@ class Table(object):
 			rows.append(cls(row))
 		return rows
 
+	@classmethod
+	def stream(cls, *args):
+		'''Like select but yields the rows as they arrive for results too big for memory.'''
+
+		if Table.conn is None:
+			Table.conn = Conn()
+
+		select = getattr(cls, '_select' + str(len(args)))
+		for row in Table.conn.stream(select, args):
+			yield cls(row)
+
 	
 	def __init__(self, row):
 		
@@ -68,6 +97,21 @@ class Games(Table):
 	def __str__(self):
 		return '%s vs. %s' %(self.white, self.black)
 
+	def headers(self):
+		'''Returns the pgn tags of the game as a dict.'''
+
+		return {
+			'Event': self.event,
+			'Site': self.site,
+			'Date': self.date_ and str(self.date_).replace('-', '.'),
+			'Round': self.round,
+			'White': self.white,
+			'Black': self.black,
+		}
+
+	def moves(self):
+		return Moves.select(self.id)
+
 
 class Moves(Table, GameMove):
 	
@@ -76,11 +120,12 @@ class Moves(Table, GameMove):
 
 	_select1 = 'select * from moves(%s)'
 
-	def __init__(self, row):
-		super(Moves, self).__init__(row)
-		super(GameMove, self).__init__(self.move)
-		self.board_before = BoardString(self.board_before)
-		self.board_after = BoardString(self.board_after)
+	# board strings are only built when asked for instead of two per row
+	def boardBefore(self):
+		return BoardString(self.board_before)
+
+	def boardAfter(self):
+		return BoardString(self.board_after)
 
 	def __repr__(self):
 		return '%s%s %s' % (
@@ -104,6 +149,17 @@ class Opening(Table):
 		return '%s %s %s %s' % (self.eco, self.opening, self.variation, self.moves)
 
 
+def exportGames(writer, *args):
+	'''
+		Writes the games of a query to an export.PgnWriter. The games are read
+		from a server side cursor and only the moves of one game are held at a
+		time.
+	'''
+
+	for game in Games.stream(*args):
+		writer.writeGame(game.moves(), game.headers())
+
+
 class VariationStats(Table):
 	
 	_rows = [ 'white_winr', 'white_loser', 'drawr', 'total', 'wins', 'losses', 'draws', 
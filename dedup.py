@@ -0,0 +1,344 @@
+'''
+Copyright Nate Carson 2013
+
+Finds duplicate games across pgn files and archives. Every game is hashed
+over its packed moves, ply by ply, starting from the key of its start
+position and optionally its headers. The hashes are kept in hash sets on
+disk so corpora larger than memory can be checked, and every duplicate is
+reported with the source and game number of the game it repeats.
+
+    dedup = Dedup('seen')
+    for number, game in enumerate(readGames('merged.pgn')):
+        duplicate = dedup.checkGame(game, 'merged.pgn', number)
+        if duplicate:
+            print duplicate
+
+A game is an exact duplicate when it has the same moves as a game seen
+before, a prefix duplicate when its moves are the start of a longer game
+seen before and it extends a game when a game seen before is the start of
+it. Nothing is dropped from the game seen before, so when writing out the
+games that are not duplicates a game extending another is written as well
+and both are kept.
+'''
+
+import os
+import mmap
+import zlib
+import struct
+
+from bitboard import BitboardPosition
+from game_engine import ChessLibGameEngine
+
+
+class DedupError(Exception): pass
+
+
+FNV_OFFSET = 0xcbf29ce484222325
+FNV_PRIME = 0x100000001b3
+MASK = 0xFFFFFFFFFFFFFFFF
+
+# headers mixed into the hash when they are used
+HEADERS = ('White', 'Black', 'Date', 'Round')
+
+
+def moveHashes(moves, seed):
+    '''Returns the rolling hash after every move (fnv-1a over the packed moves).'''
+
+    hashes = []
+    h = seed
+    for move in moves:
+        h = ((h ^ int(move)) * FNV_PRIME) & MASK
+        hashes.append(h)
+    return hashes
+
+
+def gameSeed(start_fen=None, headers=None):
+    '''Hash of a game before its first move, from its start position and headers.'''
+
+    seed = FNV_OFFSET ^ BitboardPosition(start_fen).key
+    if headers is not None:
+        text = '\0'.join([str(headers.get(name, '')) for name in HEADERS])
+        seed ^= zlib.crc32(text) & 0xffffffff
+        seed = (seed * FNV_PRIME) & MASK
+    return seed
+
+
+class DiskHashSet(object):
+    '''
+        Open addressing hash table of 64 bit hashes to 64 bit values in a memory
+        mapped file. It doubles its file when half full. Hash 0 marks an empty
+        slot so it is stored as 1.
+    '''
+
+    MAGIC = 'CJHS'
+    # magic, slots, used
+    HEADER = struct.Struct('<4sxxxxQQ')
+    SLOT = struct.Struct('<QQ')
+
+    def __init__(self, filename, slots=1 << 16):
+
+        self.filename = filename
+        if not os.path.exists(filename):
+            self._create(filename, slots)
+        self._open()
+
+    def _create(self, filename, slots):
+        f = open(filename, 'wb')
+        try:
+            f.write(self.HEADER.pack(self.MAGIC, slots, 0))
+            f.truncate(self.HEADER.size + slots * self.SLOT.size)
+        finally:
+            f.close()
+
+    def _open(self):
+
+        self._file = open(self.filename, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, self._slots, self._used = self.HEADER.unpack_from(self._map)
+        if magic != self.MAGIC:
+            raise DedupError('%s is not a hash set' % self.filename)
+
+    def close(self):
+
+        if self._map is None:
+            return
+        self.HEADER.pack_into(self._map, 0, self.MAGIC, self._slots, self._used)
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+        self._map = None
+
+    def __len__(self):
+        return self._used
+
+    def _find(self, h):
+        '''Returns (slot offset, value or None) of a hash.'''
+
+        mask = self._slots - 1
+        slot = h & mask
+        data, unpack = self._map, self.SLOT.unpack_from
+        while True:
+            offset = self.HEADER.size + slot * self.SLOT.size
+            stored, value = unpack(data, offset)
+            if stored == h:
+                return offset, value
+            if not stored:
+                return offset, None
+            slot = (slot + 1) & mask
+
+    def get(self, h):
+        return self._find(h or 1)[1]
+
+    def __contains__(self, h):
+        return self.get(h) is not None
+
+    def add(self, h, value):
+        '''Stores a value for a hash unless it is already there, returns the stored value or None.'''
+
+        h = h or 1
+        offset, stored = self._find(h)
+        if stored is not None:
+            return stored
+        self.SLOT.pack_into(self._map, offset, h, value)
+        self._used += 1
+        if self._used * 2 > self._slots:
+            self._grow()
+        return None
+
+    def _grow(self):
+
+        old_map, old_file, old_slots = self._map, self._file, self._slots
+        temp = self.filename + '.grow'
+        self._create(temp, old_slots * 2)
+        self._file = open(temp, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._slots, self._used = old_slots * 2, 0
+
+        for slot in xrange(old_slots):
+            h, value = self.SLOT.unpack_from(old_map, self.HEADER.size + slot * self.SLOT.size)
+            if h:
+                offset = self._find(h)[0]
+                self.SLOT.pack_into(self._map, offset, h, value)
+                self._used += 1
+
+        old_map.close()
+        old_file.close()
+        self.close()
+        os.rename(temp, self.filename)
+        self._open()
+
+
+class Duplicate(object):
+    '''A game found to repeat one seen before.'''
+
+    EXACT, PREFIX, EXTENDS = 'exact', 'prefix', 'extends'
+
+    def __init__(self, kind, source, number, original_source, original_number):
+        self.kind = kind
+        self.source = source
+        self.number = number
+        self.original_source = original_source
+        self.original_number = original_number
+
+    def __str__(self):
+        what = {
+            self.EXACT: 'repeats',
+            self.PREFIX: 'is the start of',
+            self.EXTENDS: 'extends',
+        }[self.kind]
+        return '%s game %d %s %s game %d' % (
+            self.source, self.number, what, self.original_source, self.original_number)
+
+
+class Dedup(object):
+    '''
+        Hash sets of the games seen so far, kept in a directory so they can be
+        added to over several runs. Games shorter than min_plies are not
+        checked as prefixes of other games.
+    '''
+
+    def __init__(self, directory, use_headers=False, min_plies=10):
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.use_headers = use_headers
+        self.min_plies = min_plies
+        self.engine = ChessLibGameEngine('bitboard')
+
+        # whole games and the starts of games
+        self.games = DiskHashSet(os.path.join(directory, 'games.hs'))
+        self.prefixes = DiskHashSet(os.path.join(directory, 'prefixes.hs'))
+
+        self._sources_name = os.path.join(directory, 'sources')
+        self.sources = []
+        if os.path.exists(self._sources_name):
+            self.sources = open(self._sources_name).read().splitlines()
+        self._source_ids = dict([(name, idx) for idx, name in enumerate(self.sources)])
+
+    def close(self):
+        self.games.close()
+        self.prefixes.close()
+
+    def _sourceId(self, source):
+
+        sid = self._source_ids.get(source)
+        if sid is None:
+            sid = self._source_ids[source] = len(self.sources)
+            self.sources.append(source)
+            f = open(self._sources_name, 'a')
+            try:
+                f.write(source + '\n')
+            finally:
+                f.close()
+        return sid
+
+    def _duplicate(self, kind, source, number, value):
+        return Duplicate(kind, source, number, self.sources[value >> 32], value & 0xffffffff)
+
+    def check(self, moves, source, number, start_fen=None, headers=None):
+        '''
+            Checks the packed moves of game number of a source. Returns a Duplicate
+            or None for a new game. New games and games extending another are
+            remembered.
+        '''
+
+        seed = gameSeed(start_fen, headers if self.use_headers else None)
+        hashes = moveHashes(moves, seed) or [seed]
+        full = hashes[-1]
+        value = self._sourceId(source) << 32 | number
+
+        seen = self.games.get(full)
+        if seen is not None:
+            return self._duplicate(Duplicate.EXACT, source, number, seen)
+        seen = self.prefixes.get(full)
+        if seen is not None:
+            return self._duplicate(Duplicate.PREFIX, source, number, seen)
+
+        duplicate = None
+        for h in hashes[self.min_plies - 1:-1]:
+            seen = self.games.get(h)
+            if seen is not None:
+                duplicate = self._duplicate(Duplicate.EXTENDS, source, number, seen)
+                break
+
+        self.games.add(full, value)
+        for h in hashes[self.min_plies - 1:-1]:
+            self.prefixes.add(h, value)
+        return duplicate
+
+    def checkGame(self, game, source, number):
+        '''Checks a pgn.PgnGame, replaying it with the engine unless its moves are packed.'''
+
+        moves = game.packed
+        if moves is None:
+            replay = self.engine.replay(game.sans, game.fen)
+            if replay.illegal is not None:
+                raise DedupError('illegal move %s at ply %d of %s' % (
+                    game.sans[replay.illegal], replay.illegal, game))
+            moves = game.packed = replay.packed
+        return self.check(moves, source, number, game.fen, game.headers)
+
+
+if __name__ == '__main__':
+
+    import sys
+    import time
+    import shutil
+    import argparse
+    import tempfile
+
+    from pgn import readGames
+    from archive import Archive, ArchiveWriter
+
+    parser = argparse.ArgumentParser(description='find duplicate games in pgn files and archives')
+    parser.add_argument('sources', nargs='+', help='pgn files or archives (.cja)')
+    parser.add_argument('-d', '--directory', help='keep the hash sets here to check later sources against')
+    parser.add_argument('--headers', action='store_true', help='only games with the same players, date and round are duplicates')
+    parser.add_argument('-o', '--out', help='archive to write the games that are not duplicates to')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only print the counts')
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp()
+    dedup = Dedup(directory, args.headers)
+    writer = args.out and ArchiveWriter(args.out)
+    counts = {}
+    begin = time.time()
+
+    try:
+        for source in args.sources:
+            if source.endswith('.cja'):
+                archive = Archive(source)
+                games = ((archive.gameLine(n), archive.headers(n)) for n in xrange(len(archive)))
+            else:
+                games = ((game, game.headers) for game in readGames(source))
+
+            for number, (game, headers) in enumerate(games):
+                try:
+                    if source.endswith('.cja'):
+                        duplicate = dedup.check(game.moves, source, number, headers.get('FEN'), headers)
+                    else:
+                        duplicate = dedup.checkGame(game, source, number)
+                except DedupError, e:
+                    print >> sys.stderr, '%s game %d: %s' % (source, number, e)
+                    continue
+
+                kind = duplicate and duplicate.kind
+                counts[kind] = counts.get(kind, 0) + 1
+                if duplicate and not args.quiet:
+                    print duplicate
+                if writer and kind in (None, Duplicate.EXTENDS):
+                    if source.endswith('.cja'):
+                        writer.addLine(game, headers)
+                    else:
+                        writer.addGame(game)
+    finally:
+        dedup.close()
+        if writer:
+            writer.close()
+        if not args.directory:
+            shutil.rmtree(directory)
+
+    print '%d new, %d exact, %d prefix, %d extending in %.2fs' % (counts.get(None, 0),
+        counts.get(Duplicate.EXACT, 0), counts.get(Duplicate.PREFIX, 0), counts.get(Duplicate.EXTENDS, 0),
+        time.time() - begin)
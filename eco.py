@@ -0,0 +1,367 @@
+'''
+Copyright Nate Carson 2013
+
+ECO classification of games without the database. The lines of an ECO table
+are loaded into a trie of packed moves and a cursor walks the trie as the
+moves of a game are made, one dict lookup a ply, keeping the deepest line
+reached. A position key map lets a game that left the trie by a move order
+of its own rejoin it on a transposition.
+
+    classifier = EcoClassifier.load('eco.pgn')
+    cursor = classifier.cursor()
+    for move in game_moves:
+        eco = cursor.advance(move)
+    print eco.eco, eco.opening, eco.variation
+
+    # a whole archive at once
+    for game, (eco, ply) in enumerate(classifyArchive('eco.pgn', 'corpus.cja', processes=8)):
+        ...
+
+ECO tables are read from pgn files with ECO, Opening and Variation tags (as
+scid's eco.pgn) or from tab separated files of eco, name and movetext (as
+the lichess openings), where the name is split into opening and variation at
+its first colon.
+'''
+
+import gzip
+import itertools
+from array import array
+from collections import namedtuple
+from multiprocessing import Pool
+
+import bitboard
+from bitboard import BitboardPosition
+from pgn import readGames, parseMovetext
+from archive import Archive
+
+
+class EcoError(Exception): pass
+
+
+Eco = namedtuple('Eco', 'eco opening variation plies')
+
+ROOT = 0
+
+
+def _packedOf(move):
+    '''Returns the packed move of a packed move, bitboard move or game move.'''
+
+    if isinstance(move, (int, long)):
+        return move
+    packed = getattr(move, 'packed', None)
+    if packed is not None:
+        return packed
+    promotion = 0
+    if '=' in move.san:
+        promotion = ' NBRQ'.index(move.san[move.san.index('=') + 1])
+    return bitboard.packMove(
+        bitboard.SQUARE_INDEX[move.source.name], bitboard.SQUARE_INDEX[move.target.name], promotion)
+
+
+class EcoClassifier(object):
+    '''
+        Trie of ECO lines. Nodes are numbered from the root (0), edges are a
+        dict from node << 16 | packed move to the child node and every node
+        keeps the deepest entry on the way to it.
+    '''
+
+    def __init__(self):
+
+        self.entries = []
+        self._edges = {}
+        self._children = [[]]
+        # entry number of the deepest line at or above every node, -1 for none
+        self._best = array('i', [-1])
+        # position key -> node, the first node reaching a position
+        self._positions = {BitboardPosition().key: ROOT}
+        self.max_plies = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def load(cls, filename):
+        '''Loads an ECO table from a pgn or tab separated file.'''
+
+        classifier = cls()
+        if filename.endswith('.tsv') or filename.endswith('.tsv.gz'):
+            f = gzip.open(filename) if filename.endswith('.gz') else open(filename)
+            try:
+                for line in f:
+                    fields = line.rstrip('\r\n').split('\t')
+                    if len(fields) < 3 or fields[0] == 'eco':
+                        continue
+                    opening, _, variation = fields[1].partition(':')
+                    classifier.add(fields[0], opening.strip(), variation.strip(), parseMovetext(fields[2])[0])
+            finally:
+                f.close()
+        else:
+            for game in readGames(filename):
+                headers = game.headers
+                variation = ', '.join([headers[tag] for tag in ('Variation', 'SubVariation') if headers.get(tag)])
+                classifier.add(headers.get('ECO', ''), headers.get('Opening', ''), variation, game.sans)
+        return classifier
+
+    @classmethod
+    def fromRows(cls, rows):
+        '''Builds a classifier from db.Opening rows, whose moves are san separated by spaces.'''
+
+        classifier = cls()
+        for row in rows:
+            variation = ', '.join([part for part in (row.variation, row.subvar) if part])
+            classifier.add(row.eco, row.opening, variation, parseMovetext(row.moves)[0])
+        return classifier
+
+    def add(self, eco, opening, variation, sans):
+        '''Adds a line from the start position, returns its entry number.'''
+
+        position = BitboardPosition()
+        node = ROOT
+        for san in sans:
+            try:
+                move = position.parseSan(san)
+            except bitboard.MoveError:
+                raise EcoError('illegal move %s in %s %s' % (san, eco, opening))
+            position.makeMove(move)
+            edge = node << 16 | move
+            child = self._edges.get(edge)
+            if child is None:
+                child = self._edges[edge] = len(self._children)
+                self._children.append([])
+                self._children[node].append(move)
+                self._best.append(self._best[node])
+                self._positions.setdefault(position.key, child)
+            node = child
+
+        number = len(self.entries)
+        self.entries.append(Eco(eco, opening, variation, len(sans)))
+        self.max_plies = max(self.max_plies, len(sans))
+        self._mark(node, number)
+        return number
+
+    def _mark(self, node, number):
+        '''Makes an entry the deepest of a node and of the nodes below it that had a shallower one.'''
+
+        previous = self._best[node]
+        if previous != -1 and self.entries[previous].plies >= self.entries[number].plies:
+            return
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            self._best[node] = number
+            for move in self._children[node]:
+                child = self._edges[node << 16 | move]
+                if self._best[child] == previous:
+                    stack.append(child)
+
+    def best(self, node):
+        '''Returns the entry number of a node, -1 for none.'''
+        return self._best[node] if node is not None else -1
+
+    def entry(self, node):
+        '''Returns the Eco of a node or None.'''
+
+        best = self.best(node)
+        return self.entries[best] if best != -1 else None
+
+    def child(self, node, move):
+        return self._edges.get(node << 16 | move)
+
+    def node(self, key):
+        '''Returns the node reaching a position key or None.'''
+        return self._positions.get(key)
+
+    def continuations(self, node):
+        '''Returns (packed move, Eco) of the moves out of a node.'''
+
+        return [(move, self.entry(self._edges[node << 16 | move])) for move in self._children[node]]
+
+    def cursor(self, fen=None):
+        return EcoCursor(self, fen)
+
+    def classifyLine(self, moves, fen=None):
+        '''Returns (Eco or None, ply it was reached at) for the packed moves of a game.'''
+
+        number, ply = self._classify(moves, fen)
+        return (self.entries[number] if number != -1 else None), ply
+
+    def _classify(self, moves, fen):
+
+        cursor = EcoCursor(self, fen)
+        position = None
+        for move in moves[:self.max_plies]:
+            key = None
+            node = cursor.node
+            if node is None or self.child(node, move) is None:
+                # off the trie, keys are only needed to find a transposition
+                if position is None:
+                    position = BitboardPosition(fen)
+                    for before in moves[:cursor.ply]:
+                        position.makeMove(before)
+                position.makeMove(move)
+                key = position.key
+            elif position is not None:
+                position.makeMove(move)
+            cursor.advance(move, key)
+        return cursor.number, cursor.eco_ply
+
+
+class EcoCursor(object):
+    '''
+        Position in the trie of a game being played. advance() takes each move
+        made and returns the deepest Eco so far. Moves can be taken back with
+        goBack().
+    '''
+
+    def __init__(self, classifier, fen=None):
+
+        self.classifier = classifier
+        start = ROOT
+        if fen and str(fen) != BitboardPosition.START_FEN:
+            start = classifier.node(BitboardPosition(str(fen)).key)
+        # (node, entry number, ply it was reached at) after every move
+        self._states = [(start, classifier.best(start), 0)]
+
+    @property
+    def ply(self):
+        return len(self._states) - 1
+
+    @property
+    def node(self):
+        return self._states[-1][0]
+
+    @property
+    def number(self):
+        return self._states[-1][1]
+
+    @property
+    def eco(self):
+        number = self._states[-1][1]
+        return self.classifier.entries[number] if number != -1 else None
+
+    @property
+    def eco_ply(self):
+        return self._states[-1][2]
+
+    def advance(self, move, key=None):
+        '''
+            Makes a packed move or game move and returns the deepest Eco so far.
+            key is the position key after the move, game moves carry their own.
+            It is only looked at to rejoin the trie after leaving it.
+        '''
+
+        node, number, eco_ply = self._states[-1]
+        classifier = self.classifier
+        if node is not None:
+            node = classifier.child(node, _packedOf(move))
+        if node is None:
+            if key is None:
+                key = getattr(move, 'key', None)
+            if key is not None:
+                node = classifier.node(key)
+
+        # a transposition back into the trie may reach a shorter line than the one found
+        found = classifier.best(node)
+        if found != -1 and found != number and (
+                number == -1 or classifier.entries[found].plies >= classifier.entries[number].plies):
+            number, eco_ply = found, len(self._states)
+        self._states.append((node, number, eco_ply))
+        return self.eco
+
+    def goBack(self, ply):
+        '''Takes back the moves after a ply.'''
+        del self._states[ply + 1:]
+
+    def continuations(self):
+        '''Returns (packed move, Eco) of the book moves from here.'''
+
+        node = self.node
+        return [] if node is None else self.classifier.continuations(node)
+
+
+_classifier = None
+
+def _loadClassifier(eco_filename):
+    global _classifier
+    _classifier = EcoClassifier.load(eco_filename)
+
+
+def _classifyRange(args):
+
+    archive_name, start, end = args
+    archive = Archive(archive_name)
+    try:
+        results = []
+        for n in xrange(start, end):
+            line = archive.gameLine(n)
+            results.append(_classifier._classify(line.moves, line.start_fen))
+        return results
+    finally:
+        archive.close()
+
+
+def classifyArchive(eco_filename, archive_name, processes=1, size=4096):
+    '''
+        Yields (Eco or None, ply) for every game of an archive in order. The
+        games are classified in ranges of size by a process pool that loads the
+        ECO table once a worker.
+    '''
+
+    archive = Archive(archive_name)
+    count = len(archive)
+    archive.close()
+    ranges = [(archive_name, start, min(count, start + size)) for start in xrange(0, count, size)]
+
+    _loadClassifier(eco_filename)
+    entries = _classifier.entries
+    if processes > 1:
+        pool = Pool(processes, _loadClassifier, (eco_filename,))
+        results = pool.imap(_classifyRange, ranges)
+    else:
+        pool = None
+        results = itertools.imap(_classifyRange, ranges)
+
+    try:
+        for part in results:
+            for number, ply in part:
+                yield (entries[number] if number != -1 else None), ply
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+if __name__ == '__main__':
+
+    import sys
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='classify games by an ECO table')
+    parser.add_argument('eco', help='ECO table, pgn or tab separated')
+    parser.add_argument('-a', '--archive', help='archive to classify')
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('-m', '--moves', help='san moves to classify, such as "e4 c5 Nf3"')
+    args = parser.parse_args()
+
+    begin = time.time()
+    classifier = EcoClassifier.load(args.eco)
+    print '%d lines, %d nodes in %.2fs' % (len(classifier), len(classifier._children), time.time() - begin)
+
+    if args.moves:
+        cursor = classifier.cursor()
+        position = BitboardPosition()
+        for san in args.moves.split():
+            move = position.parseSan(san)
+            position.makeMove(move)
+            print '%-8s %s' % (san, cursor.advance(move, position.key))
+
+    if args.archive:
+        begin = time.time()
+        counts = {}
+        for eco, ply in classifyArchive(args.eco, args.archive, args.processes):
+            code = eco and eco.eco
+            counts[code] = counts.get(code, 0) + 1
+        print 'classified in %.2fs' % (time.time() - begin)
+        for code in sorted(counts, key=lambda code: -counts[code])[:20]:
+            print '    %s %d' % (code, counts[code])
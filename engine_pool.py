@@ -0,0 +1,386 @@
+'''
+Copyright Nate Carson 2013
+
+Pool of uci engine processes for analysing many positions at once. Every
+engine process is served by a thread that takes positions from a shared job
+queue, so as many positions are analysed at a time as there are engines.
+Each position handed to the pool gives back an Analysis, a future that
+holds the AnalysisResult once an engine is done with it.
+
+    pool = EnginePool('/usr/games/stockfish', size=32)
+    analyses = [pool.submit(fen, depth=18) for fen in fens]
+    for analysis in analyses:
+        print analysis.result().score
+
+    results = pool.map(fens, movetime=500)
+    pool.close()
+
+It runs without Qt, uci_engine.QtEnginePool gives the results as Qt signals.
+'''
+
+import time
+import Queue
+import threading
+import subprocess
+from multiprocessing import cpu_count
+
+
+class EnginePoolError(Exception): pass
+
+
+def parseInfo(line):
+    '''
+        Returns a dict of the fields of a uci info line. score is given in
+        centipawns and mate in moves, pv is a list of uci moves.
+    '''
+
+    tokens = line.split()
+    info = {}
+    i = 1
+    while i < len(tokens):
+        token = tokens[i]
+        if token == 'score' and i + 2 < len(tokens):
+            info[tokens[i + 1]] = int(tokens[i + 2])
+            i += 3
+            # lowerbound or upperbound
+            while i < len(tokens) and tokens[i].endswith('bound'):
+                info[tokens[i]] = True
+                i += 1
+        elif token in ('pv', 'refutation', 'currline'):
+            info[token] = tokens[i + 1:]
+            break
+        elif token == 'string':
+            info[token] = ' '.join(tokens[i + 1:])
+            break
+        elif i + 1 < len(tokens):
+            value = tokens[i + 1]
+            info[token] = int(value) if value.lstrip('-').isdigit() else value
+            i += 2
+        else:
+            i += 1
+    return info
+
+
+class AnalysisResult(object):
+    '''What an engine found for a position: its best move and the last info line it gave.'''
+
+    def __init__(self, fen, bestmove, ponder, info, elapsed):
+        self.fen = fen
+        self.bestmove = bestmove
+        self.ponder = ponder
+        self.depth = info.get('depth')
+        self.score = info.get('cp')
+        self.mate = info.get('mate')
+        self.nodes = info.get('nodes')
+        self.pv = info.get('pv', [])
+        self.info = info
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        score = 'mate %s' % self.mate if self.mate is not None else 'cp %s' % self.score
+        return '<AnalysisResult %s depth %s %s>' % (self.bestmove, self.depth, score)
+
+
+class Analysis(object):
+    '''
+        Future of the analysis of a position. result() waits for it and raises
+        the error the engine ran into, callbacks added are called with the
+        Analysis from the engine's thread once it is done.
+    '''
+
+    def __init__(self, fen, moves, limits):
+        self.fen = fen
+        self.moves = moves
+        self.limits = limits
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._error = None
+        self._cancelled = False
+        self._started = False
+
+    def done(self):
+        return self._done.is_set()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        '''Cancels the analysis unless an engine has started on it.'''
+
+        with self._lock:
+            if self._started or self.done():
+                return False
+            self._cancelled = True
+        self._finish(None, EnginePoolError('analysis cancelled'))
+        return True
+
+    def _start(self):
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._started = True
+            return True
+
+    def _finish(self, result, error=None):
+
+        with self._lock:
+            self._result, self._error = result, error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def addDoneCallback(self, callback):
+        '''Calls callback(analysis) when done, at once if it already is.'''
+
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout=None):
+
+        if not self._done.wait(timeout):
+            raise EnginePoolError('analysis of %s timed out' % self.fen)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def error(self, timeout=None):
+        self._done.wait(timeout)
+        return self._error
+
+
+class UciProcess(object):
+    '''A uci engine process driven with blocking reads and writes.'''
+
+    timeout = 10
+
+    def __init__(self, path, options=None):
+
+        self.path = path
+        try:
+            self._process = subprocess.Popen([path], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, bufsize=1, universal_newlines=True)
+        except OSError, e:
+            raise EnginePoolError('could not start engine %s: %s' % (path, e))
+
+        self.send('uci')
+        self.name = None
+        for line in self._until('uciok'):
+            if line.startswith('id name '):
+                self.name = line[8:]
+        for name, value in sorted((options or {}).items()):
+            self.send('setoption name %s value %s' % (name, value))
+        self.ready()
+
+    def send(self, command):
+        try:
+            self._process.stdin.write(command + '\n')
+            self._process.stdin.flush()
+        except IOError, e:
+            raise EnginePoolError('engine %s stopped: %s' % (self.path, e))
+
+    def _until(self, token):
+        '''Yields the lines the engine writes up to and including the line starting with token.'''
+
+        while True:
+            line = self._process.stdout.readline()
+            if not line:
+                raise EnginePoolError('engine %s stopped' % self.path)
+            line = line.strip()
+            yield line
+            if line.startswith(token):
+                return
+
+    def ready(self):
+        self.send('isready')
+        for line in self._until('readyok'):
+            pass
+
+    def analyze(self, fen, moves=(), **limits):
+        '''
+            Analyses a fen ('startpos' for the start position) after uci moves and
+            returns an AnalysisResult. limits are the go arguments such as
+            depth=18, movetime=500 or nodes=10**6.
+        '''
+
+        begin = time.time()
+        position = 'startpos' if fen in (None, 'startpos') else 'fen ' + str(fen)
+        if moves:
+            position += ' moves ' + ' '.join(moves)
+        self.send('position ' + position)
+        self.send(' '.join(['go'] + ['%s %s' % item for item in sorted(limits.items())]))
+
+        info = {}
+        for line in self._until('bestmove'):
+            # the deepest info line with a score of the main line
+            if line.startswith('info') and ' score ' in line:
+                parsed = parseInfo(line)
+                if parsed.get('multipv', 1) == 1:
+                    info = parsed
+        parts = line.split()
+        bestmove = parts[1] if len(parts) > 1 else None
+        ponder = parts[3] if len(parts) > 3 and parts[2] == 'ponder' else None
+        return AnalysisResult(fen, bestmove, ponder, info, time.time() - begin)
+
+    def isAlive(self):
+        return self._process.poll() is None
+
+    def quit(self):
+
+        if self.isAlive():
+            try:
+                self.send('quit')
+            except EnginePoolError:
+                pass
+            deadline = time.time() + self.timeout
+            while self.isAlive() and time.time() < deadline:
+                time.sleep(.01)
+            if self.isAlive():
+                self._process.kill()
+        self._process.wait()
+
+
+class EnginePool(object):
+    '''
+        size engine processes started from the same path, one thread each,
+        sharing a queue of positions. options are uci options set on every
+        engine, Threads defaults to 1 so that size engines use size cores.
+    '''
+
+    def __init__(self, path, size=None, options=None):
+
+        self.path = path
+        self.size = size or cpu_count()
+        self.options = dict(options or {})
+        self.options.setdefault('Threads', 1)
+        self._jobs = Queue.Queue()
+        self._closed = False
+
+        self.engines = []
+        try:
+            for n in xrange(self.size):
+                self.engines.append(UciProcess(path, self.options))
+        except EnginePoolError:
+            for engine in self.engines:
+                engine.quit()
+            raise
+
+        self._threads = []
+        for n in xrange(self.size):
+            thread = threading.Thread(target=self._work, args=(n,), name='engine %d' % n)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    def pending(self):
+        '''Number of positions waiting for an engine.'''
+        return self._jobs.qsize()
+
+    def submit(self, fen, moves=(), **limits):
+        '''Queues a position for analysis, see UciProcess.analyze, and returns its Analysis.'''
+
+        if self._closed:
+            raise EnginePoolError('engine pool is closed')
+        if not limits:
+            # a bare go searches until stopped and would hold its engine forever
+            raise EnginePoolError('analysis needs a limit such as depth, movetime or nodes')
+        analysis = Analysis(fen, tuple(moves), limits)
+        self._jobs.put(analysis)
+        return analysis
+
+    def map(self, fens, **limits):
+        '''Analyses fens and returns their AnalysisResults in order.'''
+
+        analyses = [self.submit(fen, **limits) for fen in fens]
+        return [analysis.result() for analysis in analyses]
+
+    def _work(self, n):
+
+        while True:
+            analysis = self._jobs.get()
+            if analysis is None:
+                return
+            if not analysis._start():
+                continue
+
+            try:
+                engine = self.engines[n]
+                if engine is None:
+                    engine = self.engines[n] = UciProcess(self.path, self.options)
+                result = engine.analyze(analysis.fen, analysis.moves, **analysis.limits)
+            except EnginePoolError, e:
+                # the process may not be reaped yet, so it is stopped here and
+                # the next position starts a new one instead of trusting poll()
+                if self.engines[n] is not None:
+                    self.engines[n].quit()
+                    self.engines[n] = None
+                analysis._finish(None, e)
+            except Exception, e:
+                analysis._finish(None, e)
+            else:
+                analysis._finish(result)
+
+    def close(self, cancel=False):
+        '''Stops the engines once the queued positions are done, or drops them with cancel.'''
+
+        if self._closed:
+            return
+        self._closed = True
+        if cancel:
+            while True:
+                try:
+                    analysis = self._jobs.get_nowait()
+                except Queue.Empty:
+                    break
+                analysis.cancel()
+        for thread in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        for engine in self.engines:
+            if engine is not None:
+                engine.quit()
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    from bitboard import BitboardPosition
+    from pgn import readGames
+
+    parser = argparse.ArgumentParser(description='analyse every position of pgn games with a pool of uci engines')
+    parser.add_argument('engine', help='path of the uci engine')
+    parser.add_argument('pgn')
+    parser.add_argument('-n', '--engines', type=int, default=cpu_count())
+    parser.add_argument('-d', '--depth', type=int, default=12)
+    args = parser.parse_args()
+
+    fens = []
+    for game in readGames(args.pgn):
+        position = BitboardPosition(game.fen)
+        fens.append(position.toFen())
+        for move in game.gameLine().moves:
+            position.makeMove(move)
+            fens.append(position.toFen())
+
+    begin = time.time()
+    pool = EnginePool(args.engine, args.engines)
+    try:
+        results = pool.map(fens, depth=args.depth)
+    finally:
+        pool.close()
+    elapsed = time.time() - begin
+    print '%d positions with %d engines in %.2fs, %.1f positions/s' % (
+        len(results), args.engines, elapsed, len(results) / (elapsed or 1e-9))
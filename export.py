@@ -0,0 +1,310 @@
+'''
+Copyright Nate Carson 2013
+
+Streaming export of games to pgn and of positions to epd. Text is gathered
+in a buffer and written in large blocks, through gzip or zstd when asked
+for, so writing a large query result costs one write call per block rather
+than one per game.
+
+    writer = PgnWriter('out.pgn.gz')
+    writer.writeGame(moves, {'White': 'Tal', 'Black': 'Botvinnik'})
+    for game in readGames('games.pgn'):
+        writer.writePgnGame(game)
+    writer.close()
+
+    epd = EpdWriter('positions.epd')
+    epd.writePosition(fen, id='test 1', bm='Nf3')
+    epd.close()
+
+Compression follows the file name (.gz, .zst) unless it is given. zstd
+needs the zstandard module.
+'''
+
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from bitboard import BitboardPosition
+from game_engine import GameLine
+
+
+class ExportError(Exception): pass
+
+
+# the seven tag roster, written first and in this order
+ROSTER = ('Event', 'Site', 'Date', 'Round', 'White', 'Black', 'Result')
+ROSTER_DEFAULTS = {'Event': '?', 'Site': '?', 'Date': '????.??.??', 'Round': '?',
+    'White': '?', 'Black': '?', 'Result': '*'}
+LINE_WIDTH = 79
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def openOutput(filename, compression=None, mode='wb'):
+    '''Opens a file for writing, compressed by gzip or zstd.'''
+
+    if compression is None:
+        if filename.endswith('.gz'):
+            compression = 'gzip'
+        elif filename.endswith('.zst'):
+            compression = 'zstd'
+
+    if compression is None:
+        return open(filename, mode)
+    if compression == 'gzip':
+        return gzip.open(filename, mode)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ExportError('zstd compression needs the zstandard module')
+        return zstandard.ZstdCompressor().stream_writer(open(filename, mode))
+    raise ExportError('unknown compression %s' % compression)
+
+
+class _BufferedWriter(object):
+    '''Collects text and writes it to a file or file name in blocks of buffer_size.'''
+
+    def __init__(self, output, compression=None, buffer_size=1 << 20):
+
+        if isinstance(output, basestring):
+            self._file = openOutput(output, compression)
+            self._owned = True
+        else:
+            self._file = output
+            self._owned = False
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        self._count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    def __len__(self):
+        '''Number of games or positions written.'''
+        return self._count
+
+    def _write(self, text):
+
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+
+        if self._buffer:
+            self._file.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+
+        if self._file is None:
+            return
+        self.flush()
+        if self._owned:
+            self._file.close()
+        self._file = None
+
+
+def _tag(name, value):
+    value = _text(value).replace('\\', '\\\\').replace('"', '\\"')
+    return '[%s "%s"]\n' % (name, value)
+
+
+def _isInitial(move):
+    # the engine's initial move holds the start position and has no source square
+    try:
+        return move.source is None
+    except AttributeError:
+        return False
+
+
+def _fenStart(fen):
+    '''Returns (move number, white to move) of a fen.'''
+
+    fields = fen.split()
+    movenum = int(fields[5]) if len(fields) == 6 else 1
+    return movenum, fields[1] != 'b'
+
+
+class PgnWriter(_BufferedWriter):
+    '''
+        Writes games as pgn. Games are given as a sequence of game moves (see
+        GameMove, for instance MovePagingList.gameMoves() or db.Moves rows), a
+        GameLine, a pgn.PgnGame or a list of san.
+    '''
+
+    def writeSans(self, sans, headers=None, result=None, fen=None, start=None):
+        '''
+            Writes a game from its san, headers and start fen. start is the move
+            number and whether white moves first for games without a fen.
+        '''
+
+        headers = dict(headers or {})
+        result = headers.get('Result') or result or '*'
+        headers['Result'] = result
+        fen = fen or headers.get('FEN')
+        if fen and str(fen) != BitboardPosition.START_FEN:
+            headers['FEN'] = str(fen)
+            headers['SetUp'] = '1'
+            movenum, iswhite = _fenStart(str(fen))
+        else:
+            headers.pop('FEN', None)
+            headers.pop('SetUp', None)
+            movenum, iswhite = start or (1, True)
+        self._write(self._game(sans, headers, result, movenum, iswhite))
+
+    def _game(self, sans, headers, result, movenum, iswhite):
+
+        lines = [_tag(name, headers.get(name) or ROSTER_DEFAULTS[name]) for name in ROSTER]
+        lines.extend([_tag(name, value) for name, value in sorted(headers.items())
+            if name not in ROSTER_DEFAULTS and value is not None])
+        lines.append('\n')
+
+        tokens = []
+        if not iswhite and sans:
+            tokens.append('%d...' % movenum)
+        for san in sans:
+            if iswhite:
+                tokens.append('%d.' % movenum)
+            tokens.append(san)
+            if not iswhite:
+                movenum += 1
+            iswhite = not iswhite
+        tokens.append(result)
+
+        line, width = [], 0
+        for token in tokens:
+            if width and width + 1 + len(token) > LINE_WIDTH:
+                lines.append(' '.join(line) + '\n')
+                line, width = [], 0
+            width += len(token) + bool(line)
+            line.append(token)
+        lines.append(' '.join(line) + '\n\n')
+
+        self._count += 1
+        return ''.join(lines)
+
+    def writeGame(self, moves, headers=None, result=None):
+        '''Writes a sequence of game moves or a GameLine.'''
+
+        if isinstance(moves, GameLine):
+            return self.writeSans([move.san for move in moves], headers, result, moves.start_fen)
+
+        moves = list(moves)
+        fen = start = None
+        if moves and _isInitial(moves[0]):
+            fen = moves.pop(0).fen_after
+        elif moves:
+            # database rows have board strings instead of fens
+            fen = getattr(moves[0], 'fen_before', None)
+            start = moves[0].movenum, bool(moves[0].iswhite)
+        self.writeSans([move.san for move in moves], headers, result, fen, start)
+
+    def writePgnGame(self, game):
+        self.writeSans(game.sans, game.headers, game.result, game.fen)
+
+
+class EpdWriter(_BufferedWriter):
+    '''
+        Writes positions as epd, the first four fields of their fen followed by
+        operations such as id "name"; or bm Nf3;.
+    '''
+
+    # opcodes whose operand is a quoted string
+    QUOTED = frozenset(['id'] + ['c%d' % n for n in range(10)])
+
+    def writePosition(self, fen, operations=None, **kwargs):
+        '''
+            Writes a position. Operations are given as a list of (opcode, value)
+            pairs, a dict or keywords. The operands of id and the comments c0 to
+            c9 are quoted, lists and tuples are written space separated and other
+            values as they are.
+        '''
+
+        fields = str(fen).split()
+        if len(fields) < 4:
+            raise ExportError('bad fen %s' % fen)
+        parts = [' '.join(fields[:4])]
+
+        if isinstance(operations, dict):
+            operations = sorted(operations.items())
+        for opcode, value in list(operations or ()) + sorted(kwargs.items()):
+            if opcode in self.QUOTED:
+                parts.append('%s "%s";' % (opcode, _text(value).replace('"', '')))
+            elif isinstance(value, (list, tuple)):
+                parts.append('%s %s;' % (opcode, ' '.join([_text(v) for v in value])))
+            elif value is None:
+                parts.append('%s;' % opcode)
+            else:
+                parts.append('%s %s;' % (opcode, value))
+        self._count += 1
+        self._write(' '.join(parts) + '\n')
+
+    def writePositions(self, positions):
+        '''Writes fens or (fen, operations) pairs.'''
+
+        for position in positions:
+            if isinstance(position, basestring):
+                self.writePosition(position)
+            else:
+                self.writePosition(*position)
+
+    def writeGame(self, moves, name=None):
+        '''
+            Writes the position after every move of a sequence of game moves or a
+            GameLine, with the game name and ply as the id.
+        '''
+
+        for move in moves:
+            if name is None:
+                self.writePosition(move.fen_after)
+            else:
+                self.writePosition(move.fen_after, id='%s ply %d' % (name, move.halfmove))
+
+
+if __name__ == '__main__':
+
+    import time
+    import argparse
+
+    from pgn import readGames
+    from archive import Archive
+
+    parser = argparse.ArgumentParser(description='export games to pgn or their positions to epd')
+    parser.add_argument('source', help='pgn file or archive (.cja)')
+    parser.add_argument('out', help='pgn or epd file, compressed when it ends in .gz or .zst')
+    parser.add_argument('-e', '--epd', action='store_true', help='write the positions of the games as epd')
+    args = parser.parse_args()
+
+    begin = time.time()
+    writer = EpdWriter(args.out) if args.epd else PgnWriter(args.out)
+    try:
+        if args.source.endswith('.cja'):
+            archive = Archive(args.source)
+            for n in xrange(len(archive)):
+                line = archive.gameLine(n)
+                if args.epd:
+                    writer.writeGame(line, str(n))
+                else:
+                    writer.writeGame(line, archive.headers(n))
+        else:
+            for n, game in enumerate(readGames(args.source)):
+                if args.epd:
+                    writer.writeGame(game.gameLine(), str(n))
+                else:
+                    writer.writePgnGame(game)
+    finally:
+        writer.close()
+    print '%d written in %.2fs' % (len(writer), time.time() - begin)
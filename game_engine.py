@@ -3,83 +3,136 @@ Copyright Nate Carson 2012
 
 '''
 
+import re
+import numbers
+from array import array
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from util import tr
 
 #FIXME
 import sys
 sys.path.append('../python-chess/')
 
-from chess import Position, Move, MoveError, SanNotation
+try:
+    from chess import Position, Move, MoveError, SanNotation
+except ImportError:
+    # the bitboard backend runs without python-chess
+    Position = SanNotation = None
+    from bitboard import Move, MoveError
+
+import bitboard
+from bitboard import BitboardPosition
+
+
+class LRUCache(object):
+    '''
+        Bounded mapping that drops the least recently used entry once full and
+        counts hits and misses.
+    '''
+
+    def __init__(self, size=50000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        items = self._items
+        items.pop(key, None)
+        items[key] = value
+        if len(items) > self.size:
+            items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+        self.hits = self.misses = 0
+
+    def __str__(self):
+        total = self.hits + self.misses
+        return '%d entries, %d hits, %d misses (%.1f%%)' % (
+            len(self._items), self.hits, self.misses, 100.0 * self.hits / total if total else 0)
 
 
 class BoardString(object):
+    '''
+        64 character board, a8 first, h1 last. Squares are kept in a bytearray so
+        writes do not copy the board and the fen is only rebuilt after a write.
+    '''
     
     EMPTY_SQUARE = '.'
     FEN_SEP = '/'
 
+    # fen digits to runs of empty squares
+    _expand = dict(zip('12345678', [EMPTY_SQUARE * n for n in range(1, 9)]))
+    _empties = re.compile(re.escape(EMPTY_SQUARE) + '+')
+
     def __init__(self, board=tr('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR')):
 
-        cls = self.__class__
-        self.string = (str(board).split()[0].replace('/','').
-                replace('8', cls.EMPTY_SQUARE * 8).
-                replace('7', cls.EMPTY_SQUARE * 7).
-                replace('6', cls.EMPTY_SQUARE * 6).
-                replace('5', cls.EMPTY_SQUARE * 5).
-                replace('4', cls.EMPTY_SQUARE * 4).
-                replace('3', cls.EMPTY_SQUARE * 3).
-                replace('2', cls.EMPTY_SQUARE * 2).
-                replace('1', cls.EMPTY_SQUARE * 1)
-        )
+        board = str(board).split()[0]
+        # already a board string
+        if len(board) == 64 and self.FEN_SEP not in board:
+            self._squares = bytearray(board)
+        else:
+            expand = self._expand
+            self._squares = bytearray(''.join([expand.get(c, c) for c in board if c != self.FEN_SEP]))
+        self._fen = None
+
+    @property
+    def string(self):
+        return str(self._squares)
     
     def __str__(self):
-        return self.string  
+        return str(self._squares)
 
     def __iter__(self):
-        return self.string.__iter__()
+        return iter(str(self._squares))
     
     def _getIdx(self, algsquare):
         return ((8 - algsquare.y) * 8) + algsquare.x - 1
     
     def __getitem__(self, algsquare):
-        
-        idx = self._getIdx(algsquare)
-        return self.string[idx]
+        return chr(self._squares[self._getIdx(algsquare)])
     
     def __setitem__(self, algsquare, value):
-        idx = self._getIdx(algsquare)
-        l = list(self.string)
-        l[idx] = value
-        self.string = ''.join(l)
+        self._squares[self._getIdx(algsquare)] = ord(value)
+        self._fen = None
 
     def makeMove(self, ssquare, esquare, promotion=''):
         if not promotion:
             self[esquare] = self[ssquare]
         else:
-            self[move.esquare] = promotion
+            self[esquare] = promotion
         self[ssquare] = self.__class__.EMPTY_SQUARE
     
     def isEmpty(self, algsquare):
         return self[algsquare] == self.__class__.EMPTY_SQUARE 
 
     def toFen(self):
-        
-        fen = ''
-        for y in xrange(8):
-            empties = 0
-            for x in xrange(8):
-                char = self.string[y * 8 + x]
-                if char == self.EMPTY_SQUARE:
-                    empties += 1
-                else:
-                    if empties:
-                        fen += str(empties)
-                        empties = 0
-                    fen += char
-            if empties:
-                fen += str(empties)
-            if y != 7:
-                fen += self.FEN_SEP
-        return fen
+
+        if self._fen is None:
+            string = str(self._squares)
+            sub, empties = self._empties.sub, lambda m: str(len(m.group()))
+            self._fen = self.FEN_SEP.join([sub(empties, string[y:y + 8]) for y in xrange(0, 64, 8)])
+        return self._fen
 
 
 class Piece(object):
@@ -90,57 +143,97 @@ class Piece(object):
 
     PAWN, BISHOP, KNIGHT, ROOK, QUEEN, KING = range(6)
 
+    # piece symbol -> color, class and svg file name
+    #FIXME if pieces were translated this will break the svg file naming convention
+    _white = dict([(p, idx < 6) for idx, p in enumerate(pieces)])
+    _classes = dict([(p, idx % 6) for idx, p in enumerate(pieces)])
+    _svg = dict([(p, ('w' if idx < 6 else 'b') + p.lower()) for idx, p in enumerate(pieces)])
+
     @staticmethod
     def toSVGFont(piece):
-        #FIXME if pieces were translated this will break the svg file naming convention
-        
-        if Piece.isWhite(piece):
-            color = 'w' 
-        else:
-            color = 'b'
-        return color + piece.lower() 
+        try:
+            return Piece._svg[piece]
+        except KeyError:
+            raise ValueError(piece)
             
     @staticmethod
     def isWhite(piece):
-        return list(Piece.pieces).index(piece) < 6  
+        try:
+            return Piece._white[piece]
+        except KeyError:
+            raise ValueError(piece)
 
     @staticmethod
     def toPieceClass(piece):
-        #see if it pops
-        list(Piece.pieces).index(piece)
-        return list(Piece.pieces[6:]).index(piece)
+        try:
+            return Piece._classes[piece]
+        except KeyError:
+            raise ValueError(piece)
 
 
                 
 
 class AlgSquare(object):
-    
+    '''
+        Board square. Squares are interned: AlgSquare('e4') always returns the
+        same object and there are lookups by (x, y) and by index (a1 = 0, h8 = 63).
+    '''
+
+    __slots__ = ('x', 'y', 'label', 'index')
+
     files = tr('abcdefgh')
     ranks = tr('12345678')
 
-    def __init__(self, label):
-        
-        if len(label) != 2:
+    def __new__(cls, label):
+        try:
+            return cls._labels[label]
+        except (KeyError, TypeError):
             raise ValueError(label)
 
-        cls = self.__class__
+    @classmethod
+    def _intern(cls, labels):
 
-        self.x = cls.files.index(label[0]) + 1
-        self.y = cls.ranks.index(label[1]) + 1
-        self.label = label
+        cls._labels = {}
+        cls._coords = {}
+        cls._squares = []
+        for label in labels:
+            square = object.__new__(cls)
+            square.x = cls.files.index(label[0]) + 1
+            square.y = cls.ranks.index(label[1]) + 1
+            square.label = label
+            square.index = len(cls._squares)
+            cls._labels[label] = square
+            cls._coords[(square.x, square.y)] = square
+            cls._squares.append(square)
+        # in generate order
+        cls._generated = tuple(sorted(cls._squares, key=lambda s: (s.x, s.y)))
+
+    @classmethod
+    def at(cls, x, y):
+        '''Returns the square at (x, y), 1 based, or raises KeyError.'''
+        return cls._coords[(x, y)]
+
+    @classmethod
+    def fromIndex(cls, index):
+        return cls._squares[index]
+
+    def __reduce__(self):
+        return (self.__class__, (self.label,))
     
     def isPalette(self):
         return False
     
     def __str__(self):
         return self.label
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.label)
     
     @classmethod
     def generate(cls):
-        
-        for x in range(8):
-            for y in range(8):
-                yield cls(cls.files[x] + cls.ranks[y])
+        return iter(cls._generated)
+
+AlgSquare._intern([f + r for r in AlgSquare.ranks for f in AlgSquare.files])
 
 
 
@@ -148,17 +241,15 @@ class PaletteSquare(AlgSquare):
 #XXX this really belongs with board.py but its nice
 #    to have it next to the orignal definition.
 
+    __slots__ = ()
+
     files = AlgSquare.files + 'ij'
 
     def isPalette(self):
         return True
 
-    @classmethod
-    def generate(cls):
-        
-        for x in range(8, 10):
-            for y in range(6):
-                yield cls(cls.files[x] + cls.ranks[y])
+# indexed in Piece.pieces order, white on the i file and black on the j file
+PaletteSquare._intern([f + r for f in 'ij' for r in PaletteSquare.ranks[:6]])
 
 
 
@@ -179,22 +270,10 @@ class PaletteSquare(AlgSquare):
 
 
 
-class GameMove(object):
-    
-    
-    def __init__(self, san, movenum, iswhite, before, after, source, target, captured, piece):
-        
-        self.san = san
-        self.movenum = movenum
-        self.iswhite = iswhite
-        self.fen_before = before
-        self.fen_after = after
-        self.source = source
-        self.target = target
-        self.captured = captured
-        self.piece = piece
+class AbstractGameMove(object):
+    '''Behaviour shared by stored and packed game moves.'''
 
-        self.is_start_pos = False
+    __slots__ = ()
 
     @property
     def halfmove(self):
@@ -225,9 +304,355 @@ class GameMove(object):
         return self.movenum == other.movenum and self.iswhite == other.iswhite
 
 
+class GameMove(AbstractGameMove):
+
+    __slots__ = (
+        'san', 'movenum', 'iswhite', 'fen_before', 'fen_after',
+        'source', 'target', 'captured', 'piece', 'key', 'is_start_pos', 'repetitions',
+    )
+    
+    def __init__(self, san, movenum, iswhite, before, after, source, target, captured, piece, key=None):
+        
+        self.san = san
+        self.movenum = movenum
+        self.iswhite = iswhite
+        self.fen_before = before
+        self.fen_after = after
+        self.source = source
+        self.target = target
+        self.captured = captured
+        self.piece = piece
+        # polyglot zobrist key of the position after the move
+        self.key = key
+
+        self.is_start_pos = False
+        # times the position after the move has been reached in the game
+        self.repetitions = 1
+
+
+class GameLine(object):
+    '''
+        The moves of one game packed into 16 bits each (see bitboard.packMove).
+        Keys and pieces, fens and san are only worked out by replaying the game
+        the first time one of them is asked for, fens and san each only when
+        asked for as they are the slow ones, and each position is shared by the
+        move before and the move after it. release() drops them again.
+    '''
+
+    def __init__(self, moves=(), fen=None):
+
+        self.start_fen = str(fen or BitboardPosition.START_FEN)
+        self.moves = array('H', moves)
+
+        fields = self.start_fen.split()
+        full_move = int(fields[5]) if len(fields) == 6 else 1
+        self._start_ply = (full_move - 1) * 2 + int(fields[1] == 'b')
+        self.release()
+
+    @classmethod
+    def fromSan(cls, sans, fen=None):
+        position = BitboardPosition(fen)
+        moves = []
+        for san in sans:
+            move = position.parseSan(san)
+            position.makeMove(move)
+            moves.append(move)
+        return cls(moves, fen)
+
+    def __len__(self):
+        return len(self.moves)
+
+    def __getitem__(self, ply):
+        if ply < 0:
+            ply += len(self.moves)
+        if not 0 <= ply < len(self.moves):
+            raise IndexError(ply)
+        return PackedGameMove(self, ply)
+
+    def __iter__(self):
+        for ply in xrange(len(self.moves)):
+            yield PackedGameMove(self, ply)
+
+    def append(self, move):
+        self.moves.append(move)
+        self.release()
+
+    def release(self):
+        '''Forget the replayed positions.'''
+        self._fens = self._sans = self._keys = self._pieces = self._captured = None
+
+    def _replay(self, fens=False, sans=False):
+        '''Replays the game for keys and pieces and, when asked for and not known yet, fens or san.'''
+
+        fens = fens and self._fens is None
+        sans = sans and self._sans is None
+        if not fens and not sans and self._keys is not None:
+            return
+
+        position = BitboardPosition(self.start_fen)
+        keys, pieces, captured = [position.key], [], []
+        fen_list = [position.toFen()] if fens else None
+        san_list = [] if sans else None
+        for move in self.moves:
+            # the moves are known to be legal so san needs no legal move table
+            if sans:
+                san_list.append(position.legalSan(move))
+            pieces.append(position.pieceAt(move >> 6 & 63))
+            captured.append(position.pieceAt(move & 63))
+            position.makeMove(move)
+            if fens:
+                fen_list.append(position.toFen())
+            keys.append(position.key)
+
+        self._keys, self._pieces, self._captured = keys, pieces, captured
+        if fens:
+            self._fens = fen_list
+        if sans:
+            self._sans = san_list
+
+    def fen(self, ply):
+        '''Fen after ply moves.'''
+        self._replay(fens=True)
+        return self._fens[ply]
+
+    def key(self, ply):
+        self._replay()
+        return self._keys[ply]
+
+    def san(self, ply):
+        self._replay(sans=True)
+        return self._sans[ply]
+
+    def piece(self, ply):
+        self._replay()
+        return self._pieces[ply]
+
+    def captured(self, ply):
+        self._replay()
+        return self._captured[ply]
+
+    def halfmove(self, ply):
+        '''Halfmove counted from the first move of a game starting at 0.'''
+        return self._start_ply + ply
+
+
+class PackedGameMove(AbstractGameMove):
+    '''Game move that is only a game line and a ply.'''
+
+    __slots__ = ('line', 'ply')
+
+    is_start_pos = False
+
+    def __init__(self, line, ply):
+        self.line = line
+        self.ply = ply
+
+    @property
+    def packed(self):
+        return self.line.moves[self.ply]
+
+    @property
+    def movenum(self):
+        return self.line.halfmove(self.ply) // 2 + 1
+
+    @property
+    def iswhite(self):
+        return self.line.halfmove(self.ply) % 2 == 0
+
+    @property
+    def san(self):
+        return self.line.san(self.ply)
+
+    @property
+    def fen_before(self):
+        return self.line.fen(self.ply)
+
+    @property
+    def fen_after(self):
+        return self.line.fen(self.ply + 1)
+
+    @property
+    def key(self):
+        return self.line.key(self.ply + 1)
+
+    @property
+    def source(self):
+        return bitboard.SQUARES[self.packed >> 6 & 63]
+
+    @property
+    def target(self):
+        return bitboard.SQUARES[self.packed & 63]
+
+    @property
+    def piece(self):
+        return self.line.piece(self.ply)
+
+    @property
+    def captured(self):
+        return self.line.captured(self.ply)
+
+
+class Replay(object):
+    '''
+        Result of replaying a list of san moves. Every field has one entry per ply
+        that was played: source, target and promotion (piece kind, 0 for none) of
+        the move, piece moved and piece captured as bitboard piece codes (-1 for
+        none), the key of the position after the move and its material signature
+        (see bitboard.materialSignature). These are numpy arrays or, without
+        numpy, array module arrays. start_material is the signature before the
+        first move.
+
+        illegal is the ply of the first move that could not be played, with error
+        its MoveError, or None when the whole list was played.
+    '''
+
+    _types = (
+        ('source', 'B', 'uint8'),
+        ('target', 'B', 'uint8'),
+        ('promotion', 'B', 'uint8'),
+        ('piece', 'b', 'int8'),
+        ('captured', 'b', 'int8'),
+        ('keys', 'L', 'uint64'),
+        ('material', 'L', 'uint64'),
+    )
+
+    def __init__(self, columns, start_fen, start_material, illegal=None, error=None):
+
+        for (name, code, dtype), values in zip(self._types, columns):
+            if numpy is not None:
+                values = numpy.array(values, dtype=dtype)
+            else:
+                values = array(code, values)
+            setattr(self, name, values)
+        self.start_fen = start_fen
+        self.start_material = start_material
+        self.illegal = illegal
+        self.error = error
+
+    def __len__(self):
+        return len(self.source)
+
+    @property
+    def packed(self):
+        '''Packed moves, target | source << 6 | promotion << 12.'''
+        if numpy is not None:
+            return self.target.astype('uint16') | self.source.astype('uint16') << 6 | \
+                self.promotion.astype('uint16') << 12
+        return array('H', [t | s << 6 | p << 12 for s, t, p in zip(self.source, self.target, self.promotion)])
+
+
+class RepetitionTracker(object):
+    '''
+        Repetition counts and fifty move clock of the positions of a game, kept
+        as moves are made and taken back in constant time a move. Every
+        position remembers the last ply its key was seen at before it, and
+        positions from before the last capture or pawn move, which the clock
+        reaches back to, cannot come again.
+    '''
+
+    # fifty moves without a capture or pawn move for each side
+    FIFTY_MOVES = 100
+    THREEFOLD, FIFTY = 'threefold repetition', 'fifty moves'
+
+    def __init__(self, key, clock=0):
+
+        self._keys = [key]
+        self._clocks = [clock]
+        self._counts = [1]
+        self._previous = [None]
+        # key -> last ply seen
+        self._last = {key: 0}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def push(self, key, clock):
+        '''Adds the position after a move with its halfmove clock, returns its repetition count.'''
+
+        ply = len(self._keys)
+        seen = self._last.get(key)
+        if seen is not None and ply - seen <= clock:
+            count = self._counts[seen] + 1
+        else:
+            count = 1
+        self._keys.append(key)
+        self._clocks.append(clock)
+        self._counts.append(count)
+        self._previous.append(seen)
+        self._last[key] = ply
+        return count
+
+    def pop(self):
+        '''Takes back the last position.'''
+
+        key, seen = self._keys.pop(), self._previous.pop()
+        self._clocks.pop()
+        self._counts.pop()
+        if seen is None:
+            del self._last[key]
+        else:
+            self._last[key] = seen
+
+    @property
+    def repetitions(self):
+        '''Times the current position has been reached.'''
+        return self._counts[-1]
+
+    @property
+    def clock(self):
+        return self._clocks[-1]
+
+    def claim(self):
+        '''Returns the draw that can be claimed in the current position or None.'''
+
+        if self._counts[-1] >= 3:
+            return self.THREEFOLD
+        if self._clocks[-1] >= self.FIFTY_MOVES:
+            return self.FIFTY
+        return None
+
+
+def firstDrawClaim(moves, fen=None):
+    '''
+        Returns (ply, reason) of the first position of a game's packed moves
+        where a draw could be claimed, or (None, None).
+    '''
+
+    position = BitboardPosition(fen and str(fen))
+    tracker = RepetitionTracker(position.key, position.halfmove_clock)
+    claim = tracker.claim()
+    if claim:
+        return 0, claim
+    for ply, move in enumerate(moves):
+        position.makeMove(int(move))
+        tracker.push(position.key, position.halfmove_clock)
+        claim = tracker.claim()
+        if claim:
+            return ply + 1, claim
+    return None, None
+
+
 class ChessLibGameEngine(object):
+    '''
+        Game engine that runs on either the python-chess Position ('chess')
+        or the native BitboardPosition ('bitboard') backend.
+    '''
+
+    backends = ('chess', 'bitboard')
+
+    # shared by every engine as openings repeat across games
+    # (position key, packed move) -> san
+    san_cache = LRUCache()
+    # (position key, san) -> packed move
+    move_cache = LRUCache()
     
-    def __init__(self):
+    def __init__(self, backend=None):
+
+        if backend is None:
+            backend = 'chess' if Position else 'bitboard'
+        if backend not in self.backends or (backend == 'chess' and not Position):
+            raise ValueError(backend)
+        self.backend = backend
 
         self.castles = {
             ('K', 'e1', 'g1'): Move.from_uci('h1f1'),
@@ -243,10 +668,31 @@ class ChessLibGameEngine(object):
             ('k', 'c8', 'e8'): Move.from_uci('d8a8'),
         }
         self.position = None
+        # BitboardPosition kept in step with the position for its incremental key
+        # and clock, the position itself on the bitboard backend
+        self._board = None
         self._start_name = None
+        # (fen, legal moves) for the python-chess backend
+        self._legal = (None, None)
+        # [game move, move, undo] for every move made since the new game
+        self._history = []
+        self._ply = 0
+        # repetitions and fifty move clock of the positions up to the current ply
+        self._repetitions = None
+
+    @property
+    def isbitboard(self):
+        return self.backend == 'bitboard'
+
+    @property
+    def key(self):
+        '''Polyglot zobrist key of the current position.'''
+        return self._board and self._board.key
 
     @property
     def fen(self):
+        if self.isbitboard:
+            return self.position and self.position.toFen()
         return self.position and str(self.position.fen)
         
 
@@ -254,26 +700,83 @@ class ChessLibGameEngine(object):
 
         #if we have a boardstring
         if fen:
-            turn = self.position.fen.turn 
-            self.position = Position(fen)
+            if self.isbitboard:
+                self.position = BitboardPosition(str(fen))
+            else:
+                self.position = Position(fen)
             self._start_name = "Custom"
         # else let it set to the default position
         else:
-            self.position = Position()
+            if self.isbitboard:
+                self.position = BitboardPosition()
+            else:
+                self.position = Position()
             self._start_name = "Start"
+        self._board = self.position if self.isbitboard else BitboardPosition(fen and str(fen))
+
+        self._history = []
+        self._ply = 0
+        self._repetitions = RepetitionTracker(self.key, self.halfmoveClock)
+
+    def _toPacked(self, move):
+        '''Returns the packed bitboard move for a packed, bitboard or python-chess move.'''
+
+        # numpy integers of archive and replay arrays are registered as Integral
+        if isinstance(move, numbers.Integral):
+            return int(move)
+        if isinstance(move, bitboard.Move):
+            return move.packed
+        uci = move.source.name + move.target.name
+        if getattr(move, 'promotion', None):
+            uci += str(move.promotion)[-1].lower()
+        return bitboard.uciToMove(uci)
+
+    def _makeBitboardMove(self, move):
+
+        position = self.position
+        packed = self._toPacked(move)
+        source, target = packed >> 6 & 63, packed & 63
+        san = self._san(position.key, packed)
+        piece = position.pieceAt(source)
+        captured = position.pieceAt(target)
+        movenum = position.full_move
+        iswhite = position.turn == bitboard.WHITE
+        before = position.toFen()
+        undo = position.makeMove(packed)
+        after = position.toFen()
+
+        game_move = GameMove(
+            san,
+            movenum,
+            iswhite,
+            before,
+            after,
+            bitboard.SQUARES[source],
+            bitboard.SQUARES[target],
+            captured,
+            piece,
+            position.key
+        )
+        self._push(game_move, packed, undo)
+        return game_move
 
     def makeMove(self, move):
-        san = SanNotation(self.position, move)
+        if self.isbitboard:
+            return self._makeBitboardMove(move)
+
+        before = self.fen
+        packed = self._toPacked(move)
+        san = self._san(self._board.key, packed, move)
         piece = self.position[move.source]
         captured = self.position[move.target]
         movenum = self.position.fen.full_move
         iswhite = self.position.fen.turn == 'w'
-        before = self.fen
         self.position.make_move(move)
+        undo = self._board.makeMove(packed)
         after = self.fen
 
         game_move = GameMove(
-            str(san),
+            san,
             movenum,
             iswhite, 
             before, 
@@ -281,22 +784,235 @@ class ChessLibGameEngine(object):
             move.source,
             move.target,
             captured,
-            piece
+            piece,
+            self._board.key
         )
+        self._push(game_move, move, undo)
         return game_move
 
+    def makePackedMove(self, packed):
+        '''Makes a move packed as target | source << 6 | promotion << 12.'''
+
+        if self.isbitboard:
+            return self._makeBitboardMove(packed)
+        return self.makeMove(Move.from_uci(bitboard.moveToUci(int(packed))))
+
+    def _push(self, game_move, move, undo):
+        # making a move after going back drops the moves that were taken back
+        del self._history[self._ply:]
+        self._history.append([game_move, move, undo])
+        self._ply += 1
+        game_move.repetitions = self._repetitions.push(game_move.key, self.halfmoveClock)
+
+    @property
+    def halfmoveClock(self):
+        '''Plies since the last capture or pawn move.'''
+        return self._board.halfmove_clock
+
+    @property
+    def repetitions(self):
+        '''Times the current position has been reached since the new game.'''
+        return self._repetitions.repetitions
+
+    def drawClaim(self):
+        '''Returns the draw that can be claimed, threefold repetition or fifty moves, or None.'''
+        return self._repetitions.claim()
+
+    @property
+    def ply(self):
+        '''Number of moves played since the new game.'''
+        return self._ply
+
+    @property
+    def plies(self):
+        '''Number of moves that can be played forward to, including those taken back.'''
+        return len(self._history)
+
+    def goBack(self, plies=1):
+        '''
+            Takes back up to plies moves and returns their game moves, last move first.
+            The bitboard position unmakes each move from its undo state, python-chess
+            has no unmake so it is reset to the fen before the last move taken back.
+        '''
+
+        taken = []
+        while plies > 0 and self._ply > 0:
+            self._ply -= 1
+            game_move, move, undo = self._history[self._ply]
+            self._board.unmakeMove(undo)
+            self._repetitions.pop()
+            taken.append(game_move)
+            plies -= 1
+
+        if taken and not self.isbitboard:
+            self.position = Position(taken[-1].fen_before)
+        return taken
+
+    def goForward(self, plies=1):
+        '''Replays up to plies moves that were taken back and returns their game moves.'''
+
+        made = []
+        while plies > 0 and self._ply < len(self._history):
+            entry = self._history[self._ply]
+            if self.isbitboard:
+                entry[2] = self.position.makeMove(entry[1])
+            else:
+                self.position.make_move(entry[1])
+                entry[2] = self._board.makeMove(self._toPacked(entry[1]))
+            self._ply += 1
+            self._repetitions.push(entry[0].key, self.halfmoveClock)
+            made.append(entry[0])
+            plies -= 1
+        return made
+
+    def gameLine(self):
+        '''Returns the moves made since the new game as a packed GameLine.'''
+
+        start = self._history[0][0].fen_before if self._history else self.fen
+        return GameLine([self._toPacked(move) for game_move, move, undo in self._history], start)
+
+    def goTo(self, ply):
+        '''Goes back or forward to a ply and returns the game moves taken back or replayed.'''
+
+        if ply < self._ply:
+            return self.goBack(self._ply - ply)
+        return self.goForward(ply - self._ply)
+
     def makeMoveFromSan(self, san):
-        move = SanNotation.to_move(self.position, san)
-        return self.makeMove(move)
+        return self.makeMove(self.sanToMove(san))
+
+    def _san(self, key, packed, move=None):
+        '''Returns the san of a move from the cache or the position.'''
+
+        san = self.san_cache.get((key, packed))
+        if san is None:
+            if self.isbitboard:
+                san = self.position.san(packed)
+            else:
+                san = str(SanNotation(self.position, move))
+            self.san_cache.put((key, packed), san)
+        return san
 
     def sanToMove(self, san):
-        return SanNotation.to_move(self.position, san)
+
+        key = self.key
+        packed = self.move_cache.get((key, san))
+        if packed is None:
+            if self.isbitboard:
+                packed = self.position.parseSan(san)
+            else:
+                packed = self._toPacked(SanNotation.to_move(self.position, san))
+            self.move_cache.put((key, san), packed)
+        return self.toMove(packed)
+
+    def toMove(self, packed):
+        '''Returns the backend's move for a packed move.'''
+
+        packed = int(packed)
+        if self.isbitboard:
+            return bitboard.Move(packed)
+        return Move.from_uci(bitboard.moveToUci(packed))
+
+    def replay(self, sans, fen=None, packed=False):
+        '''
+            Validates and plays a list of san moves from a fen, or the current
+            position, and returns a Replay. The moves are played on a scratch
+            bitboard position whatever the backend, so the engine's own position
+            and move history are left alone. A move that cannot be played ends
+            the replay instead of raising. With packed the list holds packed
+            moves already known to be legal, such as those of an archive, and
+            they are played without being checked.
+        '''
+
+        if fen:
+            position = BitboardPosition(str(fen))
+        elif self.position is None:
+            position = BitboardPosition()
+        elif self.isbitboard:
+            position = self.position.copy()
+        else:
+            position = BitboardPosition(self.fen)
+        start_fen = position.toFen()
+
+        sources, targets, promotions, pieces, captures, keys, materials = columns = [], [], [], [], [], [], []
+        board = position.board
+        move_cache = self.move_cache
+        shifts = bitboard.MATERIAL_SHIFTS
+        material = start_material = bitboard.materialSignature(position)
+        illegal = error = None
+
+        for ply, san in enumerate(sans):
+            if packed:
+                move = int(san)
+            else:
+                key = position.key
+                move = move_cache.get((key, san))
+            if move is None:
+                try:
+                    move = position.parseSan(san)
+                except bitboard.MoveError as e:
+                    illegal, error = ply, e
+                    break
+                move_cache.put((key, san), move)
+
+            source, target = move >> 6 & 63, move & 63
+            piece, captured = board[source], board[target]
+            # en passant
+            if captured == bitboard.EMPTY and piece % 6 == bitboard.PAWN and (source ^ target) & 7:
+                captured = piece + 6 if piece < 6 else piece - 6
+            position.makeMove(move)
+
+            # material only changes on captures and promotions
+            if captured != bitboard.EMPTY:
+                material -= 1 << shifts[captured]
+            promotion = move >> 12 & 7
+            if promotion:
+                material += (1 << shifts[piece - bitboard.PAWN + promotion]) - (1 << shifts[piece])
+
+            sources.append(source)
+            targets.append(target)
+            promotions.append(promotion)
+            pieces.append(piece)
+            captures.append(captured)
+            keys.append(position.key)
+            materials.append(material)
+
+        return Replay(columns, start_fen, start_material, illegal, error)
+
+    def _legalKey(self, move):
+        promotion = getattr(move, 'promotion', None)
+        return (move.source.name, move.target.name, promotion and str(promotion)[-1].lower())
+
+    def _legalTable(self):
+        '''Returns the legal moves of the python-chess position keyed by (source, target, promotion).'''
+
+        fen = self.fen
+        if self._legal[0] != fen:
+            moves = self.position.get_legal_moves()
+            self._legal = (fen, dict([(self._legalKey(m), m) for m in moves]))
+        return self._legal[1]
 
     def validateMove(self, move):
-        for m in self.position.get_legal_moves():
-            if m == move:
-                return True
-        return False
+        if self.isbitboard:
+            try:
+                return self.position.isLegal(self._toPacked(move))
+            except MoveError:
+                return False
+        return self._legalKey(move) in self._legalTable()
+
+    def legalMoves(self):
+        if self.isbitboard:
+            return [bitboard.Move(m) for m in self.position.legalMoves()]
+        return self._legalTable().values()
+
+    def legalTargets(self, square):
+        '''Returns the names of the squares the piece on a square can move to.'''
+
+        name = str(square)
+        if self.isbitboard:
+            moves = self.position.movesFrom(bitboard.SQUARE_INDEX[name])
+            return sorted(set([bitboard.SQUARE_NAMES[m & 63] for m in moves]))
+        return sorted(set([target for source, target, promotion in self._legalTable() if source == name]))
 
     def castleRookMove(self, move):
         '''Returns the corresponding rook move if a given move is a castling one.'''
@@ -309,22 +1025,30 @@ class ChessLibGameEngine(object):
         return None
 
     def toBoardstring(self):
-        return BoardString(str(self.position.fen))
+        return BoardString(self.fen)
 
     def initialMove(self):
         '''Special game move to hold starting position.'''
 
+        if self.isbitboard:
+            movenum = self.position.full_move
+            iswhite = self.position.turn == bitboard.WHITE
+        else:
+            movenum = self.position.fen.full_move
+            iswhite = self.position.fen.turn == 'w'
+
         # FIXME: use iswhite
         start = GameMove(
             self._start_name,
-            self.position.fen.full_move,
-            self.position.fen.turn == 'w',
+            movenum,
+            iswhite,
             None,
             self.fen,
             None,
             None,
             None,
-            None
+            None,
+            self.key
         )
         return start
 
@@ -9,7 +9,7 @@ import db
 import settings
 from util import tr
 
-from table_widget import VariationsTable
+from table_widget import VariationsTable, GameListView
 
 class MainWindow(QtGui.QMainWindow):
 	
@@ -29,6 +29,8 @@ class MainWindow(QtGui.QMainWindow):
 		self.setCentralWidget(self.widget)
 		self.setWindowTitle(tr("ChessJay"))
 
+		self.game_list = None
+
 		self.createActions()
 		self.createMenus()
 		self.createDocks()
@@ -36,6 +38,14 @@ class MainWindow(QtGui.QMainWindow):
 
 	def createActions(self):
 
+		self.action_open_pgn = QtGui.QAction("Open PGN...", self, 
+				shortcut="Ctrl+O", statusTip="Open a pgn file", 
+				triggered=self.openPgn)
+
+		self.action_save_pgn = QtGui.QAction("Save PGN...", self, 
+				shortcut="Ctrl+S", statusTip="Save the game to a pgn file", 
+				triggered=self.savePgn)
+
 		self.action_exit = QtGui.QAction("Quit", self, 
 				shortcut="Ctrl+Q", statusTip="Quit", 
 				triggered=self.close)
@@ -50,6 +60,8 @@ class MainWindow(QtGui.QMainWindow):
 
 	def createMenus(self):
 		self.file_menu = self.menuBar().addMenu("&File")
+		self.file_menu.addAction(self.action_open_pgn)
+		self.file_menu.addAction(self.action_save_pgn)
 		self.file_menu.addAction(self.action_exit)
 
 		self.view_menu = self.menuBar().addMenu("&View")
@@ -67,6 +79,32 @@ class MainWindow(QtGui.QMainWindow):
 		#self.variations_table.moveSelected.connect(self.onVariationSelected)
 		#Dock(variations_table, self.tr('Variations'), self)
 
+	def openPgn(self):
+
+		filename = QtGui.QFileDialog.getOpenFileName(self, tr("Open PGN"), '', tr("PGN files (*.pgn)"))
+		if not filename:
+			return
+
+		if self.game_list is None:
+			self.game_list = GameListView()
+			self.game_list.gameSelected.connect(self.onGameSelected)
+			self.game_list.indexFailed.connect(self.onIndexFailed)
+			Dock(self.game_list, tr('Games'), self)
+		self.game_list.openPgn(str(filename))
+
+	def savePgn(self):
+
+		filename = QtGui.QFileDialog.getSaveFileName(self, tr("Save PGN"), '', tr("PGN files (*.pgn *.pgn.gz)"))
+		if not filename:
+			return
+		self.scene.moves.exportPgn(str(filename))
+
+	def onIndexFailed(self, message):
+		QtGui.QMessageBox.warning(self, tr("Open PGN"), message)
+
+	def onGameSelected(self, game):
+		self.scene.loadPgnGame(game)
+
 
 class Dock(QtGui.QDockWidget):
 	
@@ -0,0 +1,105 @@
+'''
+Copyright Nate Carson 2013
+
+Index of the material signatures (see bitboard.materialSignature) each game
+of an archive went through, with the first ply each was reached at, for
+searches such as all games that reached KRPvKR.
+
+    buildMaterialIndex('corpus.cja', 'corpus.cjm', processes=8)
+    index = MaterialIndex('corpus.cjm')
+    games, plies = index.find('KRPvKR')
+
+The file is a position index (see position_index) keyed by signature
+instead of position key, with one posting per game and signature.
+'''
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import bitboard
+from game_engine import ChessLibGameEngine
+from position_index import PositionIndex, buildIndex
+
+
+def materialPostings(line):
+    '''Returns (signature, first ply) of every material signature of a GameLine.'''
+
+    replay = ChessLibGameEngine('bitboard').replay(line.moves, line.start_fen, packed=True)
+    first = {replay.start_material: 0}
+    for ply, signature in enumerate(replay.material):
+        first.setdefault(int(signature), ply + 1)
+    return first.items()
+
+
+def buildMaterialIndex(archive_name, out, processes=1):
+    buildIndex(archive_name, out, processes, postings=materialPostings)
+
+
+def _swapColors(signature):
+    white = signature & 0xfffff
+    black = signature >> 20 & 0xfffff
+    return black | white << 20
+
+
+class MaterialIndex(PositionIndex):
+    '''Reads a material index.'''
+
+    def find(self, material, either=False):
+        '''
+            Returns (games, plies) for the games that reached material, given as a
+            signature or text such as KRPvKR with white first, and the ply each
+            first reached it at. With either the colors may also be the other
+            way around.
+        '''
+
+        if isinstance(material, basestring):
+            material = bitboard.parseMaterial(material)
+        games, plies = self.lookup(material)
+        swapped = _swapColors(material)
+        if not either or swapped == material:
+            return games, plies
+
+        other_games, other_plies = self.lookup(swapped)
+        if numpy is not None:
+            games = numpy.concatenate((games, other_games))
+            plies = numpy.concatenate((plies, other_plies))
+            order = numpy.lexsort((plies, games))
+            return games[order], plies[order]
+        pairs = sorted(zip(list(games) + list(other_games), list(plies) + list(other_plies)))
+        return [g for g, p in pairs], [p for g, p in pairs]
+
+    def signatures(self):
+        '''Yields (material text, games) for every signature in the index.'''
+
+        for key, data, last, count in self.entries():
+            yield bitboard.materialString(key), count
+
+
+if __name__ == '__main__':
+
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='build or query a material index of a game archive')
+    parser.add_argument('index')
+    parser.add_argument('-a', '--archive', help='archive to index')
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('-m', '--material', help='material to look up, such as KRPvKR')
+    parser.add_argument('-e', '--either', action='store_true', help='either side may have the material')
+    args = parser.parse_args()
+
+    if args.archive:
+        begin = time.time()
+        buildMaterialIndex(args.archive, args.index, args.processes)
+        print 'indexed in %.2fs' % (time.time() - begin)
+
+    index = MaterialIndex(args.index)
+    print '%d signatures' % len(index)
+    if args.material:
+        begin = time.time()
+        games, plies = index.find(args.material, args.either)
+        print '%d games in %.2fms' % (len(games), (time.time() - begin) * 1000)
+        for game, ply in zip(games, plies)[:20]:
+            print '    game %d ply %d' % (game, ply)
@@ -1,7 +1,8 @@
 
 from PyQt4 import QtCore, QtGui
 from util import TextWidget, GraphicsWidget, Action, tr, ToolBar, GraphicsButton
-from game_engine import GameMove
+from game_engine import AbstractGameMove, BoardString
+from export import PgnWriter
 import settings
 
 class MoveItem(TextWidget):
@@ -168,7 +169,7 @@ class PagingList(GraphicsWidget):
 
 class MovePagingList(PagingList):
 
-    move_selected = QtCore.pyqtSignal(GameMove, int)
+    move_selected = QtCore.pyqtSignal(AbstractGameMove, int)
 
     def __init__(self, width):
         super(MovePagingList, self).__init__(width)
@@ -241,6 +242,13 @@ class MovePagingList(PagingList):
             item.setWhite()
         super(MovePagingList, self).append(item)
 
+    def gameMoves(self):
+        '''Returns the game moves in the list starting with the initial move.'''
+        return [item.gamemove for item in self if isinstance(item, MoveItem) and item.isEnabled()]
+
+    def selectedMove(self):
+        return self._selected and self._selected.gamemove
+
     def newGame(self, initial_move):
 
         self.clear()
@@ -261,7 +269,7 @@ class MovePagingList(PagingList):
 
 class MovesWidget(GraphicsWidget):
 
-    move_made = QtCore.pyqtSignal(GameMove)
+    move_made = QtCore.pyqtSignal(AbstractGameMove)
 
     def __init__(self, board, game_engine):
         
@@ -319,9 +327,9 @@ class MovesWidget(GraphicsWidget):
     def _onNewGame(self, button):
         self.newGame()
 
-    def newGame(self, fen=None):
+    def newGame(self, fen=None, force=False):
 
-        if fen and str(fen) == str(self.game_engine.position.fen):
+        if not force and fen and str(fen) == self.game_engine.fen:
             return
 
         if fen:
@@ -334,34 +342,62 @@ class MovesWidget(GraphicsWidget):
         self.board.setFen(self.game_engine.fen)
     
     def loadGame(self, moves, initial=None):
+        '''Loads a list of game moves or a GameLine, initial is the starting fen.'''
 
-        if initial:
-            self.newGame(inital)
-        else:
-            self.newGame()
+        # start over even when the engine is already on the starting fen
+        self.newGame(initial, force=True)
 
         for move in moves:
             self.move_list.append(move)
 
+    def loadPgnGame(self, game):
+        '''
+            Loads a pgn.PgnGame by playing it through the engine from its starting
+            fen, so the engine can go back and forth over its moves.
+        '''
+
+        self.newGame(game.fen, force=True)
+        for move in game.gameMoves(self.game_engine):
+            self.move_list.append(move)
+
     def setEngine(self, game_engine):
         self.game_engine = game_engine
     
     def onMoveSelected(self, move, diff):
 
-        # one move backward from current
-        if diff == -1:
-            current = self.move_list.current(emit=False)
-            self._move_piece(current.gamemove.reverse(), current.gamemove.captured)
+        moves = self.move_list.gameMoves()
+        start = self._moveIndex(moves, self.move_list.selectedMove())
+        end = self._moveIndex(moves, move)
 
-        # one move forward from current or first move from inital
-        elif diff in [0,1]:
-            self._move_piece(move)
+        # nothing on the board to replay from
+        if start is None or end is None:
+            self.board.setFen(move.fen_after)
 
-        # everything else
         else:
-            self.board.setFen(move.fen_after)
+            # take moves back one at a time
+            for idx in xrange(start, end, -1):
+                self._move_piece(moves[idx].reverse(), moves[idx].captured)
+
+            # or replay them forward
+            for idx in xrange(start + 1, end + 1):
+                self._move_piece(moves[idx])
+
+            # en passant and promotions are not animated so fix up the board if needed
+            if str(self.board.squares.toString()) != str(BoardString(move.fen_after)):
+                self.board.setFen(move.fen_after)
+
+        # keep the engine on the selected move if it made the moves
+        if end is not None and end <= self.game_engine.plies:
+            self.game_engine.goTo(end)
+
         self.move_made.emit(move)
 
+    def _moveIndex(self, moves, move):
+        for idx, other in enumerate(moves):
+            if other is move:
+                return idx
+        return None
+
     def _move_piece(self, move, uncapture=''):
         #We need this to check for castling moves so we can move the rook.
 
@@ -411,6 +447,15 @@ class MovesWidget(GraphicsWidget):
     def lastMove(self):
         return self.move_list.last()
 
+    def exportPgn(self, filename, headers=None):
+        '''Writes the game in the move list to a pgn file.'''
+
+        writer = PgnWriter(filename)
+        try:
+            writer.writeGame(self.move_list.gameMoves(), headers)
+        finally:
+            writer.close()
+
 
 
 if __name__ == '__main__':
@@ -427,7 +472,7 @@ if __name__ == '__main__':
 
             if event.key() == QtCore.Qt.Key_Return:
                 engine = self.scene().moves.game_engine
-                move = engine.position.get_legal_moves().next()
+                move = engine.legalMoves()[0]
                 self.scene().moves.onNewMove(move)
 
 
@@ -0,0 +1,332 @@
+'''
+Copyright Nate Carson 2013
+
+Opening explorer built from a corpus of games. Every move played from a
+position within the first max_ply plies of a game is a node of the tree,
+keyed by the position (polyglot zobrist) and the packed move, with the
+number of games that were won by white, drawn, won by black and played in
+all. Keying by position joins transpositions.
+
+    buildTree('corpus.cja', 'corpus.cjt')
+    tree = OpeningTree('corpus.cjt')
+    for variation in tree.variations(fen):
+        print variation.san, variation.total
+
+    # games imported later are added without reading the corpus again
+    addGames('corpus.cjt', [(line, '1-0'), ...])
+
+The file holds a header, then the nodes sorted by key and move as three
+columns: keys (uint64), counts (4 x uint32) and moves (uint16). It is read
+through mmap so a lookup is a binary search over the key column.
+'''
+
+import os
+import mmap
+import bisect
+import struct
+import tempfile
+import itertools
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import bitboard
+from bitboard import BitboardPosition
+from archive import Archive
+from position_index import _KeyTable
+
+
+class OpeningTreeError(Exception): pass
+
+
+MAGIC = 'CJOT'
+VERSION = 1
+# magic, version, nodes, max ply
+HEADER = struct.Struct('<4sIQI12x')
+COUNT = struct.Struct('<4I')
+
+WHITE, DRAW, BLACK, TOTAL = range(4)
+# column counted for every result, games without one are only in the total
+RESULT_COLUMNS = {'1-0': WHITE, '1/2-1/2': DRAW, '0-1': BLACK}
+
+
+Node = namedtuple('Node', 'move white draws black total')
+
+
+class Variation(object):
+    '''A move from a position with its results, as shown by table_widget.VariationsTable.'''
+
+    def __init__(self, node, position):
+
+        self.move = node.move
+        self.total = node.total
+        self.wins, self.draws, self.losses = node.white, node.draws, node.black
+        self.undetermined = node.total - node.white - node.draws - node.black
+
+        decided = float(self.total - self.undetermined) or 1.
+        self.white_winr = int(round(100 * self.wins / decided))
+        self.drawr = int(round(100 * self.draws / decided))
+        self.white_loser = int(round(100 * self.losses / decided))
+
+        source, target, promotion = bitboard.unpackMove(node.move)
+        self.ssquare = bitboard.SQUARE_NAMES[source]
+        self.esquare = bitboard.SQUARE_NAMES[target]
+        self.subject = position.pieceAt(source)
+        self.target = position.pieceAt(target) or ''
+        self.san = position.san(node.move)
+
+    def __repr__(self):
+        return '%s %d (%d%% %d%% %d%%)' % (self.san, self.total, self.white_winr, self.drawr, self.white_loser)
+
+
+def _gameNodes(line, max_ply):
+    '''Returns the (key, move) of every move of a GameLine within max_ply.'''
+
+    position = BitboardPosition(line.start_fen)
+    nodes = []
+    for move in line.moves[:max_ply]:
+        nodes.append((position.key, move))
+        position.makeMove(move)
+    return nodes
+
+
+def _aggregate(keys, moves, counts):
+    '''Sums the counts of equal (key, move) rows, returns the rows sorted.'''
+
+    if not len(keys):
+        return keys, moves, counts
+    order = numpy.lexsort((moves, keys))
+    keys, moves, counts = keys[order], moves[order], counts[order]
+    first = numpy.ones(len(keys), dtype=bool)
+    first[1:] = (keys[1:] != keys[:-1]) | (moves[1:] != moves[:-1])
+    starts = numpy.flatnonzero(first)
+    return keys[starts], moves[starts], numpy.add.reduceat(counts, starts, axis=0).astype('<u4')
+
+
+def _countGames(games, max_ply):
+    '''Returns the aggregated (keys, moves, counts) of (GameLine, result) pairs.'''
+
+    keys, moves, columns = [], [], []
+    for line, result in games:
+        # a game reaching a position and move twice still counts once
+        nodes = set(_gameNodes(line, max_ply))
+        keys.extend([key for key, move in nodes])
+        moves.extend([move for key, move in nodes])
+        columns.extend([RESULT_COLUMNS.get(result, TOTAL)] * len(nodes))
+
+    counts = numpy.zeros((len(keys), 4), dtype='<u4')
+    counts[:, TOTAL] = 1
+    columns = numpy.array(columns, dtype=int)
+    decided = numpy.flatnonzero(columns != TOTAL)
+    counts[decided, columns[decided]] = 1
+    return _aggregate(numpy.array(keys, dtype='<u8'), numpy.array(moves, dtype='<u2'), counts)
+
+
+def _merge(a, b):
+    '''
+        Merges aggregated rows b into aggregated rows a in one pass over a. Rows
+        of b are placed by binary search, so a is never sorted again.
+    '''
+
+    keys, moves, counts = a
+    new_keys, new_moves, new_counts = b
+    if not len(keys) or not len(new_keys):
+        return b if not len(keys) else a
+
+    # (position number, move) orders the rows of a as (key, move) does
+    first = numpy.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    block = numpy.cumsum(first) - 1
+    ranks = block.astype('i8') << 16 | moves
+
+    at = numpy.searchsorted(keys, new_keys)
+    clipped = numpy.minimum(at, len(keys) - 1)
+    present = keys[clipped] == new_keys
+    new_ranks = block[clipped].astype('i8') << 16 | new_moves
+    at[present] = numpy.searchsorted(ranks, new_ranks[present])
+
+    clipped = numpy.minimum(at, len(keys) - 1)
+    same = present & (ranks[clipped] == new_ranks)
+    counts = counts.copy()
+    counts[at[same]] += new_counts[same]
+
+    fresh = ~same
+    at = at[fresh]
+    return (numpy.insert(keys, at, new_keys[fresh]), numpy.insert(moves, at, new_moves[fresh]),
+        numpy.insert(counts, at, new_counts[fresh], axis=0))
+
+
+def _writeTree(filename, tree, max_ply):
+    '''Writes aggregated rows to a temporary file and moves it over filename.'''
+
+    keys, moves, counts = tree
+    fd, temp = tempfile.mkstemp('.cjt', 'tree', os.path.dirname(os.path.abspath(filename)))
+    f = os.fdopen(fd, 'wb')
+    try:
+        f.write(HEADER.pack(MAGIC, VERSION, len(keys), max_ply))
+        keys.astype('<u8').tofile(f)
+        counts.astype('<u4').tofile(f)
+        moves.astype('<u2').tofile(f)
+    finally:
+        f.close()
+    os.rename(temp, filename)
+
+
+def _emptyTree():
+    return numpy.zeros(0, dtype='<u8'), numpy.zeros(0, dtype='<u2'), numpy.zeros((0, 4), dtype='<u4')
+
+
+def _archiveGames(archive):
+    for n in xrange(len(archive)):
+        yield archive.gameLine(n), archive.headers(n)['Result']
+
+
+def buildTree(archive_name, out, max_ply=40, batch=1 << 14):
+    '''Builds a tree from the games of an archive, batch games at a time.'''
+
+    if numpy is None:
+        raise OpeningTreeError('building an opening tree needs numpy')
+
+    archive = Archive(archive_name)
+    try:
+        tree = _emptyTree()
+        games = _archiveGames(archive)
+        while True:
+            chunk = list(itertools.islice(games, batch))
+            if not chunk:
+                break
+            tree = _merge(tree, _countGames(chunk, max_ply))
+        _writeTree(out, tree, max_ply)
+    finally:
+        archive.close()
+    return len(tree[0])
+
+
+def addGames(filename, games, max_ply=None):
+    '''
+        Adds (GameLine, result) pairs to a tree file, creating it when missing.
+        Only the new games are replayed, their nodes are merged into the file.
+    '''
+
+    if numpy is None:
+        raise OpeningTreeError('building an opening tree needs numpy')
+
+    if os.path.exists(filename):
+        tree = OpeningTree(filename)
+        try:
+            max_ply = max_ply or tree.max_ply
+            old = tree.arrays()
+            old = old[0].copy(), old[1].copy(), old[2].copy()
+        finally:
+            tree.close()
+    else:
+        max_ply = max_ply or 40
+        old = _emptyTree()
+
+    _writeTree(filename, _merge(old, _countGames(games, max_ply)), max_ply)
+
+
+class OpeningTree(object):
+    '''Reads a tree file through mmap.'''
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size:
+            raise OpeningTreeError('%s is not an opening tree' % filename)
+        magic, version, count, self.max_ply = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            raise OpeningTreeError('%s is not an opening tree' % filename)
+
+        self._count = count
+        self._keys_pos = HEADER.size
+        self._counts_pos = self._keys_pos + 8 * count
+        self._moves_pos = self._counts_pos + COUNT.size * count
+        if numpy is not None:
+            self._keys = numpy.frombuffer(self._map, dtype='<u8', count=count, offset=self._keys_pos)
+        else:
+            self._keys = _KeyTable(self._map, self._keys_pos, count)
+
+    def close(self):
+        self._keys = None
+        self._map.close()
+        self._file.close()
+
+    def reload(self):
+        '''Opens the file again after addGames has written to it.'''
+
+        self.close()
+        self.__init__(self.filename)
+
+    def __len__(self):
+        '''Number of nodes.'''
+        return self._count
+
+    def arrays(self):
+        '''Returns the keys, moves and counts columns as numpy views of the file.'''
+
+        count = self._count
+        return (
+            self._keys,
+            numpy.frombuffer(self._map, dtype='<u2', count=count, offset=self._moves_pos),
+            numpy.frombuffer(self._map, dtype='<u4', count=4 * count, offset=self._counts_pos).reshape(count, 4),
+        )
+
+    def _range(self, key):
+
+        if numpy is not None:
+            key = numpy.uint64(key)
+            return int(self._keys.searchsorted(key)), int(self._keys.searchsorted(key, 'right'))
+        return bisect.bisect_left(self._keys, key), bisect.bisect_right(self._keys, key)
+
+    def __contains__(self, key):
+        start, end = self._range(key)
+        return end > start
+
+    def nodes(self, key):
+        '''Returns the Nodes of the moves played from a position, most played first.'''
+
+        start, end = self._range(key)
+        n = end - start
+        moves = struct.unpack_from('<%dH' % n, self._map, self._moves_pos + 2 * start)
+        counts = struct.unpack_from('<%dI' % (4 * n), self._map, self._counts_pos + COUNT.size * start)
+        nodes = [Node(move, *counts[4 * i:4 * i + 4]) for i, move in enumerate(moves)]
+        nodes.sort(key=lambda node: -node.total)
+        return nodes
+
+    def variations(self, fen=None):
+        '''Returns the Variations played from a fen, most played first.'''
+
+        position = BitboardPosition(fen and str(fen))
+        return [Variation(node, position) for node in self.nodes(position.key)]
+
+
+if __name__ == '__main__':
+
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='build or query an opening tree of a game archive')
+    parser.add_argument('tree')
+    parser.add_argument('-a', '--archive', help='archive to build the tree from')
+    parser.add_argument('-m', '--max-ply', type=int, default=40)
+    parser.add_argument('-f', '--fen', help='position to show the moves of')
+    args = parser.parse_args()
+
+    if args.archive:
+        begin = time.time()
+        count = buildTree(args.archive, args.tree, args.max_ply)
+        print '%d nodes in %.2fs' % (count, time.time() - begin)
+
+    tree = OpeningTree(args.tree)
+    print '%d nodes to ply %d' % (len(tree), tree.max_ply)
+    begin = time.time()
+    variations = tree.variations(args.fen)
+    print '%d moves in %.3fms' % (len(variations), (time.time() - begin) * 1000)
+    for variation in variations:
+        print '    %r' % variation
@@ -0,0 +1,289 @@
+'''
+Copyright Nate Carson 2013
+
+Piece placement searches over every position of an archive. Positions are
+stored as 12 bitboards each (PNBRQKpnbrqk, a1 = bit 0) in a memory mapped
+file and a pattern is tested against a chunk of positions at a time with
+numpy bitwise operations.
+
+    buildPlanes('corpus.cja', 'corpus.cjb')
+    planes = PlaneIndex('corpus.cjb')
+
+    # white knight on d5, no black c pawn, queens off
+    pattern = Pattern().require('N', 'd5').forbid('p', fileSquares('c')).absent('Q').absent('q')
+    games, plies = planes.search(pattern)
+
+The file holds a header, then the 12 planes of every position, then the game
+(uint32) and the ply (uint16) of every position.
+'''
+
+import struct
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import bitboard
+from bitboard import BitboardPosition
+from game_engine import AlgSquare, BoardString, Piece
+from archive import Archive
+
+
+class PatternError(Exception): pass
+
+
+MAGIC = 'CJBP'
+VERSION = 1
+# magic, version, positions
+HEADER = struct.Struct('<4sIQ16x')
+PLANES = len(bitboard.SYMBOLS)
+
+
+def _square(square):
+    '''Returns the bitboard index of an AlgSquare, its label or an index.'''
+
+    if isinstance(square, (int, long)):
+        return square
+    return AlgSquare(str(square)).index
+
+def _plane(piece):
+    # Piece raises ValueError for anything that is not a piece
+    Piece.isWhite(piece)
+    return bitboard.SYMBOLS.index(piece)
+
+def fileSquares(name):
+    '''Returns the squares of a file, such as fileSquares('c').'''
+    return [AlgSquare(name + rank) for rank in AlgSquare.ranks]
+
+def rankSquares(name):
+    '''Returns the squares of a rank, such as rankSquares('7').'''
+    return [AlgSquare(f + str(name)) for f in AlgSquare.files]
+
+
+class Pattern(object):
+    '''
+        Piece placement that positions are matched against. Every piece has a
+        mask of squares it must stand on and a mask of squares it must not. The
+        methods return the pattern so they can be chained.
+    '''
+
+    def __init__(self):
+        self.need = [0] * PLANES
+        self.forbidden = [0] * PLANES
+
+    @classmethod
+    def fromBoardString(cls, board):
+        '''Pattern requiring every piece of a BoardString or fen on its square.'''
+
+        board = BoardString(board)
+        pattern = cls()
+        for square in AlgSquare.generate():
+            if not board.isEmpty(square):
+                pattern.require(board[square], square)
+        return pattern
+
+    def require(self, piece, *squares):
+        '''A piece must stand on every one of the squares.'''
+
+        plane = _plane(piece)
+        for square in self._squares(squares):
+            self.need[plane] |= 1 << _square(square)
+        return self
+
+    def forbid(self, piece, *squares):
+        '''A piece must not stand on any of the squares.'''
+
+        plane = _plane(piece)
+        for square in self._squares(squares):
+            self.forbidden[plane] |= 1 << _square(square)
+        return self
+
+    def absent(self, piece):
+        '''The piece is nowhere on the board.'''
+
+        self.forbidden[_plane(piece)] = bitboard.FULL
+        return self
+
+    def _squares(self, squares):
+        for square in squares:
+            if isinstance(square, (list, tuple)):
+                for s in square:
+                    yield s
+            else:
+                yield square
+
+    def planes(self):
+        '''Yields (plane, need, forbidden) for the planes the pattern looks at.'''
+
+        for plane in xrange(PLANES):
+            if self.need[plane] or self.forbidden[plane]:
+                yield plane, self.need[plane], self.forbidden[plane]
+
+    def matches(self, position):
+        '''Tests one BitboardPosition.'''
+
+        for plane, need, forbidden in self.planes():
+            bb = position.kinds[plane % 6] & position.colors[plane / 6]
+            if bb & need != need or bb & forbidden:
+                return False
+        return True
+
+    def __str__(self):
+
+        parts = []
+        for plane, need, forbidden in self.planes():
+            symbol = bitboard.SYMBOLS[plane]
+            if need:
+                parts.append('%s on %s' % (symbol, ','.join([bitboard.SQUARE_NAMES[s] for s in bitboard.scan(need)])))
+            if forbidden == bitboard.FULL:
+                parts.append('no %s' % symbol)
+            elif forbidden:
+                parts.append('no %s on %s' % (symbol, ','.join([bitboard.SQUARE_NAMES[s] for s in bitboard.scan(forbidden)])))
+        return ', '.join(parts)
+
+
+def _positionPlanes(position):
+    kinds, colors = position.kinds, position.colors
+    return [kinds[plane % 6] & colors[plane / 6] for plane in xrange(PLANES)]
+
+
+def buildPlanes(archive_name, out, batch=1 << 16):
+    '''Writes the planes of every position of every game of an archive.'''
+
+    if numpy is None:
+        raise PatternError('pattern search needs numpy')
+
+    archive = Archive(archive_name)
+    f = open(out, 'wb')
+    games, plies = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+    try:
+        f.write(HEADER.pack(MAGIC, VERSION, 0))
+        count = 0
+        rows, game_ids, ply_ids = [], [], []
+
+        def flush():
+            numpy.array(rows, dtype='<u8').tofile(f)
+            numpy.array(game_ids, dtype='<u4').tofile(games)
+            numpy.array(ply_ids, dtype='<u2').tofile(plies)
+            del rows[:], game_ids[:], ply_ids[:]
+
+        for game in xrange(len(archive)):
+            line = archive.gameLine(game)
+            position = BitboardPosition(line.start_fen)
+            rows.append(_positionPlanes(position))
+            for move in line.moves:
+                position.makeMove(move)
+                rows.append(_positionPlanes(position))
+            plies_in_game = len(line.moves) + 1
+            game_ids.extend([game] * plies_in_game)
+            ply_ids.extend(xrange(plies_in_game))
+            count += plies_in_game
+            if len(rows) >= batch:
+                flush()
+        flush()
+
+        for part in (games, plies):
+            part.seek(0)
+            while True:
+                data = part.read(1 << 20)
+                if not data:
+                    break
+                f.write(data)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, count))
+    finally:
+        f.close()
+        games.close()
+        plies.close()
+        archive.close()
+    return count
+
+
+class PlaneIndex(object):
+    '''Reads a planes file through numpy memory maps.'''
+
+    def __init__(self, filename):
+
+        if numpy is None:
+            raise PatternError('pattern search needs numpy')
+
+        self.filename = filename
+        f = open(filename, 'rb')
+        try:
+            magic, version, count = HEADER.unpack(f.read(HEADER.size))
+        finally:
+            f.close()
+        if magic != MAGIC or version != VERSION:
+            raise PatternError('%s is not a planes file' % filename)
+
+        self._count = count
+        offset = HEADER.size
+        self.planes = numpy.memmap(filename, dtype='<u8', mode='r', offset=offset, shape=(count, PLANES))
+        offset += 8 * PLANES * count
+        self.games = numpy.memmap(filename, dtype='<u4', mode='r', offset=offset, shape=(count,))
+        offset += 4 * count
+        self.plies = numpy.memmap(filename, dtype='<u2', mode='r', offset=offset, shape=(count,))
+
+    def __len__(self):
+        return self._count
+
+    def matches(self, pattern, chunk=1 << 20):
+        '''Yields the position numbers, chunk by chunk, of the positions matching a pattern.'''
+
+        tests = [(plane, numpy.uint64(need), numpy.uint64(forbidden)) for plane, need, forbidden in pattern.planes()]
+        for start in xrange(0, self._count, chunk):
+            planes = self.planes[start:start + chunk]
+            ok = numpy.ones(len(planes), dtype=bool)
+            for plane, need, forbidden in tests:
+                column = planes[:, plane]
+                if need:
+                    ok &= (column & need) == need
+                if forbidden:
+                    ok &= (column & forbidden) == 0
+            yield numpy.flatnonzero(ok) + start
+
+    def search(self, pattern, first=True, chunk=1 << 20):
+        '''
+            Returns (games, plies) of the positions matching a pattern. With first
+            only the first matching ply of each game is returned.
+        '''
+
+        found = [hits for hits in self.matches(pattern, chunk) if len(hits)]
+        if not found:
+            empty = numpy.zeros(0, dtype='uint32')
+            return empty, empty.astype('uint16')
+        hits = numpy.concatenate(found)
+        games, plies = self.games[hits], self.plies[hits]
+        if first:
+            # positions are stored in game order so the first of each game is its first ply
+            games, index = numpy.unique(games, return_index=True)
+            plies = plies[index]
+        return numpy.asarray(games), numpy.asarray(plies)
+
+
+if __name__ == '__main__':
+
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='build or search a planes file of a game archive')
+    parser.add_argument('planes')
+    parser.add_argument('-a', '--archive', help='archive to build the planes from')
+    parser.add_argument('-f', '--fen', help='search for the pieces of a fen or board string')
+    args = parser.parse_args()
+
+    if args.archive:
+        begin = time.time()
+        count = buildPlanes(args.archive, args.planes)
+        print '%d positions in %.2fs' % (count, time.time() - begin)
+
+    index = PlaneIndex(args.planes)
+    print '%d positions' % len(index)
+    if args.fen:
+        pattern = Pattern.fromBoardString(args.fen)
+        begin = time.time()
+        games, plies = index.search(pattern)
+        elapsed = time.time() - begin
+        print '%s: %d games in %.2fs, %d positions/s' % (pattern, len(games), elapsed, len(index) / (elapsed or 1e-9))
@@ -0,0 +1,179 @@
+'''
+Copyright Nate Carson 2013
+
+Perft (move path enumeration) for checking and timing move generation of
+the game engine backends.
+
+    python perft.py                         # every position to depth 3 on every backend
+    python perft.py -d 4 -b bitboard start kiwipete
+    python perft.py -d 5 --divide -p 8 start
+'''
+
+import sys
+import time
+from multiprocessing import Pool
+
+from game_engine import ChessLibGameEngine, Position, Move
+
+
+# name, fen, node counts from depth 1
+POSITIONS = [
+    ('start', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+        [20, 400, 8902, 197281, 4865609, 119060324]),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+        [48, 2039, 97862, 4085603, 193690690]),
+    ('position3', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+        [14, 191, 2812, 43238, 674624, 11030083]),
+    ('position4', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+        [6, 264, 9467, 422333, 15833292]),
+    ('position5', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+        [44, 1486, 62379, 2103487, 89941194]),
+    ('position6', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+        [46, 2079, 89890, 3894594]),
+
+    # en passant
+    ('ep-discovered-check', '8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1', [15, 126, 1928, 13931]),
+    ('ep-pinned', '3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1', [18, 92, 1670, 10138]),
+    ('ep-bishop-pin', '8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1', [13, 102, 1266, 10276]),
+
+    # castling
+    ('castle-short', '5k2/8/8/8/8/8/8/4K2R w K - 0 1', [15, 66, 1198, 6399]),
+    ('castle-long', '3k4/8/8/8/8/8/8/R3K3 w Q - 0 1', [16, 71, 1286, 7418]),
+    ('castle-prevented', 'r3k2r/1b4bq/8/8/8/8/7B/R3K2R w KQkq - 0 1', [26, 1141, 27826]),
+    ('castle-rook-capture', 'r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1', [44, 1494, 50509]),
+
+    # promotion
+    ('promote-out-of-check', '2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1', [11, 133, 1442, 19174]),
+    ('promote-to-check', '4k3/1P6/8/8/8/8/K7/8 w - - 0 1', [9, 40, 472, 2661, 38983]),
+    ('underpromote-to-check', '8/P1k5/K7/8/8/8/8/8 w - - 0 1', [6, 27, 273, 1329, 18135]),
+    ('promote-double-check', '8/k1P5/8/1K6/8/8/8/8 w - - 0 1', [10, 25, 268, 926, 10857]),
+
+    # mate and stalemate
+    ('self-stalemate', 'K1k5/8/P7/8/8/8/8/8 w - - 0 1', [2, 6, 13, 63, 382, 2217]),
+    ('discovered-check', '8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1', [29, 165, 5160, 31961]),
+    ('check-evasion', '8/8/2k5/5q2/5n2/8/5K2/8 b - - 0 1', [37, 183, 6559, 23527]),
+]
+
+
+def _bitboardPerft(position, depth):
+
+    moves = position.legalMoves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        undo = position.makeMove(move)
+        nodes += _bitboardPerft(position, depth - 1)
+        position.unmakeMove(undo)
+    return nodes
+
+def _chessPerft(position, depth):
+
+    moves = list(position.get_legal_moves())
+    if depth == 1:
+        return len(moves)
+    # python-chess positions cannot take a move back
+    fen = str(position.fen)
+    nodes = 0
+    for move in moves:
+        child = Position(fen)
+        child.make_move(move)
+        nodes += _chessPerft(child, depth - 1)
+    return nodes
+
+def perft(engine, depth):
+    '''Returns the number of leaf nodes depth plies below the engine's position.'''
+
+    if depth < 1:
+        return 1
+    if engine.isbitboard:
+        return _bitboardPerft(engine.position, depth)
+    return _chessPerft(engine.position, depth)
+
+
+def _divideMove(args):
+    backend, fen, uci, depth = args
+    engine = ChessLibGameEngine(backend)
+    engine.newGame(fen)
+    engine.makeMove(Move.from_uci(uci))
+    return uci, perft(engine, depth - 1)
+
+def divide(backend, fen, depth, processes=1):
+    '''
+        Returns (uci, nodes) for every root move. With more than one process the
+        root moves are split across a process pool.
+    '''
+
+    engine = ChessLibGameEngine(backend)
+    engine.newGame(fen)
+    jobs = [(backend, fen, str(move), depth) for move in engine.legalMoves()]
+
+    if processes > 1:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_divideMove, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_divideMove(job) for job in jobs]
+    return sorted(results)
+
+
+def run(backends, names=None, depth=3, show_divide=False, processes=1, out=None):
+    '''Runs the positions and writes counts and nodes per second, returns False on a wrong count.'''
+
+    out = out or sys.stdout
+    passed = True
+
+    for backend in backends:
+        total_nodes, total_time = 0, 0.0
+        for name, fen, counts in POSITIONS:
+            if names and name not in names:
+                continue
+            d = min(depth, len(counts))
+
+            start = time.time()
+            if processes > 1 or show_divide:
+                results = divide(backend, fen, d, processes)
+                nodes = sum([n for uci, n in results])
+            else:
+                engine = ChessLibGameEngine(backend)
+                engine.newGame(fen)
+                results = None
+                nodes = perft(engine, d)
+            elapsed = time.time() - start
+
+            ok = nodes == counts[d - 1]
+            passed = passed and ok
+            total_nodes += nodes
+            total_time += elapsed
+            out.write('%-9s %-22s depth %d %12d %s %8.2fs %10d nps\n' % (
+                backend, name, d, nodes, 'ok' if ok else 'FAIL (expected %d)' % counts[d - 1],
+                elapsed, nodes / elapsed if elapsed else 0))
+            if show_divide:
+                for uci, n in results:
+                    out.write('    %-6s %d\n' % (uci, n))
+
+        if total_time:
+            out.write('%-9s total %d nodes in %.2fs, %d nps\n' % (
+                backend, total_nodes, total_time, total_nodes / total_time))
+    return passed
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='perft the game engine backends')
+    parser.add_argument('positions', nargs='*', help='names of the positions to run (default all)')
+    parser.add_argument('-d', '--depth', type=int, default=3)
+    parser.add_argument('-b', '--backend', action='append', choices=ChessLibGameEngine.backends,
+        help='backend to run, may be repeated (default every available one)')
+    parser.add_argument('--divide', action='store_true', help='show the node count of every root move')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='split root moves across processes')
+    args = parser.parse_args()
+
+    backends = args.backend or [b for b in ChessLibGameEngine.backends if b != 'chess' or Position]
+    passed = run(backends, args.positions, args.depth, args.divide, args.processes)
+    sys.exit(0 if passed else 1)
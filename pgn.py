@@ -0,0 +1,303 @@
+'''
+Copyright Nate Carson 2013
+
+Streaming reader for pgn files. Games are read one at a time so files of any
+size are read in constant memory, and only the headers and the san of the
+main line are kept. Comments, variations, nags and move numbers are dropped.
+
+    for game in readGames('games.pgn'):
+        print game.headers.get('White'), len(game.sans)
+        moves = game.gameMoves()
+'''
+
+import os
+import re
+import gzip
+import itertools
+from multiprocessing import Pool, cpu_count
+
+import bitboard
+from game_engine import ChessLibGameEngine, GameLine, MoveError
+
+# the python-chess and bitboard backends raise their own errors
+_move_errors = (MoveError, bitboard.MoveError)
+
+
+class PgnError(Exception): pass
+
+
+class PgnGame(object):
+    '''
+        Headers and main line san of one game. offset and length are the bytes
+        the game takes up in its file.
+    '''
+
+    def __init__(self, headers, sans, result=None, offset=None, length=None):
+        self.headers = headers
+        self.sans = sans
+        self.result = result or headers.get('Result', '*')
+        self.offset = offset
+        self.length = length
+        # packed moves once validated by an import
+        self.packed = None
+
+    @property
+    def fen(self):
+        '''Starting fen for games set up from a position, otherwise None.'''
+        return self.headers.get('FEN')
+
+    def __len__(self):
+        return len(self.sans)
+
+    def __str__(self):
+        return '%s vs. %s' % (self.headers.get('White', '?'), self.headers.get('Black', '?'))
+
+    def gameMoves(self, engine=None):
+        '''Plays the game through an engine and returns its GameMoves.'''
+
+        engine = engine or ChessLibGameEngine()
+        engine.newGame(self.fen)
+        moves = []
+        for ply, san in enumerate(self.sans):
+            try:
+                moves.append(engine.makeMoveFromSan(san))
+            except _move_errors:
+                raise PgnError('illegal move %s at ply %d of %s' % (san, ply, self))
+        return moves
+
+    def gameLine(self):
+        '''Returns the game as a packed GameLine.'''
+
+        try:
+            return GameLine.fromSan(self.sans, self.fen)
+        except _move_errors, e:
+            raise PgnError('illegal move %s in %s' % (e, self))
+
+    def replay(self, engine=None):
+        '''Validates the moves in one call and returns the engine's Replay arrays.'''
+
+        engine = engine or ChessLibGameEngine('bitboard')
+        return engine.replay(self.sans, self.fen)
+
+
+_header = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+# brace and rest of line comments, whichever starts first
+_comments = re.compile(r'\{[^}]*\}?|;[^\n]*')
+# innermost variation
+_variation = re.compile(r'\([^()]*\)')
+# first characters of san, move numbers, nags and results start otherwise
+_san_start = frozenset('abcdefghNBRQKO')
+_result = re.compile(r'(1-0|0-1|1/2-1/2|\*)\s*$')
+
+
+def parseMovetext(text):
+    '''Returns the main line san and the result token, or None, of pgn movetext.'''
+
+    # the fast path is movetext without comments or variations
+    if '{' in text or ';' in text:
+        text = _comments.sub(' ', text)
+    if '(' in text:
+        count = 1
+        while count:
+            text, count = _variation.subn(' ', text)
+
+    match = _result.search(text)
+    result = match and match.group(1)
+    sans = [t for t in text.replace('.', ' ').split() if t[0] in _san_start or t[:3] == '0-0']
+    return sans, result
+
+
+def readGames(source, offset=0, end=None):
+    '''
+        Yields a PgnGame for every game in a pgn file name (gzipped when it ends
+        in .gz) or file object, starting from a byte offset. With end, games
+        starting at or after that offset are not read.
+    '''
+
+    if isinstance(source, basestring):
+        if source.endswith('.gz'):
+            f = gzip.open(source, 'rb')
+        else:
+            f = open(source, 'rb')
+    else:
+        f = source
+
+    try:
+        if offset:
+            f.seek(offset)
+
+        headers = {}
+        movetext = []
+        start = pos = offset
+        for line in f:
+            size = len(line)
+            stripped = line.strip()
+
+            if stripped.startswith('[') and movetext:
+                # a header after movetext starts the next game
+                sans, result = parseMovetext('\n'.join(movetext))
+                yield PgnGame(headers, sans, result, start, pos - start)
+                headers, movetext, start = {}, [], pos
+
+            if end is not None and pos >= end and not headers and not movetext:
+                break
+
+            if not stripped or stripped[0] == '%':
+                if not headers and not movetext:
+                    start = pos + size
+            elif stripped[0] == '[' and not movetext:
+                match = _header.match(stripped)
+                if match:
+                    headers[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+            else:
+                movetext.append(stripped)
+            pos += size
+
+        if headers or movetext:
+            sans, result = parseMovetext('\n'.join(movetext))
+            yield PgnGame(headers, sans, result, start, pos - start)
+    finally:
+        if f is not source:
+            f.close()
+
+
+def splitGames(filename, size):
+    '''
+        Returns (start, end) byte offsets that split a pgn file into shards of
+        about size bytes. Every shard starts at the first header of a game.
+    '''
+
+    total = os.path.getsize(filename)
+    bounds = [0]
+    f = open(filename, 'rb')
+    try:
+        while bounds[-1] + size < total:
+            f.seek(bounds[-1] + size)
+            f.readline()
+            pos = f.tell()
+            blank = False
+            # the next header line after a blank line
+            for line in iter(f.readline, ''):
+                if blank and line.startswith('['):
+                    break
+                blank = not line.strip()
+                pos += len(line)
+            if pos >= total:
+                break
+            bounds.append(pos)
+    finally:
+        f.close()
+    return zip(bounds, bounds[1:] + [total])
+
+
+def _importShard(args):
+    '''Reads and optionally validates the games of one shard in a worker.'''
+
+    filename, start, end, validate, skip_illegal = args
+    games, errors = [], []
+    try:
+        engine = ChessLibGameEngine('bitboard')
+        for game in readGames(filename, start, end):
+            if validate:
+                replay = engine.replay(game.sans, game.fen)
+                if replay.illegal is not None:
+                    errors.append((game.offset, 'illegal move %s at ply %d of %s' % (
+                        game.sans[replay.illegal], replay.illegal, game)))
+                    if skip_illegal:
+                        continue
+                else:
+                    game.packed = replay.packed
+            games.append(game)
+    except Exception, e:
+        errors.append((start, 'shard failed: %r' % e))
+    return start, end, games, errors
+
+
+class PgnImport(object):
+    '''
+        Reads a pgn file across a process pool. The file is split into shards at
+        game boundaries, each worker parses and validates whole shards and the
+        games are yielded back in file order. Games with illegal moves are
+        reported in errors as (shard start, shard end, [(offset, message)]) and
+        left out, or yielded with packed left None unless skip_illegal.
+
+        for game in PgnImport('big.pgn', processes=8):
+            ...
+    '''
+
+    # bytes per shard, sized from the file and worker count between these
+    min_shard = 1 << 20
+    max_shard = 1 << 26
+    shards_per_process = 8
+
+    def __init__(self, filename, processes=None, shard_size=None, validate=True, skip_illegal=True):
+
+        self.filename = filename
+        self.processes = processes or cpu_count()
+        self.validate = validate
+        self.skip_illegal = skip_illegal
+        if shard_size is None:
+            shard_size = os.path.getsize(filename) / (self.processes * self.shards_per_process)
+            shard_size = max(self.min_shard, min(self.max_shard, shard_size))
+        self.shard_size = shard_size
+        self.errors = []
+
+    def __iter__(self):
+
+        self.errors = []
+        jobs = [(self.filename, start, end, self.validate, self.skip_illegal)
+            for start, end in splitGames(self.filename, self.shard_size)]
+
+        if self.processes < 2 or len(jobs) < 2:
+            results = itertools.imap(_importShard, jobs)
+            pool = None
+        else:
+            pool = Pool(min(self.processes, len(jobs)))
+            results = pool.imap(_importShard, jobs)
+
+        try:
+            for start, end, games, errors in results:
+                if errors:
+                    self.errors.append((start, end, errors))
+                for game in games:
+                    yield game
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+
+if __name__ == '__main__':
+
+    import sys
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='read games from a pgn file')
+    parser.add_argument('filename')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='import across processes')
+    parser.add_argument('--replay', action='store_true', help='validate the moves of every game')
+    args = parser.parse_args()
+
+    begin = time.time()
+    games = plies = 0
+    if args.processes > 1:
+        reader = PgnImport(args.filename, args.processes, validate=args.replay)
+    else:
+        reader = readGames(args.filename)
+    illegal = 0
+    for game in reader:
+        games += 1
+        plies += len(game.sans)
+        if args.replay and args.processes < 2 and game.replay().illegal is not None:
+            illegal += 1
+    elapsed = time.time() - begin or 1e-9
+
+    print '%d games, %d plies in %.2fs, %d games/s' % (games, plies, elapsed, games / elapsed)
+    if args.processes > 1:
+        for start, end, errors in reader.errors:
+            print 'shard %d-%d:' % (start, end)
+            for offset, message in errors:
+                print '    %d %s' % (offset, message)
+    elif args.replay:
+        print '%d games with illegal moves' % illegal
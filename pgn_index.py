@@ -0,0 +1,213 @@
+'''
+Copyright Nate Carson 2013
+
+Sidecar index of the games in a pgn file. The index holds one fixed width
+record per game with its byte offset and length in the pgn file and the
+players, date, result and eco, so game n is found without reading the games
+before it. Both files are read through mmap.
+
+    index = PgnIndex('games.pgn')       # builds or extends games.pgn.idx
+    print len(index), index[1250000].white
+    game = index.game(1250000)
+'''
+
+import os
+import mmap
+import struct
+import zlib
+from cStringIO import StringIO
+from collections import namedtuple
+
+from pgn import readGames
+
+
+class PgnIndexError(Exception): pass
+
+
+GameInfo = namedtuple('GameInfo', 'offset length white black date result eco')
+
+
+class PgnIndex(object):
+    '''
+        Index of a pgn file kept in a sidecar file, by default the pgn file name
+        with .idx added. The index is brought up to date when opened: games
+        appended to the pgn file since the last build are added and a pgn file
+        that was otherwise changed is indexed again from the start.
+    '''
+
+    MAGIC = 'CJIX'
+    VERSION = 1
+    # magic, version, pgn bytes indexed, crc of the last indexed bytes
+    HEADER = struct.Struct('<4sIQI12x')
+    # offset, length, white, black, date, result, eco
+    RECORD = struct.Struct('<QI32s32s10s7s3s')
+    # bytes before the indexed size that must be unchanged to extend the index
+    TAIL = 4096
+
+    def __init__(self, filename, index_filename=None, update=True):
+
+        self.filename = filename
+        self.index_filename = index_filename or filename + '.idx'
+        self._pgn = self._pgn_file = None
+        self._index = self._index_file = None
+        if update or not os.path.exists(self.index_filename):
+            self.update()
+        self._open()
+
+    def _tailCrc(self, f, size):
+        start = max(0, size - self.TAIL)
+        f.seek(start)
+        return zlib.crc32(f.read(size - start)) & 0xffffffff
+
+    def _readHeader(self):
+        '''Returns (indexed size, tail crc) of the index file or None if it is unusable.'''
+
+        if not os.path.exists(self.index_filename):
+            return None
+        f = open(self.index_filename, 'rb')
+        try:
+            data = f.read(self.HEADER.size)
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+        finally:
+            f.close()
+        if len(data) != self.HEADER.size:
+            return None
+        magic, version, indexed, crc = self.HEADER.unpack(data)
+        if magic != self.MAGIC or version != self.VERSION:
+            return None
+        if (size - self.HEADER.size) % self.RECORD.size:
+            return None
+        return indexed, crc
+
+    def _record(self, game):
+
+        get = game.headers.get
+        return self.RECORD.pack(game.offset, game.length,
+            get('White', ''), get('Black', ''), get('Date', ''), get('Result', game.result or ''), get('ECO', ''))
+
+    def update(self):
+        '''Indexes the games added to the pgn file since the last update, returns how many.'''
+
+        self.close()
+        pgn_size = os.path.getsize(self.filename)
+        header = self._readHeader()
+
+        pgn = open(self.filename, 'rb')
+        try:
+            count, start, reread = 0, 0, 0
+            if header is not None:
+                indexed, crc = header
+                if indexed > pgn_size or self._tailCrc(pgn, indexed) != crc:
+                    header = None
+
+            if header is None:
+                index = open(self.index_filename, 'w+b')
+                index.write(self.HEADER.pack(self.MAGIC, self.VERSION, 0, 0))
+            else:
+                if indexed == pgn_size:
+                    return 0
+                index = open(self.index_filename, 'r+b')
+                index.seek(0, os.SEEK_END)
+                count = (index.tell() - self.HEADER.size) / self.RECORD.size
+                # the last game may have been cut short when indexed so it is read again
+                if count:
+                    count -= 1
+                    reread = 1
+                    index.seek(self.HEADER.size + count * self.RECORD.size)
+                    start = self.RECORD.unpack(index.read(self.RECORD.size))[0]
+                    index.seek(self.HEADER.size + count * self.RECORD.size)
+                    index.truncate()
+
+            added = 0
+            try:
+                pgn.seek(start)
+                for game in readGames(pgn, start):
+                    index.write(self._record(game))
+                    added += 1
+                index.seek(0)
+                index.write(self.HEADER.pack(self.MAGIC, self.VERSION, pgn_size, self._tailCrc(pgn, pgn_size)))
+            finally:
+                index.close()
+        finally:
+            pgn.close()
+
+        # the game read again is not counted as new
+        return max(0, added - reread)
+
+    def _open(self):
+
+        self._pgn_file = open(self.filename, 'rb')
+        if os.path.getsize(self.filename):
+            self._pgn = mmap.mmap(self._pgn_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._pgn = ''
+        self._index_file = open(self.index_filename, 'rb')
+        self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._count = (len(self._index) - self.HEADER.size) / self.RECORD.size
+
+    def close(self):
+
+        for name in ('_pgn', '_pgn_file', '_index', '_index_file'):
+            f = getattr(self, name)
+            if f is not None and not isinstance(f, str):
+                f.close()
+            setattr(self, name, None)
+        self._count = 0
+
+    def refresh(self):
+        '''Picks up games appended to the pgn file, returns how many were added.'''
+
+        added = self.update()
+        self._open()
+        return added
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, n):
+        '''Returns the GameInfo of game n.'''
+
+        if n < 0:
+            n += self._count
+        if not 0 <= n < self._count:
+            raise IndexError(n)
+        start = self.HEADER.size + n * self.RECORD.size
+        fields = self.RECORD.unpack(self._index[start:start + self.RECORD.size])
+        return GameInfo(*(fields[:2] + tuple([f.rstrip('\0') for f in fields[2:]])))
+
+    def __iter__(self):
+        for n in xrange(self._count):
+            yield self[n]
+
+    def text(self, n):
+        '''Returns the pgn text of game n.'''
+        info = self[n]
+        return self._pgn[info.offset:info.offset + info.length]
+
+    def game(self, n):
+        '''Returns game n parsed as a PgnGame.'''
+
+        info = self[n]
+        for game in readGames(StringIO(self.text(n))):
+            game.offset = info.offset
+            return game
+        raise PgnIndexError('no game at %d in %s' % (info.offset, self.filename))
+
+
+if __name__ == '__main__':
+
+    import sys
+    import time
+
+    if len(sys.argv) < 2:
+        print 'usage: pgn_index.py file.pgn [game number]'
+        sys.exit(1)
+
+    begin = time.time()
+    index = PgnIndex(sys.argv[1])
+    print '%d games indexed in %.2fs' % (len(index), time.time() - begin)
+    if len(sys.argv) > 2:
+        n = int(sys.argv[2])
+        print index[n]
+        print ' '.join(index.game(n).sans)
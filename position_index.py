@@ -0,0 +1,412 @@
+'''
+Copyright Nate Carson 2013
+
+Inverted index from position key (polyglot zobrist) to the games of an
+archive that reached the position and the ply they reached it at.
+
+    buildIndex('corpus.cja', 'corpus.cjp', processes=8)
+    index = PositionIndex('corpus.cjp')
+    games, plies = index.lookup(engine.key)
+
+The file holds a header, the sorted keys (uint64), for every key the end of
+its postings (uint64), its last game (uint32) and its posting count (uint32),
+then the postings. The postings of a key are varints, game then ply for
+every position reached, in game order with each game stored as the
+difference from the game before it. Lists of games that cover game ranges
+one after the other can so be merged by rewriting one varint per key.
+'''
+
+import os
+import mmap
+import heapq
+import struct
+import bisect
+import tempfile
+from multiprocessing import Pool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from archive import Archive
+from bitboard import BitboardPosition
+
+
+class PositionIndexError(Exception): pass
+
+
+MAGIC = 'CJPI'
+VERSION = 1
+# magic, version, keys, postings, key table position, postings position
+HEADER = struct.Struct('<4sIQQQQ')
+
+
+def encodeVarint(value, out):
+    '''Appends value as a little endian base 128 varint to a bytearray.'''
+
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decodeVarints(data):
+    '''Returns the values of a string of varints as a list.'''
+
+    values, value, shift = [], 0, 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def _decodeNumpy(data):
+    '''decodeVarints over a numpy uint8 array without a python loop.'''
+
+    if not len(data):
+        return numpy.zeros(0, dtype='uint64')
+    last = (data & 0x80) == 0
+    first = numpy.concatenate(([True], last[:-1]))
+    starts = numpy.flatnonzero(first)
+    group = numpy.cumsum(first) - 1
+    shift = (numpy.arange(len(data)) - starts[group]) * 7
+    parts = (data & 0x7f).astype('uint64') << shift.astype('uint64')
+    return numpy.add.reduceat(parts, starts)
+
+
+class _Writer(object):
+    '''Writes the keys of an index in sorted order with their encoded postings.'''
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self._blob = tempfile.TemporaryFile()
+        self._keys, self._ends, self._lasts, self._counts = [], [], [], []
+        self._end = 0
+        self._postings = 0
+
+    def add(self, key, data, last, count):
+
+        self._blob.write(data)
+        self._end += len(data)
+        self._keys.append(key)
+        self._ends.append(self._end)
+        self._lasts.append(last)
+        self._counts.append(count)
+        self._postings += count
+
+    def close(self):
+
+        count = len(self._keys)
+        f = open(self.filename, 'wb')
+        try:
+            f.write(HEADER.pack(MAGIC, VERSION, count, self._postings, HEADER.size,
+                HEADER.size + 24 * count))
+            for fmt, values in (('Q', self._keys), ('Q', self._ends), ('I', self._lasts), ('I', self._counts)):
+                # in blocks to keep struct from building one huge format
+                for start in xrange(0, count, 65536):
+                    block = values[start:start + 65536]
+                    f.write(struct.pack('<%d%s' % (len(block), fmt), *block))
+            self._blob.seek(0)
+            while True:
+                data = self._blob.read(1 << 20)
+                if not data:
+                    break
+                f.write(data)
+        finally:
+            f.close()
+            self._blob.close()
+
+
+def writeIndex(filename, postings):
+    '''Writes an index from (key, game, ply) tuples sorted by key then game.'''
+
+    writer = _Writer(filename)
+    key = data = None
+    for k, game, ply in postings:
+        if k != key:
+            if key is not None:
+                writer.add(key, str(data), last, count)
+            key, data, last, count = k, bytearray(), 0, 0
+        encodeVarint(game - last, data)
+        encodeVarint(ply, data)
+        last = game
+        count += 1
+    if key is not None:
+        writer.add(key, str(data), last, count)
+    writer.close()
+
+
+class PositionIndex(object):
+    '''Reads a position index through mmap.'''
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size:
+            raise PositionIndexError('%s is not a position index' % filename)
+        magic, version, count, postings, table, blob = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            raise PositionIndexError('%s is not a position index' % filename)
+
+        self._count = count
+        self.postings = postings
+        self._keys_pos = table
+        self._ends_pos = table + 8 * count
+        self._lasts_pos = table + 16 * count
+        self._counts_pos = table + 20 * count
+        self._blob_pos = blob
+        if numpy is not None:
+            self._keys = numpy.frombuffer(self._map, dtype='<u8', count=count, offset=table)
+        else:
+            self._keys = _KeyTable(self._map, table, count)
+
+    def close(self):
+        self._keys = None
+        self._map.close()
+        self._file.close()
+
+    def __len__(self):
+        '''Number of distinct positions.'''
+        return self._count
+
+    def _find(self, key):
+        '''Returns the key's position in the key table or None.'''
+
+        if numpy is not None:
+            i = int(self._keys.searchsorted(numpy.uint64(key)))
+        else:
+            i = bisect.bisect_left(self._keys, key)
+        if i < self._count and int(self._keys[i]) == key:
+            return i
+        return None
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def _entry(self, i):
+        '''Returns (key, start, end, last game, count) of the key at i.'''
+
+        unpack = struct.unpack_from
+        start = unpack('<Q', self._map, self._ends_pos + 8 * i - 8)[0] if i else 0
+        return (
+            unpack('<Q', self._map, self._keys_pos + 8 * i)[0],
+            self._blob_pos + start,
+            self._blob_pos + unpack('<Q', self._map, self._ends_pos + 8 * i)[0],
+            unpack('<I', self._map, self._lasts_pos + 4 * i)[0],
+            unpack('<I', self._map, self._counts_pos + 4 * i)[0],
+        )
+
+    def count(self, key):
+        '''Number of times the position was reached.'''
+
+        i = self._find(key)
+        if i is None:
+            return 0
+        return struct.unpack_from('<I', self._map, self._counts_pos + 4 * i)[0]
+
+    def lookup(self, key):
+        '''
+            Returns (games, plies) for every time the position was reached, in
+            game order. These are numpy arrays or, without numpy, lists.
+        '''
+
+        i = self._find(key)
+        if i is None:
+            if numpy is not None:
+                return numpy.zeros(0, dtype='uint64'), numpy.zeros(0, dtype='uint64')
+            return [], []
+        key, start, end, last, count = self._entry(i)
+
+        if numpy is not None:
+            values = _decodeNumpy(numpy.frombuffer(self._map, dtype='uint8', count=end - start, offset=start))
+            return numpy.cumsum(values[0::2]), values[1::2]
+
+        values = decodeVarints(self._map[start:end])
+        games, game = [], 0
+        for delta in values[0::2]:
+            game += delta
+            games.append(game)
+        return games, values[1::2]
+
+    def games(self, key):
+        '''Returns the distinct games that reached the position.'''
+
+        games = self.lookup(key)[0]
+        if numpy is not None:
+            return numpy.unique(games)
+        return sorted(set(games))
+
+    def entries(self):
+        '''Yields (key, encoded postings, last game, count) in key order.'''
+
+        for i in xrange(self._count):
+            key, start, end, last, count = self._entry(i)
+            yield key, self._map[start:end], last, count
+
+
+class _KeyTable(object):
+    '''Sequence over the mapped key table for bisect when numpy is missing.'''
+
+    def __init__(self, data, offset, count):
+        self._data, self._offset, self._count = data, offset, count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        return struct.unpack_from('<Q', self._data, self._offset + 8 * i)[0]
+
+
+def _numbered(entries, part):
+    for key, data, last, count in entries:
+        yield key, part, data, last, count
+
+
+def mergeIndexes(filenames, out):
+    '''
+        Merges indexes whose games are in increasing ranges, in the order given,
+        into one index.
+    '''
+
+    indexes = [PositionIndex(name) for name in filenames]
+    writer = _Writer(out)
+    try:
+        # the part number keeps the postings of a key in game order
+        streams = [_numbered(index.entries(), part) for part, index in enumerate(indexes)]
+
+        key = None
+        for k, part, data, last, count in heapq.merge(*streams):
+            if k != key:
+                if key is not None:
+                    writer.add(key, str(merged), merged_last, merged_count)
+                key, merged, merged_last, merged_count = k, bytearray(data), last, count
+                continue
+
+            # rewrite the first game of the list from an absolute game to a difference
+            end = 0
+            while ord(data[end]) & 0x80:
+                end += 1
+            first = decodeVarints(data[:end + 1])[0]
+            encodeVarint(first - merged_last, merged)
+            merged.extend(data[end + 1:])
+            merged_last = last
+            merged_count += count
+
+        if key is not None:
+            writer.add(key, str(merged), merged_last, merged_count)
+        writer.close()
+    finally:
+        for index in indexes:
+            index.close()
+
+
+def positionPostings(line):
+    '''Returns (key, ply) of every position of a game line, start position first.'''
+
+    position = BitboardPosition(line.start_fen)
+    postings = [(position.key, 0)]
+    for ply, move in enumerate(line.moves):
+        position.makeMove(move)
+        postings.append((position.key, ply + 1))
+    return postings
+
+
+def _buildPart(args):
+    '''Indexes a range of archive games into part files of at most batch postings.'''
+
+    archive_name, start, end, batch, directory, gamePostings = args
+    archive = Archive(archive_name)
+    parts, postings = [], []
+
+    def flush():
+        postings.sort()
+        fd, name = tempfile.mkstemp('.cjp', 'part', directory)
+        os.close(fd)
+        writeIndex(name, postings)
+        parts.append(name)
+        del postings[:]
+
+    try:
+        for game in xrange(start, end):
+            postings.extend([(key, game, ply) for key, ply in gamePostings(archive.gameLine(game))])
+            if len(postings) >= batch:
+                flush()
+        if postings or not parts:
+            flush()
+    finally:
+        archive.close()
+    return parts
+
+
+def buildIndex(archive_name, out, processes=1, batch=1 << 21, postings=positionPostings):
+    '''
+        Indexes every position of an archive into a position index file. The
+        games are split into ranges indexed by a process pool, each range is
+        written as sorted part files of at most batch postings and the parts
+        are merged in game order. postings is a module level function that
+        returns the (key, ply) pairs to index for a GameLine.
+    '''
+
+    archive = Archive(archive_name)
+    count = len(archive)
+    archive.close()
+
+    directory = os.path.dirname(os.path.abspath(out))
+    jobs = max(1, processes) * 4
+    size = max(1, (count + jobs - 1) / jobs)
+    ranges = [(archive_name, start, min(count, start + size), batch, directory, postings)
+        for start in xrange(0, count, size)] or [(archive_name, 0, 0, batch, directory, postings)]
+
+    if processes > 1:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_buildPart, ranges, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_buildPart, ranges)
+
+    parts = [name for names in results for name in names]
+    try:
+        if len(parts) == 1:
+            os.rename(parts[0], out)
+            parts = []
+        else:
+            mergeIndexes(parts, out)
+    finally:
+        for name in parts:
+            os.remove(name)
+
+
+if __name__ == '__main__':
+
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description='build or query a position index of a game archive')
+    parser.add_argument('index')
+    parser.add_argument('-a', '--archive', help='archive to index')
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('-f', '--fen', help='position to look up')
+    args = parser.parse_args()
+
+    if args.archive:
+        begin = time.time()
+        buildIndex(args.archive, args.index, args.processes)
+        print 'indexed in %.2fs' % (time.time() - begin)
+
+    index = PositionIndex(args.index)
+    print '%d positions, %d postings' % (len(index), index.postings)
+    if args.fen:
+        begin = time.time()
+        games, plies = index.lookup(BitboardPosition(args.fen).key)
+        print '%d postings in %.2fms' % (len(games), (time.time() - begin) * 1000)
@@ -69,8 +69,12 @@ class ChessScene(QtGui.QGraphicsScene):
     def cursorSelect(self):
         self.board.cursorSelect()
 
-    def loadGame(self, moves):
-        position = self.moves.loadGame(moves)
+    def loadGame(self, moves, initial=None):
+        position = self.moves.loadGame(moves, initial)
+        self.moves.first()
+
+    def loadPgnGame(self, game):
+        self.moves.loadPgnGame(game)
         self.moves.first()
 
     def newGame(self):
@@ -160,8 +164,8 @@ class ChessWidget(QtGui.QWidget):
     def toggleGuides(self):
         self.scene.board.toggleGuides()
 
-    def loadGame(self, moves):
-        self.scene.loadGame(moves)
+    def loadGame(self, moves, initial=None):
+        self.scene.loadGame(moves, initial)
 
     def keyPressEvent(self, event):
         
@@ -11,6 +11,10 @@ dbname = 'chess'
 lib = '/../build/lib'
 media_piece = '/media/pieces/'
 dbchesslib = os.getcwd() + lib
+# opening tree file (see opening_tree.py) for the variations table instead of the database
+opening_tree = None
+# eco table (see eco.py) for the openings table instead of the database
+eco_table = None
 
 COLOR_NONE = QtGui.QColor(0,0,0,0)
 
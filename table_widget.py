@@ -4,9 +4,13 @@ Copyright Nate Carson 2012
 '''
 from PyQt4 import QtCore, QtGui
 
-from db import Moves, Opening
+from db import Moves, Opening, VariationStats
 from util import tr, ToolBar
-from game_engine import BoardString, GameMove
+from game_engine import BoardString, AbstractGameMove
+from pgn_index import PgnIndex, PgnIndexError
+from opening_tree import OpeningTree
+from eco import EcoClassifier
+from bitboard import BitboardPosition
 import settings
 
 
@@ -72,23 +76,58 @@ class OpeningTable(TableWidget):
 
 	moveSelected = QtCore.pyqtSignal(str)
 
-	#FIXME
+	def __init__(self, eco_filename=None):
+		super(OpeningTable, self).__init__()
+
+		# without an eco table the openings come from the database
+		eco_filename = eco_filename or settings.eco_table
+		self.classifier = EcoClassifier.load(eco_filename) if eco_filename else None
+		self.cursor = self.classifier and self.classifier.cursor()
+		# halfmove the cursor started from
+		self._start = 0
+
+	def _classify(self, move):
+		'''Returns rows of (eco, opening, variation, next move) for the position after a move.'''
+
+		if move.fen_before is None:
+			# the initial move of a new game
+			self.cursor = self.classifier.cursor(move.fen_after)
+			self._start = move.halfmove - 1
+		else:
+			# follow the move list when moves are taken back or another move is picked
+			ply = move.halfmove - 1 - self._start
+			if not 0 <= ply <= self.cursor.ply:
+				self.cursor = self.classifier.cursor(move.fen_before)
+				self._start, ply = move.halfmove - 1, 0
+			self.cursor.goBack(ply)
+			self.cursor.advance(move)
+
+		rows = []
+		eco = self.cursor.eco
+		if eco is not None:
+			rows.append((eco.eco, eco.opening, eco.variation, ''))
+		position = BitboardPosition(move.fen_after)
+		for packed, eco in self.cursor.continuations():
+			if eco is not None:
+				rows.append((eco.eco, eco.opening, eco.variation, position.san(packed)))
+		return rows
+
 	def onMoveMade(self, move):
 
-		rows = Opening.select(str(boardstring), str(move))
+		if self.classifier is not None:
+			rows = self._classify(move)
+		else:
+			rows = [(row.eco, row.opening, row.variation, (row.moves.split()[move.halfmove:] or [''])[0])
+				for row in Opening.select(str(BoardString(move.fen_after)), str(move))]
 		self.setRowCount(len(rows))
 
-		for idx, row in enumerate(rows):
-			try:
-				m = row.moves[halfmove]
-			except IndexError:
-				m = ''
+		for idx, (eco, opening, variation, m) in enumerate(rows):
 
-			item = QtGui.QTableWidgetItem(row.eco)
+			item = QtGui.QTableWidgetItem(eco)
 			self.setItem(idx, 0, item)
-			item = QtGui.QTableWidgetItem(row.opening)
+			item = QtGui.QTableWidgetItem(opening)
 			self.setItem(idx, 1, item)
-			item = QtGui.QTableWidgetItem(row.variation)
+			item = QtGui.QTableWidgetItem(variation)
 			self.setItem(idx, 2, item)
 			item = QtGui.QTableWidgetItem(m)
 			self.setItem(idx, 3, item)
@@ -109,9 +148,13 @@ class VariationsTable(TableWidget):
 
 	moveSelected = QtCore.pyqtSignal(str, str, str, str)
 
-	def __init__(self):
+	def __init__(self, tree_filename=None):
 		super(VariationsTable, self).__init__()
 
+		# without a tree file the variations come from the database
+		tree_filename = tree_filename or settings.opening_tree
+		self.tree = OpeningTree(tree_filename) if tree_filename else None
+
 		self._addAction('0', 'first_move', 'first move', self.onItemSelected)
 	
 
@@ -127,7 +170,10 @@ class VariationsTable(TableWidget):
 	
 	def set(self, move):
 
-		variations =  db.VariationStats.select(move.board_before)
+		if self.tree is not None:
+			variations = self.tree.variations(move.fen_before or move.fen_after)
+		else:
+			variations =  VariationStats.select(move.board_before)
 		self.setRowCount(len(variations))
 
 		for idx, variation in enumerate(variations):
@@ -175,7 +221,7 @@ class MoveTable(TableWidget):
 
 	labels = ['White', 'Black']
 
-	moveMade = QtCore.pyqtSignal(GameMove)
+	moveMade = QtCore.pyqtSignal(AbstractGameMove)
 
 	def __init__(self, board, game_engine):
 		super(MoveTable, self).__init__()
@@ -325,3 +371,122 @@ class MoveTable(TableWidget):
 	
 
 
+
+class GameListModel(QtCore.QAbstractTableModel):
+	'''Table model over a PgnIndex, rows are only read from the index when shown.'''
+
+	labels = ['White', 'Black', 'Date', 'Result', 'Eco']
+	fields = ['white', 'black', 'date', 'result', 'eco']
+
+	def __init__(self, index=None):
+		super(GameListModel, self).__init__()
+		self.index_ = index
+
+	def setIndex(self, index):
+		self.beginResetModel()
+		self.index_ = index
+		self.endResetModel()
+
+	def rowCount(self, parent=QtCore.QModelIndex()):
+		if parent.isValid() or self.index_ is None:
+			return 0
+		return len(self.index_)
+
+	def columnCount(self, parent=QtCore.QModelIndex()):
+		return len(self.labels)
+
+	def data(self, index, role=QtCore.Qt.DisplayRole):
+		if role != QtCore.Qt.DisplayRole or not index.isValid():
+			return None
+		info = self.index_[index.row()]
+		return getattr(info, self.fields[index.column()])
+
+	def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+		if role != QtCore.Qt.DisplayRole:
+			return None
+		if orientation == QtCore.Qt.Horizontal:
+			return tr(self.labels[section])
+		return section + 1
+
+
+class PgnIndexThread(QtCore.QThread):
+	'''Builds or extends the PgnIndex of a pgn file away from the gui thread.'''
+
+	indexed = QtCore.pyqtSignal(object)
+	failed = QtCore.pyqtSignal(str)
+
+	def __init__(self, filename, parent=None):
+		super(PgnIndexThread, self).__init__(parent)
+		self.filename = filename
+
+	def run(self):
+		try:
+			index = PgnIndex(self.filename)
+		except (PgnIndexError, IOError, OSError), e:
+			self.failed.emit(str(e))
+		else:
+			self.indexed.emit(index)
+
+
+class GameListView(QtGui.QTableView):
+	'''
+		Browses the games of an indexed pgn file, emits the game picked. Files
+		are indexed by a PgnIndexThread and listed once it is done.
+	'''
+
+	gameSelected = QtCore.pyqtSignal(object)
+	indexFailed = QtCore.pyqtSignal(str)
+
+	def __init__(self):
+		super(GameListView, self).__init__()
+
+		self._thread = None
+
+		self.model_ = GameListModel()
+		self.setModel(self.model_)
+		self.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
+		self.setSelectionBehavior(QtGui.QAbstractItemView.SelectRows)
+		self.setSelectionMode(QtGui.QAbstractItemView.SingleSelection)
+		# every row is the same height so the view does not measure a million rows
+		self.verticalHeader().setResizeMode(QtGui.QHeaderView.Fixed)
+		self.activated.connect(self.onActivated)
+
+	def openPgn(self, filename):
+		'''Starts indexing a pgn file, or bringing its index up to date, to list its games.'''
+
+		# two threads must not write the same index file
+		running = self._thread
+		if running is not None and running.isRunning() and running.filename == filename:
+			return running
+
+		# the index file may be rewritten so the one listed is let go first
+		index = self.model_.index_
+		self.model_.setIndex(None)
+		if index is not None:
+			index.close()
+
+		thread = self._thread = PgnIndexThread(filename, self)
+		thread.indexed.connect(self._onIndexed)
+		thread.failed.connect(self._onFailed)
+		thread.start()
+		return thread
+
+	def _onIndexed(self, index):
+		# a file opened since this one was started replaces it
+		if self.sender() is not self._thread:
+			index.close()
+			return
+		self.model_.setIndex(index)
+
+	def _onFailed(self, message):
+		if self.sender() is self._thread:
+			self.indexFailed.emit(message)
+
+	def refresh(self):
+		index = self.model_.index_
+		if index is not None:
+			self.openPgn(index.filename)
+
+	def onActivated(self, item):
+		game = self.model_.index_.game(item.row())
+		self.gameSelected.emit(game)
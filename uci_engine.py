@@ -2,6 +2,8 @@
 
 from PyQt4 import QtCore
 
+from engine_pool import EnginePool
+
 '''
 http://wbec-ridderkerk.nl/html/UCIProtocol.html
 '''
@@ -200,6 +202,39 @@ class UciEngine(QtCore.QThread):
         super(UciEngine, self).start()
 
 
+class QtEnginePool(QtCore.QObject):
+    '''
+        engine_pool.EnginePool for the gui. The pool's threads hand their results
+        over as queued signals so slots run in the gui thread.
+    '''
+
+    analysis_finished = QtCore.pyqtSignal(object)
+    analysis_failed = QtCore.pyqtSignal(object, str)
+
+    def __init__(self, path, size=None, options=None, parent=None):
+        super(QtEnginePool, self).__init__(parent)
+
+        self.pool = EnginePool(path, size, options)
+
+    def submit(self, fen, moves=(), **limits):
+        '''Queues a position, its Analysis is emitted with analysis_finished or analysis_failed.'''
+
+        analysis = self.pool.submit(fen, moves, **limits)
+        analysis.addDoneCallback(self._onDone)
+        return analysis
+
+    def _onDone(self, analysis):
+
+        error = analysis.error()
+        if error is None:
+            self.analysis_finished.emit(analysis)
+        elif not analysis.cancelled():
+            self.analysis_failed.emit(analysis, str(error))
+
+    def close(self, cancel=True):
+        self.pool.close(cancel)
+
+
 
 if __name__ == '__main__':
 